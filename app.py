@@ -3,6 +3,8 @@ import os
 import json
 import time
 import base64
+import asyncio
+import logging
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -10,182 +12,157 @@ from dotenv import load_dotenv
 for var in ["HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"]:
     os.environ.pop(var, None)
 
-from flask import Flask, request, jsonify
+# 各モジュールは import 時に環境変数を読むので、.env はプロジェクトのモジュールより先に読み込む
+load_dotenv()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from openai import OpenAI
-import faiss
-import numpy as np
 from product_film_matcher import ProductFilmMatcher
-from query_expander import expand_query
-from expand_reserve_query import expand_reserve_query
-
-# ① 共通設定（ここにパスを定義）
-EMBED_MODEL = "text-embedding-3-small"
-VECTOR_PATH = "data/vector_data.npy"
-INDEX_PATH = "data/index.faiss"
-RESERVE_VECTOR_PATH = "data/reserve_vector_data.npy"
-RESERVE_INDEX_PATH = "data/reserve_index.faiss"
-
-load_dotenv()
+from query_expander import expand_query, rewriter as query_rewriter
+from expand_reserve_query import expand_reserve_query, rewriter as reserve_query_rewriter
+from embedding_cache import EmbeddingCache
+from embedding_batcher import EmbeddingBatcher
+from embedding_provider import get_provider
+from knowledge_base import FUSION_CANDIDATES, RETRIEVAL_MODE, KnowledgeSnapshot, artifact_paths
+from artifact_reloader import ArtifactReloader
+from process_memory import memory_stats
+from semantic_cache import SemanticCache
+from sheets_writer import SheetsWriter
+from session_store import get_session_store
+from prompt_builder import PromptBuilder
+import metrics
+
+# 🪵 ログレベル（DEBUG でキーワード抽出・製品フィルム照合の詳細を出力）
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 
 app = Flask(__name__)
 CORS(app)
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-session_histories = {}
-HISTORY_TTL = 1800
+# ✅ 埋め込みの取得先（EMBED_PROVIDER: openai / local）
+embedding_provider = get_provider()
 
-def get_session_history(session_id):
-    now = time.time()
-    session = session_histories.get(session_id)
-    if not session or now - session["last_active"] > HISTORY_TTL:
-        session_histories[session_id] = {"last_active": now, "history": []}
-    else:
-        session_histories[session_id]["last_active"] = now
-    return session_histories[session_id]["history"]
+# ✅ 埋め込みキャッシュ（同じ質問・同じ文書は OpenAI を呼ばずに再利用）
+embedding_cache = EmbeddingCache(embedding_provider.model, embedding_provider.dimensions)
 
-def add_to_session_history(session_id, role, content):
-    history = get_session_history(session_id)
-    history.append({"role": role, "content": content})
-    if len(history) > 10:
-        history[:] = history[-10:]
-
-# 通常用
-with open("data/faq.json", encoding="utf-8") as f:
-    faq_items = json.load(f)
-faq_questions = [item["question"] for item in faq_items]
-faq_answers = [item["answer"] for item in faq_items]
-
-with open("data/knowledge.json", encoding="utf-8") as f:
-    knowledge_dict = json.load(f)
-knowledge_contents = [
-    f"{category}：{text}" for category, texts in knowledge_dict.items() for text in texts
-]
-
-metadata_note = ""
-metadata_path = "data/metadata.json"
-if os.path.exists(metadata_path):
-    with open(metadata_path, encoding="utf-8") as f:
-        metadata = json.load(f)
-        metadata_note = f"{metadata.get('title', '')} (種類: {metadata.get('type', '')}, 優先度: {metadata.get('priority', '')})"
-
-search_corpus = faq_questions + knowledge_contents
-source_flags = ["faq"] * len(faq_questions) + ["knowledge"] * len(knowledge_contents)
-
-# ✅ 予約システム用 FAQ の読み込み
-with open("data/reserve_faq.json", encoding="utf-8") as f:
-    reserve_faq_items = json.load(f)
-reserve_faq_questions = [item["question"] for item in reserve_faq_items]
-reserve_faq_answers = [item["answer"] for item in reserve_faq_items]
-
-# ✅ 予約システム用 Knowledge の読み込み
-with open("data/reserve_knowledge.json", encoding="utf-8") as f:
-    reserve_knowledge_dict = json.load(f)
-reserve_knowledge_contents = [
-    f"{category}：{text}" for category, texts in reserve_knowledge_dict.items() for text in texts
-]
-
-# ✅ 予約システム用 検索対象とフラグ
-reserve_search_corpus = reserve_faq_questions + reserve_knowledge_contents
-reserve_source_flags = ["faq"] * len(reserve_faq_questions) + ["knowledge"] * len(reserve_knowledge_contents)
-
-# ✅ 通常用 FAISS インデックスの読み込みまたは生成
-if os.path.exists(VECTOR_PATH) and os.path.exists(INDEX_PATH):
-    vector_data = np.load(VECTOR_PATH)
-    index = faiss.read_index(INDEX_PATH)
-else:
-    vector_data = np.array([get_embedding(text) for text in search_corpus], dtype="float32")
-    index = faiss.IndexFlatL2(vector_data.shape[1])
-    index.add(vector_data)
-    np.save(VECTOR_PATH, vector_data)
-    faiss.write_index(index, INDEX_PATH)
-
-# ✅ 予約システム用 FAISS インデックスの読み込みまたは生成
-if os.path.exists(RESERVE_VECTOR_PATH) and os.path.exists(RESERVE_INDEX_PATH):
-    reserve_vector_data = np.load(RESERVE_VECTOR_PATH)
-    reserve_index = faiss.read_index(RESERVE_INDEX_PATH)
-else:
-    reserve_vector_data = np.array([get_embedding(text) for text in reserve_search_corpus], dtype="float32")
-    reserve_index = faiss.IndexFlatL2(reserve_vector_data.shape[1])
-    reserve_index.add(reserve_vector_data)
-    np.save(RESERVE_VECTOR_PATH, reserve_vector_data)
-    faiss.write_index(reserve_index, RESERVE_INDEX_PATH)
-
-# --- 予約専用データの読み込み ---
-with open("data/reserve_faq.json", "r", encoding="utf-8") as f:
-    reserve_faq_list = json.load(f)
-
-with open("data/reserve_knowledge.json", "r", encoding="utf-8") as f:
-    reserve_knowledge_dict = json.load(f)
-
-reserve_knowledge_texts = [
-    f"{category}：{text}"
-    for category, texts in reserve_knowledge_dict.items()
-    for text in texts
-]
-
-reserve_corpus = [
-    f"{item['question']} {item['answer']}" for item in reserve_faq_list
-] + reserve_knowledge_texts
-
-reserve_index = faiss.read_index("data/reserve_index.faiss")
-# --- ここまで追加 ---
+# ✅ 同時リクエストの埋め込みを 1 回の API 呼び出しにまとめる
+embedding_batcher = EmbeddingBatcher(embedding_provider.embed)
+# 質問の埋め込みを待つ上限（秒）。超えたら語彙検索だけで続行する（.env の値を使うため load_dotenv() の後で読む）
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "10"))
 
 def get_embedding(text):
     if not text or not text.strip():
         raise ValueError("空のテキストには埋め込みを生成できません")
+    cached = embedding_cache.get(text)
+    if cached is not None:
+        return cached
     try:
-        response = client.embeddings.create(
-            model=EMBED_MODEL,
-            input=[text]
-        )
-        if not response.data or not response.data[0].embedding:
-            raise ValueError("埋め込みデータが空です")
-        return np.array(response.data[0].embedding, dtype="float32")
+        with metrics.span("embedding"):
+            vector = embedding_batcher.embed(text, timeout=EMBED_TIMEOUT)
+        embedding_cache.put(text, vector)
+        return vector
+    except Exception as e:
+        print("❌ Embedding error:", e)
+        raise
+
+async def aget_embedding(text):
+    # 非同期版（asgi_app.py）用。API 待ちの間もイベントループを塞がない
+    if not text or not text.strip():
+        raise ValueError("空のテキストには埋め込みを生成できません")
+    cached = embedding_cache.get(text)
+    if cached is not None:
+        return cached
+    try:
+        with metrics.span("embedding"):
+            vector = await asyncio.wait_for(embedding_batcher.aembed(text), EMBED_TIMEOUT)
+        embedding_cache.put(text, vector)
+        return vector
     except Exception as e:
         print("❌ Embedding error:", e)
         raise
 
+def query_embedding(text):
+    # 質問の埋め込み。語彙検索のみの設定、または埋め込みが遅い・使えないときは None
+    if RETRIEVAL_MODE == "lexical":
+        return None
+    try:
+        return get_embedding(text)
+    except Exception as e:
+        print("⚠️ 埋め込みを取得できないため、語彙検索のみで回答します:", e)
+        return None
+
+async def aquery_embedding(text):
+    if RETRIEVAL_MODE == "lexical":
+        return None
+    try:
+        return await aget_embedding(text)
+    except Exception as e:
+        print("⚠️ 埋め込みを取得できないため、語彙検索のみで回答します:", e)
+        return None
+
+# ✅ 会話履歴（SESSION_BACKEND: memory / sqlite / redis。件数の上限・期限切れの掃除つき）
+session_store = get_session_store()
+
+def get_session_history(session_id):
+    # 期限内の直近の履歴のコピー（追記は add_to_session_history で行う）
+    return session_store.history(session_id)
+
+def add_to_session_history(session_id, role, content):
+    session_store.append(session_id, role, content)
+
+def embed_corpus(texts):
+    # インデックスが無いときの初回構築用
+    return embedding_cache.embed(texts, embedding_provider.embed)
+
+def on_knowledge_swap(snapshot):
+    # 新しい版に切り替わったら、古いコンテキストで作った回答キャッシュは使わない
+    semantic_cache.clear()
+
+# ✅ 通常用 / 予約システム用のコーパス・インデックス・FAQ 直接回答（1 世代分）
+# データが更新されたら再起動せずに読み込み直し、検証後に差し替える
+knowledge = ArtifactReloader(
+    lambda: KnowledgeSnapshot.load(embed=embed_corpus, embedding=embedding_provider.info()),
+    watch_paths=artifact_paths(),
+    on_swap=on_knowledge_swap,
+)
+
 # 🔽 ここに予約用検索関数を追加
 
 def search_reserve_knowledge(user_q, k=3):
-    query_vector = get_embedding(user_q).astype("float32").reshape(1, -1)
-    scores, indices = reserve_index.search(query_vector, k)
-    hits = [reserve_corpus[i] for i in indices[0] if i < len(reserve_corpus)]
-    return hits
-
-# 🔽 ここに判定関数を追加
-def is_reserve_query(user_q):
-    keywords = ["予約", "納期", "製造日", "納品", "アクセス", "ID", "パスワード", "ログイン"]
-    return any(kw in user_q for kw in keywords)
-
-if os.path.exists(VECTOR_PATH) and os.path.exists(INDEX_PATH):
-    vector_data = np.load(VECTOR_PATH)
-    index = faiss.read_index(INDEX_PATH)
-else:
-    vector_data = np.array([get_embedding(text) for text in search_corpus], dtype="float32")
-    index = faiss.IndexFlatL2(vector_data.shape[1])
-    index.add(vector_data)
-    np.save(VECTOR_PATH, vector_data)
-    faiss.write_index(index, INDEX_PATH)
+    reserve_kb = knowledge.snapshot().reserve
+    _, I = reserve_kb.search(get_embedding(user_q), k)
+    return reserve_kb.texts(I)
 
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 UNANSWERED_SHEET = "faq_suggestions_reserve"
 FEEDBACK_SHEET = "feedback_log_reserve"
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+# 負荷試験などで Sheets API の接続先を差し替える（未設定なら本番の API）
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT")
 
 credentials_info = json.loads(base64.b64decode(os.environ["GOOGLE_CREDENTIALS"]).decode("utf-8"))
 credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-sheet_service = build("sheets", "v4", credentials=credentials).spreadsheets()
+client_options = {"api_endpoint": SHEETS_API_ENDPOINT} if SHEETS_API_ENDPOINT else None
+sheet_service = build("sheets", "v4", credentials=credentials, client_options=client_options).spreadsheets()
+
+# ✅ Sheets への追記はバックグラウンドでまとめて行う（リクエストの応答時間に影響させない）
+sheets_writer = SheetsWriter(sheet_service, SPREADSHEET_ID)
 
 pf_matcher = ProductFilmMatcher("data/product_film_color_matrix.json")
 
+# ✅ 言い換え質問への回答キャッシュ（データの版が切り替わったら破棄）
+semantic_cache = SemanticCache(dimensions=knowledge.current.general.dimension)
+
 with open("system_prompt.txt", encoding="utf-8") as f:
     base_prompt = f.read()
 
+# ✅ コンテキストをトークン数の予算内に詰めてプロンプトを組み立てる
+prompt_builder = PromptBuilder(base_prompt)
+
 def infer_response_mode(question):
     q_len = len(question)
     if q_len < 30:
@@ -199,26 +176,291 @@ CHAT_LOG_SHEET = "chat_logs_reserve"
 
 # ✅ ログ記録関数（ここに追加）
 def log_chat_history(user_q, answer, source_type, is_unanswered):
-    try:
-        sheet_service.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{CHAT_LOG_SHEET}!A2:E",
-            valueInputOption="RAW",
-            body={"values": [[
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                user_q.strip(),
-                answer.strip(),
-                source_type,
-                str(is_unanswered).lower()
-            ]]}
-        ).execute()
-    except Exception as e:
-        print("❌ ログ出力失敗:", e)
-
+    sheets_writer.append(f"{CHAT_LOG_SHEET}!A2:E", [
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        user_q.strip(),
+        answer.strip(),
+        source_type,
+        str(is_unanswered).lower()
+    ])
+
+RESERVE_ROUTE_KEYWORDS = ["予約", "ログイン", "マニュアル", "アカウント", "登録"]
+UNANSWERED_PHRASES = ["申し訳", "恐れ入りますが", "エラー"]
 GREETING_PATTERNS = ["こんにちは", "こんばんは", "おはよう", "はじめまして", "宜しくお願いします", "よろしくお願いします"]
+GREETING_REPLY = "こんにちは！ご質問があればお気軽にどうぞ。"
+OUT_OF_SCOPE_ANSWER = (
+    "当社はコーヒー製品の委託加工を専門とする会社です。"
+    "恐れ入りますが、ご質問内容が当社業務と直接関連のある内容かどうかをご確認のうえ、"
+    "改めてお尋ねいただけますと幸いです。\n\n"
+    "ご不明な点がございましたら、当社の【お問い合わせフォーム】よりご連絡ください。"
+)
+
+# === /chat の各ステージ（同期版 /chat と asgi_app.py の非同期版で共用） ===
+def is_reserve_route(user_q):
+    # 埋め込みが使えない（語彙検索のみ）ときの振り分け
+    lower_q = user_q.lower()
+    return any(x in lower_q for x in RESERVE_ROUTE_KEYWORDS)
+
+def route_corpus(q_vector, user_q, snapshot):
+    # "general" / "reserve" / "both"。検索に使う埋め込みで判定するので API 呼び出しは増えない
+    if q_vector is None:
+        return "reserve" if is_reserve_route(user_q) else "general"
+    with metrics.span("route"):
+        route, _ = snapshot.router.route(q_vector)
+    return route
+
+def search_knowledge_base(q_vector, query_text, use_reserve, snapshot, vector_hits=None):
+    kb = snapshot.kb_for(use_reserve)
+    with metrics.span("search"):
+        D, I = kb.retrieve(q_vector, query_text, k=7, vector_hits=vector_hits)
+    if I.shape[1] == 0:
+        raise ValueError("検索結果が見つかりませんでした")
+    return D, I, kb
+
+def search_routed(q_vector, query_text, route, snapshot):
+    """振り分け結果に従って検索し、(use_reserve, D, I, kb) を返す。
+
+    "both"（どちらとも言えない）のときは両方の行をまとめて 1 回でベクトル検索し、
+    距離が近い行を持つ方のコーパスを使う。
+    """
+    if route != "both":
+        use_reserve = route == "reserve"
+        result = (use_reserve, *search_knowledge_base(q_vector, query_text, use_reserve, snapshot))
+    else:
+        # "both" は埋め込みでの振り分けからしか出ない（埋め込みが無いときはキーワードで片方に決める）
+        with metrics.span("search_both"):
+            hits = snapshot.search_both(q_vector, 7 * FUSION_CANDIDATES)
+        use_reserve = bool(hits["reserve"][0][0, 0] < hits["general"][0][0, 0])
+        vector_hits = hits["reserve" if use_reserve else "general"]
+        result = (use_reserve, *search_knowledge_base(q_vector, query_text, use_reserve, snapshot, vector_hits))
+    metrics.ROUTES.inc(route=route, corpus="reserve" if result[0] else "general")
+    return result
+
+def match_exact_faq(user_q, snapshot):
+    # FAQ の質問と完全一致なら (use_reserve, 位置)。振り分けの前なので両方の FAQ を見る
+    for use_reserve in (False, True):
+        pos = snapshot.shortcut_for(use_reserve).match_exact(user_q)
+        if pos is not None:
+            return use_reserve, pos
+    return False, None
+
+def build_context(I, kb):
+    # 検索の順位のまま、プロンプトに入れる候補を並べる（body は重複判定に使う回答・本文）
+    context = []
+
+    for idx in I[0]:
+        entry = kb.entry(idx)
+        if entry is None:
+            continue
+        if entry["source"] == "faq":
+            q = kb.faq_questions[entry["ref"]]
+            a = kb.faq_answers[entry["ref"]]
+            context.append({"source": "faq", "text": f"Q: {q}\nA: {a}", "body": a})
+        elif entry["source"] == "knowledge":
+            content = kb.knowledge_contents[entry["ref"]]
+            context.append({"source": "knowledge", "text": f"【参考知識】{content}", "body": content})
+    return context
+
+def film_info_for(user_q, session_history):
+    with metrics.span("film_match"):
+        film_match_data = pf_matcher.match(user_q, session_history)
+        return pf_matcher.format_match_info(film_match_data)
+
+def build_prompt(user_q, context, film_info_text):
+    # 回答に使えるコンテキストが一つもなければ None
+    return prompt_builder.build(user_q, context, film_info_text, infer_response_mode(user_q))
+
+def answer_context_key(version, use_reserve, I, film_info_text, mode):
+    return (
+        version,
+        "reserve" if use_reserve else "general",
+        tuple(int(i) for i in I[0]),
+        film_info_text,
+        mode,
+    )
+
+def is_unanswered_answer(answer):
+    return any(phrase in answer for phrase in UNANSWERED_PHRASES)
+
+def answer_source_type(use_reserve, faq_part):
+    if use_reserve:
+        return "reserve_faq" if "Q:" in faq_part else "reserve_knowledge"
+    return "faq" if "Q:" in faq_part else "knowledge"
+
+def log_answer(user_q, answer, source_type, is_unanswered):
+    # Google Sheets への記録（未回答リスト + 会話ログ）
+    if is_unanswered:
+        sheets_writer.append(
+            f"{UNANSWERED_SHEET}!A2:D",
+            [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_q, "未回答", 1]
+        )
+    log_chat_history(user_q, answer, source_type, is_unanswered)
+
+def faq_direct_payload(session_id, user_q, expanded_q, shortcut, pos, match_type):
+    answer = shortcut.render(pos)
+    add_to_session_history(session_id, "assistant", answer)
+    return {
+        "response": answer,
+        "original_question": user_q,
+        "expanded_question": expanded_q,
+        "answer_path": "faq_direct",
+        "faq_match": match_type,
+        "matched_question": shortcut.questions[pos]
+    }
+
+def prepare_chat(user_q, session_id):
+    """LLM 呼び出しの直前までを処理する。
+
+    回答が確定した場合（挨拶・FAQ 直接回答・対象外・回答キャッシュ）は {"done": True, "payload": ...}、
+    LLM が必要な場合は finalize_answer() に渡す途中状態を {"done": False, ...} で返す。
+    """
+    if any(greet in user_q for greet in GREETING_PATTERNS):
+        add_to_session_history(session_id, "assistant", GREETING_REPLY)
+        return {"done": True, "payload": {
+            "response": GREETING_REPLY,
+            "original_question": user_q,
+            "expanded_question": user_q
+        }}
+
+    add_to_session_history(session_id, "user", user_q)
+    session_history = get_session_history(session_id)
+
+    snapshot = knowledge.snapshot()
+
+    # FAQ の質問と完全一致なら、リライト・埋め込み・LLM をすべて省略
+    use_reserve, faq_pos = match_exact_faq(user_q, snapshot)
+    if faq_pos is not None:
+        payload = faq_direct_payload(session_id, user_q, user_q, snapshot.shortcut_for(use_reserve), faq_pos, "exact")
+        log_chat_history(user_q, payload["response"], "reserve_faq" if use_reserve else "faq", False)
+        return {"done": True, "payload": payload}
+
+    # === 元の質問の埋め込みで検索対象のコーパスを選び、同じ埋め込みでそのまま検索 ===
+    q_vector = query_embedding(user_q)
+    route = route_corpus(q_vector, user_q, snapshot)
+    use_reserve, D, I, kb = search_routed(q_vector, user_q, route, snapshot)
+    shortcut = snapshot.shortcut_for(use_reserve)
+    source_type = "reserve_faq" if use_reserve else "faq"
+
+    faq_pos = shortcut.match_search(D, I, kb.entries)
+    if faq_pos is not None:
+        payload = faq_direct_payload(session_id, user_q, user_q, shortcut, faq_pos, "vector")
+        log_chat_history(user_q, payload["response"], source_type, False)
+        return {"done": True, "payload": payload}
+
+    # === 選んだコーパスに合わせてリライトし、質問が変わった場合だけ埋め込み直して再検索 ===
+    if use_reserve:
+        expanded_q = expand_reserve_query(user_q, session_history)
+    else:
+        expanded_q = expand_query(user_q, session_history)
+
+    if expanded_q != user_q:
+        q_vector = query_embedding(expanded_q)
+        D, I, kb = search_knowledge_base(q_vector, expanded_q, use_reserve, snapshot)
+
+        faq_pos = shortcut.match_search(D, I, kb.entries)
+        if faq_pos is not None:
+            payload = faq_direct_payload(session_id, user_q, expanded_q, shortcut, faq_pos, "vector")
+            log_chat_history(user_q, payload["response"], source_type, False)
+            return {"done": True, "payload": payload}
+
+    film_info_text = film_info_for(user_q, session_history)
+    return prepare_completion(user_q, session_id, expanded_q, use_reserve, q_vector, I, snapshot, film_info_text)
+
+def prepare_completion(user_q, session_id, expanded_q, use_reserve, q_vector, I, snapshot, film_info_text):
+    with metrics.span("prompt"):
+        built = build_prompt(user_q, build_context(I, snapshot.kb_for(use_reserve)), film_info_text)
+    if built is None:
+        add_to_session_history(session_id, "assistant", OUT_OF_SCOPE_ANSWER)
+        return {"done": True, "payload": {
+            "response": OUT_OF_SCOPE_ANSWER,
+            "original_question": user_q,
+            "expanded_question": expanded_q
+        }}
+
+    turn = {
+        "done": False,
+        "user_q": user_q,
+        "session_id": session_id,
+        "expanded_q": expanded_q,
+        "use_reserve": use_reserve,
+        "q_vector": q_vector,
+        "context_ids": [int(i) for i in I[0]],
+        "artifact_version": snapshot.version,
+        "context_key": answer_context_key(snapshot.version, use_reserve, I, film_info_text, built["mode"]),
+        "messages": built["messages"],
+        "faq_part": built["faq_part"],
+        "prompt_tokens": built["prompt_tokens"],
+    }
+
+    # 同じコンテキストを検索した言い換え質問なら、保存済みの回答を返す
+    cached_answer = None
+    if q_vector is not None:
+        with metrics.span("semantic_cache"):
+            cached_answer = semantic_cache.lookup(q_vector, turn["context_key"])
+    if cached_answer is not None:
+        return {"done": True, "payload": finalize_answer(turn, cached_answer, "semantic_cache")}
+    return turn
+
+def finalize_answer(turn, answer, answer_path):
+    # 回答確定後の共通処理（履歴追加・未回答判定・ログ・回答キャッシュ保存）
+    user_q = turn["user_q"]
+    add_to_session_history(turn["session_id"], "assistant", answer)
+
+    # ✅ 回答ソース・未回答判定・ログ出力
+    is_unanswered = is_unanswered_answer(answer)
+    log_answer(user_q, answer, answer_source_type(turn["use_reserve"], turn["faq_part"]), is_unanswered)
+
+    if answer_path == "llm" and not is_unanswered and turn["q_vector"] is not None:
+        semantic_cache.store(turn["q_vector"], turn["context_key"], answer)
+
+    return {
+        "response": answer,
+        "original_question": user_q,
+        "expanded_question": turn["expanded_q"],
+        "answer_path": answer_path,
+        "prompt_tokens": turn["prompt_tokens"]
+    }
+
+def stream_meta(turn):
+    # ストリーミング開始時に返す検索メタデータ
+    return {
+        "original_question": turn["user_q"],
+        "expanded_question": turn["expanded_q"],
+        "answer_path": "llm",
+        "corpus": "reserve" if turn["use_reserve"] else "general",
+        "context_ids": turn["context_ids"],
+        "artifact_version": turn["artifact_version"],
+        "prompt_tokens": turn["prompt_tokens"],
+    }
+
+def answer_path(payload):
+    # 回答の経路（/metrics の path ラベル）
+    path = payload.get("answer_path")
+    if path == "faq_direct":
+        return f"faq_{payload['faq_match']}"
+    if path:
+        return path
+    return "greeting" if payload.get("response") == GREETING_REPLY else "out_of_scope"
+
+def observe_request(endpoint, started, path):
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, path=path)
+
+def observe_first_token(llm_started):
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - llm_started, stage="llm_first_token")
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_payload_events(payload):
+    # LLM を使わずに確定した回答も、ストリーミングと同じ形式で返す
+    meta = {k: v for k, v in payload.items() if k != "response"}
+    yield sse_event("meta", meta)
+    yield sse_event("token", {"text": payload["response"]})
+    yield sse_event("done", payload)
 
 @app.route("/chat", methods=["POST"])
 def chat():
+    started = time.perf_counter()
     try:
         data = request.get_json()
         user_q = data.get("question", "").strip()
@@ -227,150 +469,91 @@ def chat():
         if not user_q:
             return jsonify({"error": "質問がありません"}), 400
 
-        if any(greet in user_q for greet in GREETING_PATTERNS):
-            reply = "こんにちは！ご質問があればお気軽にどうぞ。"
-            add_to_session_history(session_id, "assistant", reply)
-            return jsonify({
-                "response": reply,
-                "original_question": user_q,
-                "expanded_question": user_q
-            })
-
-        add_to_session_history(session_id, "user", user_q)
-        session_history = get_session_history(session_id)
-
-        # === クエリの種類に応じてリライト関数を自動選択 + ベクトル検索対象を決定 ===
-        lower_q = user_q.lower()
-        if any(x in lower_q for x in ["予約", "ログイン", "マニュアル", "アカウント", "登録"]):
-            expanded_q = expand_reserve_query(user_q, session_history)
-            use_reserve = True
-        else:
-            expanded_q = expand_query(user_q, session_history)
-            use_reserve = False
-
-        q_vector = get_embedding(expanded_q)
-
-        if use_reserve:
-            D, I = reserve_index.search(np.array([q_vector]), k=7)
-            search_source_flags = reserve_source_flags
-            search_faq_questions = reserve_faq_questions
-            search_faq_answers = reserve_faq_answers
-            search_knowledge_contents = reserve_knowledge_contents
-        else:
-            D, I = index.search(np.array([q_vector]), k=7)
-            search_source_flags = source_flags
-            search_faq_questions = faq_questions
-            search_faq_answers = faq_answers
-            search_knowledge_contents = knowledge_contents
-
-        D, I = index.search(np.array([q_vector]), k=7)
-        if I.shape[1] == 0:
-            raise ValueError("検索結果が見つかりませんでした")
-
-        faq_context = []
-        reference_context = []
-
-        for idx in I[0]:
-            if idx >= len(search_source_flags):
-                continue
-            src = search_source_flags[idx]
-            if src == "faq":
-                q = search_faq_questions[idx]
-                a = search_faq_answers[idx]
-                faq_context.append(f"Q: {q}\nA: {a}")
-            elif src == "knowledge":
-                ref_idx = idx - len(search_faq_questions)
-                if ref_idx < len(search_knowledge_contents):
-                    reference_context.append(f"【参考知識】{search_knowledge_contents[ref_idx]}")
+        prepared = prepare_chat(user_q, session_id)
+        if prepared["done"]:
+            observe_request("/chat", started, answer_path(prepared["payload"]))
+            return jsonify(prepared["payload"])
 
-        film_match_data = pf_matcher.match(user_q, session_history)
-        film_info_text = pf_matcher.format_match_info(film_match_data)
-        if film_info_text:
-            reference_context.insert(0, film_info_text)
-
-        if metadata_note:
-            reference_context.append(f"【参考ファイル情報】{metadata_note}")
-
-        if not faq_context and not reference_context and not film_info_text.strip():
-            answer = (
-                "当社はコーヒー製品の委託加工を専門とする会社です。"
-                "恐れ入りますが、ご質問内容が当社業務と直接関連のある内容かどうかをご確認のうえ、"
-                "改めてお尋ねいただけますと幸いです。\n\n"
-                "ご不明な点がございましたら、当社の【お問い合わせフォーム】よりご連絡ください。"
+        with metrics.span("llm"):
+            completion = client.chat.completions.create(
+                model="gpt-4o",
+                messages=prepared["messages"],
+                temperature=0.2,
             )
-            add_to_session_history(session_id, "assistant", answer)
-            return jsonify({
-                "response": answer,
-                "original_question": user_q,
-                "expanded_question": expanded_q
-            })
-
-        faq_part = "\n\n".join(faq_context[:3]) if faq_context else "該当するFAQは見つかりませんでした。"
-        ref_texts = [text for text in reference_context if "製品フィルム・カラー情報" in text]
-        other_refs = [text for text in reference_context if "製品フィルム・カラー情報" not in text][:2]
-        ref_part = "\n".join(ref_texts + other_refs)
-
-        mode = infer_response_mode(user_q)
-
-        prompt = f"""以下は当社のFAQおよび参考情報です。これらを参考に、ユーザーの質問に製造元の立場でご回答ください。
-
-【FAQ】
-{faq_part}
-
-【参考情報】
-{ref_part}
-
-ユーザーの質問: {user_q}
-回答："""
-
-        system_prompt = base_prompt
-        if mode == "short":
-            system_prompt += "\n\n可能な限り簡潔かつ要点のみで回答してください。"
-        elif mode == "long":
-            system_prompt += "\n\n詳細な説明や具体例を含めて丁寧に回答してください。"
-
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
-        )
         answer = completion.choices[0].message.content.strip()
-
-        if "申し訳" in answer or "恐れ入りますが" in answer or "エラー" in answer:
-            sheet_service.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{UNANSWERED_SHEET}!A2:D",
-                valueInputOption="RAW",
-                body={"values": [[datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_q, "未回答", 1]]}
-            ).execute()
-
-        add_to_session_history(session_id, "assistant", answer)
-
-        # ✅ 回答ソース・未回答判定・ログ出力をここに追加
-        if use_reserve:
-            source_type = "reserve_faq" if "Q:" in faq_part else "reserve_knowledge"
-        else:
-            source_type = "faq" if "Q:" in faq_part else "knowledge"
-
-        is_unanswered = any(phrase in answer for phrase in ["申し訳", "恐れ入りますが", "エラー"])
-        log_chat_history(user_q, answer, source_type, is_unanswered)
-
-        return jsonify({
-            "response": answer,
-            "original_question": user_q,
-            "expanded_question": expanded_q
-        })
+        payload = finalize_answer(prepared, answer, "llm")
+        observe_request("/chat", started, "llm")
+        return jsonify(payload)
 
     except Exception as e:
+        observe_request("/chat", started, "error")
         print("[ERROR in /chat]:", e)
         return jsonify({
             "response": "エラーが発生しました。",
             "error": str(e)
         }), 500
 
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    # Server-Sent Events: meta → token（逐次）→ done の順に送る
+    data = request.get_json()
+    user_q = data.get("question", "").strip()
+    session_id = data.get("session_id", "default")
+
+    if not user_q:
+        return jsonify({"error": "質問がありません"}), 400
+
+    def generate():
+        started = time.perf_counter()
+        try:
+            prepared = prepare_chat(user_q, session_id)
+            if prepared["done"]:
+                observe_request("/chat/stream", started, answer_path(prepared["payload"]))
+                yield from sse_payload_events(prepared["payload"])
+                return
+
+            yield sse_event("meta", stream_meta(prepared))
+            llm_started = time.perf_counter()
+            chunks = []
+            with metrics.span("llm_stream"):
+                stream = client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=prepared["messages"],
+                    temperature=0.2,
+                    stream=True,
+                )
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if text:
+                        if not chunks:
+                            observe_first_token(llm_started)
+                        chunks.append(text)
+                        yield sse_event("token", {"text": text})
+
+            answer = "".join(chunks).strip()
+            payload = finalize_answer(prepared, answer, "llm")
+            observe_request("/chat/stream", started, "llm")
+            yield sse_event("done", payload)
+
+        except Exception as e:
+            observe_request("/chat/stream", started, "error")
+            print("[ERROR in /chat/stream]:", e)
+            yield sse_event("error", {"response": "エラーが発生しました。", "error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def append_feedback(question, answer, feedback_value, reason):
+    sheets_writer.append(
+        f"{FEEDBACK_SHEET}!A2:E",
+        [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), question, answer, feedback_value, reason]
+    )
+
 @app.route("/feedback", methods=["POST"])
 def feedback():
     data = request.get_json()
@@ -382,15 +565,111 @@ def feedback():
     if not all([question, answer, feedback_value]):
         return jsonify({"error": "不完全なフィードバックデータです"}), 400
 
-    sheet_service.values().append(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"{FEEDBACK_SHEET}!A2:E",
-        valueInputOption="RAW",
-        body={"values": [[datetime.now().strftime("%Y-%m-%d %H:%M:%S"), question, answer, feedback_value, reason]]}
-    ).execute()
+    append_feedback(question, answer, feedback_value, reason)
 
     return jsonify({"status": "success"})
 
+def collect_stats():
+    return {
+        "embedding_provider": embedding_provider.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "query_rewrite": {
+            "general": query_rewriter.stats(),
+            "reserve": reserve_query_rewriter.stats(),
+        },
+        "semantic_cache": semantic_cache.stats(),
+        "sheets_writer": sheets_writer.stats(),
+        "sessions": session_store.stats(),
+        "prompt": prompt_builder.stats(),
+        "artifacts": knowledge.stats(),
+        "router": knowledge.current.router.stats(),
+        "memory": memory_stats(knowledge.current.mapped_paths())
+    }
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(collect_stats())
+
+def metric_families():
+    # 各モジュールの統計を /metrics 用に読み替える（出力時にだけ呼ばれる）
+    embedding = embedding_cache.stats()
+    semantic = semantic_cache.stats()
+    rewrites = {"general": query_rewriter.stats(), "reserve": reserve_query_rewriter.stats()}
+    provider = embedding_provider.stats()
+    batcher = embedding_batcher.stats()
+    sheets = sheets_writer.stats()
+    artifacts = knowledge.stats()
+    sessions = session_store.stats()
+    session_families = [
+        ("chatbot_sessions_removed_total", "counter", "Sessions dropped by the session store by reason.", [
+            ({"reason": "expired"}, sessions["expired"]),
+            ({"reason": "evicted"}, sessions["evicted"]),
+        ]),
+        ("chatbot_session_store_errors_total", "counter", "Session store sweeps that failed.", sessions["errors"]),
+    ]
+    if sessions["entries"] is not None:
+        session_families.append(("chatbot_sessions", "gauge", "Sessions currently held by the session store.", sessions["entries"]))
+    return session_families + [
+        ("chatbot_cache_hits_total", "counter", "Cache hits by cache.", [
+            ({"cache": "embedding"}, embedding["hits"]),
+            ({"cache": "semantic"}, semantic["hits"]),
+            *[({"cache": f"rewrite_{name}"}, r["hits"]) for name, r in rewrites.items()],
+        ]),
+        ("chatbot_cache_misses_total", "counter", "Cache misses by cache.", [
+            ({"cache": "embedding"}, embedding["misses"]),
+            ({"cache": "semantic"}, semantic["misses"]),
+            *[({"cache": f"rewrite_{name}"}, r["llm_calls"]) for name, r in rewrites.items()],
+        ]),
+        ("chatbot_cache_entries", "gauge", "Entries currently held by each cache.", [
+            ({"cache": "embedding"}, embedding["entries"]),
+            ({"cache": "semantic"}, semantic["entries"]),
+            *[({"cache": f"rewrite_{name}"}, r["entries"]) for name, r in rewrites.items()],
+        ]),
+        ("chatbot_query_rewrite_total", "counter", "Query rewrite requests by corpus and outcome.", [
+            ({"corpus": name, "result": result}, r[key])
+            for name, r in rewrites.items()
+            for result, key in (("skipped", "skipped"), ("cache_hit", "hits"), ("llm", "llm_calls"), ("error", "errors"))
+        ]),
+        ("chatbot_embedding_api_requests_total", "counter", "Embedding API batches sent.", provider["requests"]),
+        ("chatbot_embedding_api_retries_total", "counter", "Embedding API retries.", provider["retries"]),
+        ("chatbot_embedding_api_errors_total", "counter", "Embedding API calls that failed after retries.", provider["errors"]),
+        ("chatbot_embedding_batches_total", "counter", "Micro-batches formed by the embedding batcher.", batcher["batches"]),
+        ("chatbot_sheets_rows_total", "counter", "Rows handed to the Sheets writer by outcome.", [
+            ({"result": "enqueued"}, sheets["enqueued"]),
+            ({"result": "written"}, sheets["written"]),
+            ({"result": "spooled"}, sheets["spooled"]),
+            ({"result": "replayed"}, sheets["replayed"]),
+            ({"result": "corrupt"}, sheets["corrupt"]),
+        ]),
+        ("chatbot_sheets_api_failures_total", "counter", "Failed Sheets append calls.", sheets["failures"]),
+        ("chatbot_sheets_queue_length", "gauge", "Rows waiting in the Sheets writer queue.", sheets["queued"]),
+        ("chatbot_knowledge_reloads_total", "counter", "Knowledge snapshot reloads by outcome.", [
+            ({"result": "ok"}, artifacts["reloads"]),
+            ({"result": "failed"}, artifacts["failures"]),
+        ]),
+    ]
+
+metrics.registry.register_collector(metric_families)
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# ✅ データの再読み込み（ADMIN_TOKEN 未設定なら無効）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def is_admin_request(headers):
+    return bool(ADMIN_TOKEN) and headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    if not is_admin_request(request.headers):
+        return jsonify({"error": "forbidden"}), 403
+    force = request.args.get("force", "").lower() == "true"
+    result = knowledge.reload(force=force)
+    return jsonify(result), 500 if result["status"] == "failed" else 200
+
 @app.route("/", methods=["GET"])
 def home():
     return "Chatbot API is running."
@@ -0,0 +1,136 @@
+# artifact_reloader.py
+# インデックス・FAQ などのデータ更新を、プロセスを再起動せずに取り込む（ホットリロード）
+# ・新しい世代はバックグラウンド（監視スレッド or 管理用エンドポイント）で読み込み・検証する
+# ・検証に通った世代だけを参照 1 つの差し替えで切り替える。処理中のリクエストは
+#   開始時に取得した世代を最後まで使い、新しいリクエストから新しい世代を使う
+# ・読み込みや検証に失敗した場合は、現在の世代のまま動き続ける
+import os
+import time
+import hashlib
+import threading
+
+RELOAD_WATCH_INTERVAL = float(os.getenv("RELOAD_WATCH_INTERVAL", "30"))
+
+
+def file_signature(paths):
+    # 変更検知用（mtime とサイズ）。存在しないファイルも「無い」状態として扱う
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+def artifact_version(paths):
+    # データの版（内容のハッシュ）。同じ内容なら再起動しても同じ値になる
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(path.encode("utf-8") + b"\x00")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+class ArtifactReloader:
+    def __init__(self, load, watch_paths, interval=None, on_swap=None):
+        # load() -> 新しい世代（.version を持つ）。検証に失敗したら例外を投げること
+        self.load = load
+        self.watch_paths = list(watch_paths)
+        self.interval = RELOAD_WATCH_INTERVAL if interval is None else interval
+        self.on_swap = on_swap
+
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._pid = None
+        self._signature = file_signature(self.watch_paths)
+        self._current = load()
+
+    @property
+    def version(self):
+        return self._current.version
+
+    @property
+    def current(self):
+        # 監視スレッドを起動せずに現在の世代を返す（import 時の初期化用。
+        # gunicorn の preload では master で監視スレッドを起動しない）
+        return self._current
+
+    def snapshot(self):
+        # リクエストの最初に 1 回だけ呼び、その世代を最後まで使う
+        self._ensure_watcher()
+        return self._current
+
+    def _ensure_watcher(self):
+        # gunicorn の fork 後はプロセスごとに監視スレッドを起動する
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._watch, name="artifact-reloader", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _watch(self):
+        pending = None
+        while True:
+            time.sleep(self.interval)
+            signature = file_signature(self.watch_paths)
+            if signature == self._signature:
+                pending = None
+                continue
+            # 更新スクリプトの書き込み途中を読まないよう、1 周期変化がなくなってから読み込む
+            if signature != pending:
+                pending = signature
+                continue
+            pending = None
+            self.reload()
+
+    def reload(self, force=False):
+        """新しい世代を読み込んで差し替える。結果を dict で返す。"""
+        with self._reload_lock:
+            signature = file_signature(self.watch_paths)
+            previous = self._current
+            if not force and signature == self._signature:
+                return {"status": "unchanged", "version": previous.version}
+            started = time.time()
+            try:
+                new = self.load()
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                    self.last_error = str(e)
+                print("❌ データの再読み込みに失敗したため、現在の版のまま継続します:", e)
+                return {"status": "failed", "version": previous.version, "error": str(e)}
+
+            self._signature = signature
+            if new.version == previous.version:
+                return {"status": "unchanged", "version": previous.version}
+
+            self._current = new
+            with self._lock:
+                self.reloads += 1
+                self.last_error = None
+            if self.on_swap:
+                self.on_swap(new)
+            print(f"🔄 データを再読み込みしました: {previous.version} → {new.version}（{time.time() - started:.2f} 秒）")
+            return {"status": "reloaded", "version": new.version, "previous_version": previous.version}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self._current.version,
+                "loaded_at": self._current.loaded_at,
+                "watch_interval": self.interval,
+                "reloads": self.reloads,
+                "failures": self.failures,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,235 @@
+# asgi_app.py
+# /chat の非同期版（ASGI）。データ・キャッシュ・各ステージは app.py のものを共用する
+# 起動例: uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+#
+# ・OpenAI 呼び出しは AsyncOpenAI / 埋め込みバッチャーの Future を await し、ワーカースレッドを占有しない
+# ・フィルム照合は元の質問の埋め込み・検索と同時に始め、リライト（LLM）と一緒に待つ
+# ・会話履歴の読み書き（sqlite / redis）と CPU を使う検索・照合は asyncio.to_thread で行う
+# ・Google Sheets への記録は app.sheets_writer がバックグラウンドでまとめて行う
+# ・/chat/stream は回答を Server-Sent Events で逐次返す
+import os
+import time
+import asyncio
+
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import app as core
+import metrics
+from query_expander import aexpand_query
+from expand_reserve_query import aexpand_reserve_query
+
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+async def araw_search(user_q, snapshot):
+    # 元の質問の埋め込みでコーパスを選び、同じ埋め込みでそのまま検索する（検索はイベントループの外で）
+    raw_vector = await core.aquery_embedding(user_q)
+    route = core.route_corpus(raw_vector, user_q, snapshot)
+    result = await asyncio.to_thread(core.search_routed, raw_vector, user_q, route, snapshot)
+    return (raw_vector, *result)
+
+
+async def aprepare_chat(user_q, session_id):
+    # app.prepare_chat の非同期版（戻り値の形式は同じ）
+    # 会話履歴（sqlite / redis）の読み書きと、CPU を使う照合・検索はスレッドで行い、イベントループを塞がない
+    if any(greet in user_q for greet in core.GREETING_PATTERNS):
+        await asyncio.to_thread(core.add_to_session_history, session_id, "assistant", core.GREETING_REPLY)
+        return {"done": True, "payload": {
+            "response": core.GREETING_REPLY,
+            "original_question": user_q,
+            "expanded_question": user_q
+        }}
+
+    await asyncio.to_thread(core.add_to_session_history, session_id, "user", user_q)
+    session_history = await asyncio.to_thread(core.get_session_history, session_id)
+
+    snapshot = core.knowledge.snapshot()
+
+    use_reserve, faq_pos = core.match_exact_faq(user_q, snapshot)
+    if faq_pos is not None:
+        payload = await asyncio.to_thread(
+            core.faq_direct_payload, session_id, user_q, user_q, snapshot.shortcut_for(use_reserve), faq_pos, "exact"
+        )
+        core.log_chat_history(user_q, payload["response"], "reserve_faq" if use_reserve else "faq", False)
+        return {"done": True, "payload": payload}
+
+    # フィルム照合は検索結果に依存しないので、元の質問の埋め込み・検索と同時に始める
+    film_task = asyncio.create_task(asyncio.to_thread(core.film_info_for, user_q, session_history))
+    search_task = asyncio.create_task(araw_search(user_q, snapshot))
+    try:
+        raw_vector, use_reserve, raw_D, raw_I, raw_kb = await search_task
+    except BaseException:
+        film_task.cancel()
+        raise
+    shortcut = snapshot.shortcut_for(use_reserve)
+    source_type = "reserve_faq" if use_reserve else "faq"
+    faq_pos = shortcut.match_search(raw_D, raw_I, raw_kb.entries)
+    if faq_pos is not None:
+        # 元の質問だけで FAQ と十分一致したので、リライトは行わない（フィルム照合の結果は使わない）
+        film_task.cancel()
+        payload = await asyncio.to_thread(core.faq_direct_payload, session_id, user_q, user_q, shortcut, faq_pos, "vector")
+        core.log_chat_history(user_q, payload["response"], source_type, False)
+        return {"done": True, "payload": payload}
+
+    # 選んだコーパスに合わせたリライトと、まだ終わっていなければフィルム照合を一緒に待つ
+    expand = aexpand_reserve_query if use_reserve else aexpand_query
+    expanded_q, film_info_text = await asyncio.gather(expand(user_q, list(session_history)), film_task)
+    if expanded_q == user_q:
+        q_vector, I = raw_vector, raw_I
+    else:
+        q_vector = await core.aquery_embedding(expanded_q)
+        D, I, kb = await asyncio.to_thread(core.search_knowledge_base, q_vector, expanded_q, use_reserve, snapshot)
+        faq_pos = shortcut.match_search(D, I, kb.entries)
+        if faq_pos is not None:
+            payload = await asyncio.to_thread(core.faq_direct_payload, session_id, user_q, expanded_q, shortcut, faq_pos, "vector")
+            core.log_chat_history(user_q, payload["response"], source_type, False)
+            return {"done": True, "payload": payload}
+
+    return await asyncio.to_thread(
+        core.prepare_completion, user_q, session_id, expanded_q, use_reserve, q_vector, I, snapshot, film_info_text
+    )
+
+
+async def read_question(request):
+    data = await request.json()
+    return data.get("question", "").strip(), data.get("session_id", "default")
+
+
+async def chat(request):
+    started = time.perf_counter()
+    try:
+        user_q, session_id = await read_question(request)
+        if not user_q:
+            return JSONResponse({"error": "質問がありません"}, status_code=400)
+
+        prepared = await aprepare_chat(user_q, session_id)
+        if prepared["done"]:
+            core.observe_request("/chat", started, core.answer_path(prepared["payload"]))
+            return JSONResponse(prepared["payload"])
+
+        with metrics.span("llm"):
+            completion = await async_client.chat.completions.create(
+                model="gpt-4o",
+                messages=prepared["messages"],
+                temperature=0.2,
+            )
+        answer = completion.choices[0].message.content.strip()
+        payload = await asyncio.to_thread(core.finalize_answer, prepared, answer, "llm")
+        core.observe_request("/chat", started, "llm")
+        return JSONResponse(payload)
+
+    except Exception as e:
+        core.observe_request("/chat", started, "error")
+        print("[ERROR in /chat (async)]:", e)
+        return JSONResponse({
+            "response": "エラーが発生しました。",
+            "error": str(e)
+        }, status_code=500)
+
+
+async def chat_stream(request):
+    # Server-Sent Events: meta → token（逐次）→ done の順に送る
+    user_q, session_id = await read_question(request)
+    if not user_q:
+        return JSONResponse({"error": "質問がありません"}, status_code=400)
+
+    async def generate():
+        started = time.perf_counter()
+        try:
+            prepared = await aprepare_chat(user_q, session_id)
+            if prepared["done"]:
+                core.observe_request("/chat/stream", started, core.answer_path(prepared["payload"]))
+                for event in core.sse_payload_events(prepared["payload"]):
+                    yield event
+                return
+
+            yield core.sse_event("meta", core.stream_meta(prepared))
+            llm_started = time.perf_counter()
+            chunks = []
+            with metrics.span("llm_stream"):
+                stream = await async_client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=prepared["messages"],
+                    temperature=0.2,
+                    stream=True,
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if text:
+                        if not chunks:
+                            core.observe_first_token(llm_started)
+                        chunks.append(text)
+                        yield core.sse_event("token", {"text": text})
+
+            answer = "".join(chunks).strip()
+            payload = await asyncio.to_thread(core.finalize_answer, prepared, answer, "llm")
+            core.observe_request("/chat/stream", started, "llm")
+            yield core.sse_event("done", payload)
+
+        except Exception as e:
+            core.observe_request("/chat/stream", started, "error")
+            print("[ERROR in /chat/stream (async)]:", e)
+            yield core.sse_event("error", {"response": "エラーが発生しました。", "error": str(e)})
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def feedback(request):
+    data = await request.json()
+    question = data.get("question")
+    answer = data.get("answer")
+    feedback_value = data.get("feedback")
+    reason = data.get("reason", "")
+
+    if not all([question, answer, feedback_value]):
+        return JSONResponse({"error": "不完全なフィードバックデータです"}, status_code=400)
+
+    core.append_feedback(question, answer, feedback_value, reason)
+
+    return JSONResponse({"status": "success"})
+
+
+async def stats(request):
+    return JSONResponse(core.collect_stats())
+
+
+async def prometheus_metrics(request):
+    return PlainTextResponse(metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def admin_reload(request):
+    if not core.is_admin_request(request.headers):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    force = request.query_params.get("force", "").lower() == "true"
+    # 読み込み・検証は重いので、イベントループの外で行う
+    result = await asyncio.to_thread(core.knowledge.reload, force)
+    return JSONResponse(result, status_code=500 if result["status"] == "failed" else 200)
+
+
+async def home(request):
+    return PlainTextResponse("Chatbot API is running.")
+
+
+app = Starlette(
+    routes=[
+        Route("/chat", chat, methods=["POST"]),
+        Route("/chat/stream", chat_stream, methods=["POST"]),
+        Route("/feedback", feedback, methods=["POST"]),
+        Route("/stats", stats, methods=["GET"]),
+        Route("/metrics", prometheus_metrics, methods=["GET"]),
+        Route("/admin/reload", admin_reload, methods=["POST"]),
+        Route("/", home, methods=["GET"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+)
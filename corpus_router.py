@@ -0,0 +1,78 @@
+# corpus_router.py
+# 質問の埋め込みで、通常用・予約用のどちらのコーパスを検索するかを決める（キーワードによる振り分けの置き換え）
+# ・各コーパスにしかない行のベクトルをプロトタイプにする。もう一方と同じ文書（両方にあるナレッジ）と、
+#   もう一方と同じキーの行（両方の FAQ にある質問。埋め込むテキストは違っても振り分けの手がかりにならない）は除く
+# ・今のデータでは FAQ が通常用・予約用で同じなので、プロトタイプはナレッジだけになり件数に差がある（通常用が多い）。
+#   距離は近い上位 ROUTER_TOP_K 件の平均なので、件数の差そのものはスコアを偏らせない
+# ・質問に近いプロトタイプ上位 ROUTER_TOP_K 件の平均距離が小さい方へ振り分ける
+# ・差が ROUTER_MARGIN 未満なら判断せず、両方を検索する（"both"）
+# 検索に使う埋め込みをそのまま使うので、振り分けのための API 呼び出しは発生しない
+import os
+import threading
+
+import numpy as np
+
+ROUTER_TOP_K = int(os.getenv("ROUTER_TOP_K", "3"))
+# 二乗 L2 距離の差（正規化済みベクトル）
+ROUTER_MARGIN = float(os.getenv("ROUTER_MARGIN", "0.05"))
+ROUTES = ("general", "reserve", "both")
+
+
+def own_positions(kb, other):
+    # kb にしかない行の位置（other の名前空間と同じ文書 ID の行・同じキーの行を除く）
+    other_keys = {e["key"] for e in other.entries}
+    shared = {pos for doc_id, pos in kb.position_map.items() if doc_id in other.position_map}
+    return [pos for pos, e in enumerate(kb.entries) if pos not in shared and e["key"] not in other_keys]
+
+
+class CorpusRouter:
+    def __init__(self, prototypes, margin=None, top_k=None):
+        # prototypes: {"general": np.ndarray, "reserve": np.ndarray}（行 = プロトタイプのベクトル）
+        self.prototypes = {name: np.asarray(v, dtype="float32") for name, v in prototypes.items()}
+        self.margin = ROUTER_MARGIN if margin is None else margin
+        self.top_k = top_k or ROUTER_TOP_K
+        self._sq_norms = {name: np.einsum("ij,ij->i", v, v) for name, v in self.prototypes.items()}
+
+        self._lock = threading.Lock()
+        self.counts = {route: 0 for route in ROUTES}
+
+    @classmethod
+    def from_knowledge(cls, general, reserve, **kwargs):
+        return cls({
+            "general": general.entry_vectors(own_positions(general, reserve)),
+            "reserve": reserve.entry_vectors(own_positions(reserve, general)),
+        }, **kwargs)
+
+    def scores(self, q_vector):
+        # コーパスごとの「近いプロトタイプ上位 top_k 件の平均距離」（プロトタイプが無いコーパスは inf）
+        q = np.asarray(q_vector, dtype="float32").reshape(-1)
+        scores = {}
+        for name, vectors in self.prototypes.items():
+            if len(vectors) == 0:
+                scores[name] = float("inf")
+                continue
+            dist = self._sq_norms[name] - 2.0 * (vectors @ q) + float(q @ q)
+            k = min(self.top_k, len(dist))
+            scores[name] = float(np.partition(dist, k - 1)[:k].mean())
+        return scores
+
+    def route(self, q_vector):
+        """("general" | "reserve" | "both", scores) を返す。"""
+        scores = self.scores(q_vector)
+        general, reserve = scores["general"], scores["reserve"]
+        if abs(general - reserve) < self.margin or general == reserve:
+            route = "both"
+        else:
+            route = "reserve" if reserve < general else "general"
+        with self._lock:
+            self.counts[route] += 1
+        return route, scores
+
+    def stats(self):
+        with self._lock:
+            return {
+                "margin": self.margin,
+                "top_k": self.top_k,
+                "prototypes": {name: len(v) for name, v in self.prototypes.items()},
+                "routes": dict(self.counts),
+            }
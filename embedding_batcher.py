@@ -0,0 +1,99 @@
+# embedding_batcher.py
+# 同時に届いた複数リクエストの埋め込みを 1 回の API 呼び出しにまとめる（マイクロバッチ）
+# 最初のリクエストから max_wait_ms 待つか、max_batch_size 件集まった時点で送信する
+import os
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+EMBED_BATCH_CONCURRENCY = int(os.getenv("EMBED_BATCH_CONCURRENCY", "4"))
+
+
+class EmbeddingBatcher:
+    def __init__(self, embed_batch, max_batch_size=None, max_wait_ms=None, concurrency=None):
+        # embed_batch(list[str]) -> list[vector]（入力と同じ順序で返すこと）
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size or EMBED_BATCH_SIZE
+        self.max_wait = (EMBED_BATCH_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000
+        self.concurrency = concurrency or EMBED_BATCH_CONCURRENCY
+
+        self._lock = threading.Lock()
+        self._histogram = {}
+        self._requests = 0
+        self._errors = 0
+        self._pid = None
+        self._queue = None
+        self._pool = None
+
+    def _ensure_worker(self):
+        # gunicorn の fork 後に親プロセスのスレッドは引き継がれないため、プロセスごとに起動する
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed-batch")
+            threading.Thread(target=self._collect, args=(self._queue,), name="embed-batcher", daemon=True).start()
+            self._pid = os.getpid()
+
+    def embed(self, text, timeout=None):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result(timeout=timeout)
+
+    async def aembed(self, text):
+        # イベントループのスレッドを塞がずに待つ（非同期版 /chat 用）
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return await asyncio.wrap_future(future)
+
+    def _collect(self, q):
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(q.get(timeout=remaining) if remaining > 0 else q.get_nowait())
+                except queue.Empty:
+                    break
+            self._pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        # 同じテキストは 1 回だけ送る
+        unique = list(dict.fromkeys(text for text, _ in batch))
+        with self._lock:
+            self._histogram[len(unique)] = self._histogram.get(len(unique), 0) + 1
+            self._requests += len(batch)
+        try:
+            vectors = dict(zip(unique, self.embed_batch(unique)))
+        except Exception as e:
+            with self._lock:
+                self._errors += 1
+            for _, future in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            if future.set_running_or_notify_cancel():
+                future.set_result(vectors[text])
+
+    def stats(self):
+        with self._lock:
+            batches = sum(self._histogram.values())
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "requests": self._requests,
+                "batches": batches,
+                "errors": self._errors,
+                "mean_batch_size": round(self._requests / batches, 2) if batches else 0.0,
+                "histogram": dict(sorted(self._histogram.items())),
+            }
@@ -0,0 +1,313 @@
+# embedding_cache.py
+# 埋め込みベクトルの永続キャッシュ
+# キー = (モデル名, 次元数, 正規化テキストの sha256)
+# ベクトル本体は memmap（float32 の生ファイル）、キー→スロットの対応は index.json に保存する
+# ・スロットごとに、入っているキー（sha256 の 32 バイト）を keys.bin に書く。読むときに照合するので、
+#   他プロセスがスロットを別のキーに使い回しても、古い index.json のまま別の埋め込みを返すことはない
+import os
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなしで動作
+    fcntl = None
+
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", ".cache/embeddings")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "10000"))
+DEFAULT_DIMENSIONS = 1536
+MIN_CAPACITY = 256
+EVICT_RATIO = 0.1
+KEY_BYTES = 32
+
+
+def normalize_text(text):
+    # 全角・半角の揺れと空白の違いを吸収
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def text_key(model, dimensions, text):
+    raw = f"{model}\x00{dimensions}\x00{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, model, dimensions=DEFAULT_DIMENSIONS, cache_dir=None, max_entries=None):
+        self.model = model
+        self.dimensions = dimensions
+        self.max_entries = max_entries or EMBED_CACHE_MAX_ENTRIES
+        self.dir = os.path.join(cache_dir or EMBED_CACHE_DIR, f"{model}-{dimensions}")
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.vector_path = os.path.join(self.dir, "vectors.f32")
+        self.key_path = os.path.join(self.dir, "keys.bin")
+        self.lock_path = os.path.join(self.dir, "lock")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+        self._entries = {}  # key -> [slot, last_used]
+        self._free = []
+        self._capacity = 0
+        self._vectors = None
+        self._keys = None  # スロットごとのキー（書き込み中は 0）
+        self._index_mtime = None
+
+        os.makedirs(self.dir, exist_ok=True)
+        with self._lock:
+            self._load()
+
+    # === 読み込み・保存 ===
+    def _load(self):
+        entries = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("model") == self.model and data.get("dimensions") == self.dimensions:
+                    entries = data.get("entries", {})
+                self._index_mtime = os.stat(self.index_path).st_mtime_ns
+            except (OSError, ValueError) as e:
+                print("⚠️ 埋め込みキャッシュの読み込みに失敗しました:", e)
+
+        # 自プロセスで更新した last_used は保持する
+        for key, (slot, last_used) in entries.items():
+            current = self._entries.get(key)
+            if current and current[0] == slot:
+                entries[key] = [slot, max(last_used, current[1])]
+        self._entries = entries
+        self._open_vectors()
+
+        used = {slot for slot, _ in self._entries.values() if slot < self._capacity}
+        self._entries = {k: v for k, v in self._entries.items() if v[0] < self._capacity}
+        self._free = sorted(set(range(self._capacity)) - used, reverse=True)
+
+    def _open_vectors(self):
+        row_bytes = self.dimensions * 4
+        size = os.path.getsize(self.vector_path) if os.path.exists(self.vector_path) else 0
+        capacity = size // row_bytes
+        key_rows = os.path.getsize(self.key_path) // KEY_BYTES if os.path.exists(self.key_path) else 0
+        key_rows = min(key_rows, capacity)
+        if capacity == self._capacity and self._vectors is not None and key_rows == self._key_rows():
+            return
+        self._capacity = capacity
+        self._vectors = None
+        self._keys = None
+        if capacity:
+            self._vectors = np.memmap(
+                self.vector_path, dtype="float32", mode="r+", shape=(capacity, self.dimensions)
+            )
+        if key_rows:
+            # keys.bin の無い古いキャッシュは、キーを書き直すまで該当スロットを未登録として扱う
+            self._keys = np.memmap(self.key_path, dtype="uint8", mode="r+", shape=(key_rows, KEY_BYTES))
+
+    def _key_rows(self):
+        return 0 if self._keys is None else self._keys.shape[0]
+
+    def _extend_keys(self):
+        # keys.bin をスロット数まで伸ばす（ファイルロック中だけ呼ぶ。縮めることはしない）
+        needed = self._capacity * KEY_BYTES
+        size = os.path.getsize(self.key_path) if os.path.exists(self.key_path) else 0
+        if size < needed:
+            with open(self.key_path, "ab") as f:
+                f.truncate(needed)
+        self._open_vectors()
+
+    def _grow(self, needed):
+        new_capacity = max(MIN_CAPACITY, self._capacity * 2)
+        while new_capacity - self._capacity < needed:
+            new_capacity *= 2
+        new_capacity = min(new_capacity, self.max_entries)
+        if new_capacity <= self._capacity:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+        with open(self.vector_path, "ab") as f:
+            f.truncate(new_capacity * self.dimensions * 4)
+        old_capacity = self._capacity
+        self._open_vectors()
+        self._extend_keys()
+        self._free = sorted(set(self._free) | set(range(old_capacity, self._capacity)), reverse=True)
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"model": self.model, "dimensions": self.dimensions, "entries": self._entries},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def _refresh(self):
+        # 他プロセス（別の gunicorn worker やビルドスクリプト）が書き込んだ分を取り込む
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._index_mtime:
+            self._load()
+
+    def _file_lock(self):
+        return _FileLock(self.lock_path)
+
+    # === 退避（LRU） ===
+    def _evict(self, needed):
+        overflow = len(self._entries) + needed - self.max_entries
+        if overflow <= 0:
+            return
+        count = max(overflow, int(self.max_entries * EVICT_RATIO))
+        oldest = sorted(self._entries.items(), key=lambda kv: kv[1][1])[:count]
+        for key, (slot, _) in oldest:
+            del self._entries[key]
+            self._free.append(slot)
+        self.evictions += len(oldest)
+
+    # === 公開 API ===
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def _read_slot(self, key):
+        # スロットのキーが一致するときだけベクトルを返す（コピーの前後で照合し、書き込み中の行は使わない）
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        slot = entry[0]
+        if slot >= self._key_rows():
+            return None
+        expected = bytes.fromhex(key)
+        if self._keys[slot].tobytes() != expected:
+            return None
+        vector = np.array(self._vectors[slot], dtype="float32")
+        if self._keys[slot].tobytes() != expected:
+            return None
+        return vector
+
+    def get_many(self, texts):
+        keys = [text_key(self.model, self.dimensions, t) for t in texts]
+        with self._lock:
+            self._refresh()
+            now = time.time()
+            results = []
+            for key in keys:
+                vector = self._read_slot(key)
+                if vector is None and key in self._entries:
+                    # 他プロセスがスロットを使い回した可能性がある。index.json を読み直して照合し直し、
+                    # それでも一致しなければ（書き込み中・キーを書く前の古いキャッシュ）未登録として扱う
+                    self._index_mtime = None
+                    self._refresh()
+                    vector = self._read_slot(key)
+                if vector is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                self._entries[key][1] = now
+                results.append(vector)
+            return results
+
+    def put(self, text, vector):
+        self.put_many([text], [vector])
+
+    def put_many(self, texts, vectors):
+        items = {}
+        for text, vector in zip(texts, vectors):
+            vector = np.asarray(vector, dtype="float32").reshape(-1)
+            if vector.shape[0] != self.dimensions:
+                raise ValueError(f"埋め込みの次元数が一致しません: {vector.shape[0]} != {self.dimensions}")
+            items[text_key(self.model, self.dimensions, text)] = vector
+        if not items:
+            return
+
+        try:
+            with self._lock, self._file_lock():
+                self._refresh()
+                if self._key_rows() < self._capacity:
+                    self._extend_keys()
+                new_keys = [k for k in items if k not in self._entries]
+                self._evict(len(new_keys))
+                if len(self._free) < len(new_keys):
+                    self._grow(len(new_keys) - len(self._free))
+                now = time.time()
+                for key, vector in items.items():
+                    if key in self._entries:
+                        slot = self._entries[key][0]
+                    elif self._free:
+                        slot = self._free.pop()
+                    else:
+                        continue  # max_entries を超える分は保存しない
+                    # キーを消してからベクトルを書き、最後にキーを書く（読む側は前後のキーで照合する）
+                    self._keys[slot] = 0
+                    self._vectors[slot] = vector
+                    self._keys[slot] = np.frombuffer(bytes.fromhex(key), dtype="uint8")
+                    self._entries[key] = [slot, now]
+                self._vectors.flush()
+                self._keys.flush()
+                self._save()
+        except OSError as e:
+            print("⚠️ 埋め込みキャッシュの保存に失敗しました:", e)
+
+    def embed(self, texts, embed_batch, batch_size=100):
+        # キャッシュにないテキストだけを embed_batch(list[str]) -> list[vector] で埋め込む
+        vectors = self.get_many(texts)
+        pending = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                pending.setdefault(text_key(self.model, self.dimensions, texts[i]), []).append(i)
+
+        groups = list(pending.values())
+        for start in range(0, len(groups), batch_size):
+            chunk = groups[start:start + batch_size]
+            batch_texts = [texts[g[0]] for g in chunk]
+            batch_vectors = embed_batch(batch_texts)
+            self.put_many(batch_texts, batch_vectors)
+            for g, vector in zip(chunk, batch_vectors):
+                for i in g:
+                    vectors[i] = np.asarray(vector, dtype="float32")
+
+        if texts:
+            print(f"🧮 埋め込みキャッシュ: {len(texts) - sum(map(len, groups))} 件ヒット / {len(groups)} 件を新規生成")
+        return np.array(vectors, dtype="float32")
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "model": self.model,
+                "dimensions": self.dimensions,
+                "entries": len(self._entries),
+                "capacity": self._capacity,
+                "max_entries": self.max_entries,
+                "bytes": self._capacity * self.dimensions * 4,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._fh = open(self.path, "a")
+            fcntl.flock(self._fh, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._fh is not None:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+            self._fh.close()
+            self._fh = None
+        return False
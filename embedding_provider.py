@@ -0,0 +1,175 @@
+# embedding_provider.py
+# 埋め込みの取得先（設定で切り替え）
+#   openai : OpenAI の埋め込み API（既定は text-embedding-3-small）。バッチ分割・タイムアウト・リトライ付き
+#   local  : 文字 n-gram のハッシュ射影（ネットワーク不要・決定的）。オフラインの負荷試験・ベンチマーク用
+#
+# 種類の違う埋め込み同士は距離を比較できないため、インデックスは質問と同じ provider で作ること。
+# 使った provider はマニフェストに記録し、アプリの読み込み時に照合する。
+import os
+import time
+import hashlib
+import threading
+from collections import Counter
+
+import numpy as np
+
+from lexical_index import char_ngrams
+
+EMBED_PROVIDER = os.getenv("EMBED_PROVIDER", "openai")
+PROVIDERS = ("openai", "local")
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "1536"))
+OPENAI_DEFAULT_DIMENSIONS = 1536
+# 1 回の API 呼び出しに載せる最大件数
+EMBED_API_BATCH_SIZE = int(os.getenv("EMBED_API_BATCH_SIZE", "100"))
+# API 呼び出し 1 回あたりのタイムアウト（秒）と、一時的なエラーのリトライ回数
+EMBED_REQUEST_TIMEOUT = float(os.getenv("EMBED_REQUEST_TIMEOUT", "20"))
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", "3"))
+EMBED_RETRY_DELAY = float(os.getenv("EMBED_RETRY_DELAY", "1"))
+
+LOCAL_MODEL = "local-ngram-hash"
+
+
+class EmbeddingProvider:
+    # embed(list[str]) -> np.ndarray(float32, (件数, dimensions))。入力と同じ順序で返す
+    name = None
+
+    def __init__(self, model, dimensions, batch_size=None):
+        self.model = model
+        self.dimensions = dimensions
+        self.batch_size = batch_size or EMBED_API_BATCH_SIZE
+        self.requests = 0
+        self.texts = 0
+        self.retries = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def info(self):
+        # マニフェストに記録し、インデックスと質問の埋め込みが同じ種類かを照合する
+        return {"provider": self.name, "model": self.model, "dimensions": self.dimensions}
+
+    def embed(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dimensions), dtype="float32")
+        if any(not t or not t.strip() for t in texts):
+            raise ValueError("空のテキストには埋め込みを生成できません")
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed_with_retry(texts[start:start + self.batch_size]))
+        return np.array(vectors, dtype="float32")
+
+    def _embed_with_retry(self, batch):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                vectors = self.embed_batch(batch)
+                with self._lock:
+                    self.requests += 1
+                    self.texts += len(batch)
+                    self.seconds += time.monotonic() - started
+                return vectors
+            except Exception as e:
+                if attempt >= EMBED_RETRIES or not self.is_retryable(e):
+                    with self._lock:
+                        self.errors += 1
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                delay = EMBED_RETRY_DELAY * 2 ** (attempt - 1)
+                print(f"⚠️ 埋め込み API エラーのため {delay:.1f} 秒後に再試行します（{attempt}/{EMBED_RETRIES}）: {e}")
+                time.sleep(delay)
+
+    def embed_batch(self, batch):
+        raise NotImplementedError
+
+    def is_retryable(self, error):
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.info(),
+                "requests": self.requests,
+                "texts": self.texts,
+                "retries": self.retries,
+                "errors": self.errors,
+                "mean_latency_ms": round(self.seconds / self.requests * 1000, 2) if self.requests else 0.0,
+            }
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, model=None, dimensions=None, batch_size=None, timeout=None, client=None):
+        super().__init__(model or EMBED_MODEL, dimensions or EMBED_DIMENSIONS, batch_size)
+        self.timeout = EMBED_REQUEST_TIMEOUT if timeout is None else timeout
+        self._client = client
+
+    @property
+    def client(self):
+        # local だけで動かすときに OPENAI_API_KEY を要求しないよう、最初の呼び出しで作る
+        if self._client is None:
+            import openai
+            # リトライはこちらで行う（SDK 側のリトライと重ねない）
+            self._client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=self.timeout, max_retries=0)
+        return self._client
+
+    def embed_batch(self, batch):
+        kwargs = {}
+        if self.dimensions != OPENAI_DEFAULT_DIMENSIONS:
+            kwargs["dimensions"] = self.dimensions
+        response = self.client.embeddings.create(model=self.model, input=batch, **kwargs)
+        if len(response.data) != len(batch) or not all(d.embedding for d in response.data):
+            raise ValueError("埋め込みデータが空です")
+        return [np.array(d.embedding, dtype="float32") for d in sorted(response.data, key=lambda d: d.index)]
+
+    def is_retryable(self, error):
+        import openai
+        return isinstance(error, (
+            openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError,
+        ))
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    # 文字 n-gram を次元にハッシュし（符号もハッシュで決める）、L2 正規化したベクトル
+    # 表記の近い文ほど距離が近くなる。意味の近さは OpenAI の埋め込みほど捉えられない
+    name = "local"
+
+    def __init__(self, dimensions=None, batch_size=None):
+        super().__init__(LOCAL_MODEL, dimensions or EMBED_DIMENSIONS, batch_size)
+        self._buckets = {}
+
+    def _bucket(self, gram):
+        bucket = self._buckets.get(gram)
+        if bucket is None:
+            # Python の hash() はプロセスごとに変わるため、決定的なハッシュを使う
+            h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+            bucket = (h % self.dimensions, 1.0 if (h >> 63) & 1 else -1.0)
+            if len(self._buckets) < 1_000_000:
+                self._buckets[gram] = bucket
+        return bucket
+
+    def embed_batch(self, batch):
+        vectors = []
+        for text in batch:
+            vector = np.zeros(self.dimensions, dtype="float32")
+            for gram, tf in Counter(char_ngrams(text)).items():
+                dim, sign = self._bucket(gram)
+                vector[dim] += sign * (1.0 + np.log(tf))
+            norm = np.linalg.norm(vector)
+            vectors.append(vector / norm if norm else vector)
+        return vectors
+
+
+def get_provider(name=None):
+    name = name or EMBED_PROVIDER
+    if name == "openai":
+        return OpenAIEmbeddingProvider()
+    if name == "local":
+        return LocalEmbeddingProvider()
+    raise ValueError(f"未対応の埋め込みプロバイダーです: {name}（{', '.join(PROVIDERS)}）")
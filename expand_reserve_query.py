@@ -1,30 +1,36 @@
 import openai
 import os
+from query_rewrite import QueryRewriter
 
 # 環境変数からAPIキーを読み込み（app.pyで設定済みであればスキップ可）
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def expand_reserve_query(user_input, session_history):
-    try:
-        if not user_input:
-            return ""
-
-        # 直近4件の履歴を取得
-        context = session_history[-4:] if session_history else []
-        context_text = "\n".join([f"{m['role']}: {m['content']}" for m in context])
-
-        prompt = [
-            {
-                "role": "system",
-                "content": (
-                    "あなたは、予約システムに関するあいまいな質問を、FAQ検索に適した明確な文章に書き換えるアシスタントです。"
-                    "意味を変えず、キーワードを補い、予約画面・機能名・操作手順が明確になるようにしてください。"
-                    "言い換えた文章は、1文の日本語文で出力してください。"
-                )
-            },
-            {
-                "role": "user",
-                "content": f"""以下は最近のやり取りです：
+_async_client = None
+
+def _get_async_client():
+    # 非同期版（asgi_app.py）用のクライアントは初回利用時に生成
+    global _async_client
+    if _async_client is None:
+        _async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _async_client
+
+def build_reserve_expand_messages(user_input, session_history):
+    # 直近4件の履歴を取得
+    context = session_history[-4:] if session_history else []
+    context_text = "\n".join([f"{m['role']}: {m['content']}" for m in context])
+
+    return [
+        {
+            "role": "system",
+            "content": (
+                "あなたは、予約システムに関するあいまいな質問を、FAQ検索に適した明確な文章に書き換えるアシスタントです。"
+                "意味を変えず、キーワードを補い、予約画面・機能名・操作手順が明確になるようにしてください。"
+                "言い換えた文章は、1文の日本語文で出力してください。"
+            )
+        },
+        {
+            "role": "user",
+            "content": f"""以下は最近のやり取りです：
 
 {context_text}
 
@@ -34,18 +40,36 @@ def expand_reserve_query(user_input, session_history):
 
 → 言い換え後：
 """
-            }
-        ]
+        }
+    ]
 
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=prompt,
-            temperature=0.2,
-            max_tokens=100,
-        )
+def _rewrite(user_input, session_history):
+    response = openai.chat.completions.create(
+        model="gpt-4o",
+        messages=build_reserve_expand_messages(user_input, session_history),
+        temperature=0.2,
+        max_tokens=100,
+    )
+    return response.choices[0].message.content.strip()
 
-        return response.choices[0].message.content.strip()
+async def _arewrite(user_input, session_history):
+    response = await _get_async_client().chat.completions.create(
+        model="gpt-4o",
+        messages=build_reserve_expand_messages(user_input, session_history),
+        temperature=0.2,
+        max_tokens=100,
+    )
+    return response.choices[0].message.content.strip()
+
+# それだけで意味が通る質問は LLM を呼ばず、同じ質問・同じ流れのリライトは再利用する
+rewriter = QueryRewriter("expand_reserve_query", _rewrite, _arewrite)
+
+def expand_reserve_query(user_input, session_history):
+    if not user_input:
+        return ""
+    return rewriter.expand(user_input, session_history)
 
-    except Exception as e:
-        print("❌ expand_reserve_query error:", e)
-        return user_input
+async def aexpand_reserve_query(user_input, session_history):
+    if not user_input:
+        return ""
+    return await rewriter.aexpand(user_input, session_history)
@@ -0,0 +1,79 @@
+# faq_shortcut.py
+# FAQ の質問とほぼ同じ質問には、LLM を呼ばずに FAQ の回答をそのまま返す
+# ・正規化した質問文が FAQ と完全一致
+# ・検索の最上位が FAQ で、距離が校正済みしきい値以下
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+FAQ_DIRECT_ENABLED = os.getenv("FAQ_DIRECT_ENABLED", "true").lower() == "true"
+# 未設定なら FAQ 同士の最近傍距離から自動で校正する
+FAQ_DIRECT_MAX_DISTANCE = os.getenv("FAQ_DIRECT_MAX_DISTANCE")
+FAQ_DIRECT_TEMPLATE = os.getenv("FAQ_DIRECT_TEMPLATE", "{answer}")
+CALIBRATION_PERCENTILE = 5
+CALIBRATION_RATIO = 0.5
+
+_TRAILING_PUNCT = re.compile(r"[?？。．.!！\s]+$")
+
+
+def normalize_question(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(text.split())
+    return _TRAILING_PUNCT.sub("", text)
+
+
+def calibrate_max_distance(faq_vectors, percentile=CALIBRATION_PERCENTILE, ratio=CALIBRATION_RATIO):
+    # FAQ 同士の最近傍距離（L2）の下位パーセンタイルの ratio 倍以内なら、
+    # 三角不等式によりほぼすべての他の FAQ より確実に近い。返り値は FAISS と同じ二乗距離
+    vectors = np.asarray(faq_vectors, dtype="float32")
+    if len(vectors) < 2:
+        return 0.0
+    sq = (vectors ** 2).sum(axis=1)
+    dist = sq[:, None] + sq[None, :] - 2 * vectors @ vectors.T
+    np.fill_diagonal(dist, np.inf)
+    nearest = np.sqrt(np.maximum(dist.min(axis=1), 0))
+    radius = ratio * float(np.percentile(nearest, percentile))
+    return radius ** 2
+
+
+class FaqShortcut:
+    def __init__(self, questions, answers, faq_vectors=None, max_distance=None, template=None, enabled=None):
+        self.questions = questions
+        self.answers = answers
+        self.template = template or FAQ_DIRECT_TEMPLATE
+        self.enabled = FAQ_DIRECT_ENABLED if enabled is None else enabled
+        self._exact = {}
+        for pos, q in enumerate(questions):
+            self._exact.setdefault(normalize_question(q), pos)
+
+        if max_distance is not None:
+            self.max_distance = float(max_distance)
+        elif FAQ_DIRECT_MAX_DISTANCE:
+            self.max_distance = float(FAQ_DIRECT_MAX_DISTANCE)
+        elif faq_vectors is not None:
+            self.max_distance = calibrate_max_distance(faq_vectors)
+        else:
+            self.max_distance = 0.0
+
+    def match_exact(self, question):
+        # 一致した FAQ の位置を返す（なければ None）
+        if not self.enabled:
+            return None
+        return self._exact.get(normalize_question(question))
+
+    def match_search(self, D, I, entries):
+        # 検索結果の最上位が FAQ かつ十分近ければ、その FAQ の位置を返す
+        # entries は検索コーパスの行（knowledge_base.build_corpus の形式）
+        if not self.enabled or I.shape[1] == 0:
+            return None
+        top, dist = int(I[0][0]), float(D[0][0])
+        if top < 0 or top >= len(entries) or entries[top]["source"] != "faq":
+            return None
+        if dist > self.max_distance:
+            return None
+        return entries[top]["ref"]
+
+    def render(self, pos):
+        return self.template.format(question=self.questions[pos], answer=self.answers[pos])
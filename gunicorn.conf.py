@@ -0,0 +1,30 @@
+# gunicorn.conf.py
+# 起動例: gunicorn app:app（このファイルは自動で読み込まれる）
+#
+# master でアプリ（インデックス・コーパス）を 1 回だけ読み込み、worker は fork 時にそれを共有する
+# ・インデックスとベクトルは memmap（vector_store.INDEX_MMAP）なのでページキャッシュを共有
+# ・Python オブジェクトは fork 前に gc.freeze() で GC の対象外にし、
+#   worker の GC が参照カウント領域を書き換えて copy-on-write が起きるのを防ぐ
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# 読み込み中に GC が走ってページが散らばらないよう、master では止めておく
+if preload_app:
+    gc.disable()
+
+
+def when_ready(server):
+    if preload_app:
+        gc.freeze()
+        server.log.info(f"gc.freeze: {gc.get_freeze_count()} objects")
+
+
+def post_fork(server, worker):
+    if preload_app:
+        gc.enable()
@@ -0,0 +1,186 @@
+# incremental_index.py
+# FAISS インデックスの差分更新
+# 各行に安定した文書IDを割り当て（IndexIDMap2）、前回ビルドとの差分だけを埋め込み・追加・削除する
+# 各 ID のキーと内容ハッシュはインデックスと同じ場所の *_manifest.json に保存する
+# 差分更新の作業用は常に IndexFlatL2（ベクトルは .npy に保存）。保存する検索用インデックスは
+# vector_backend の設定（VECTOR_BACKEND）で作り、使ったバックエンドをマニフェストに記録する
+import os
+import json
+import hashlib
+
+import numpy as np
+import faiss
+
+from vector_backend import (
+    backend_config, build_search_index, decode_vectors, encode_vectors, load_backend, storage_recall,
+)
+
+MANIFEST_VERSION = 1
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def manifest_path_for(index_path):
+    # data/index.faiss -> data/index_manifest.json
+    root, _ = os.path.splitext(index_path)
+    return f"{root}_manifest.json"
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(path, manifest):
+    # 読み込み中のアプリや再読み込みが書きかけのファイルを読まないよう、別名で書いてから置き換える
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def doc_keys(texts, keys=None):
+    # 行の同一性キー（例: FAQ の質問文）。重複キーは出現順で区別する
+    seen = {}
+    result = []
+    for key in keys or texts:
+        n = seen.get(key, 0)
+        seen[key] = n + 1
+        result.append(content_hash(f"{key}\x00{n}"))
+    return result
+
+
+def _load_id_index(index_path, vector_path, manifest):
+    # 作業用の IndexIDMap2(IndexFlatL2) を復元する
+    if manifest is None or not os.path.exists(index_path):
+        return None
+    if "row_ids" in manifest and os.path.exists(vector_path):
+        # 保存済みベクトル（行の並び = row_ids）から組み立てる（検索用がどのバックエンドでもよい）
+        vectors = decode_vectors(np.load(vector_path), manifest.get("storage", {}).get("params"))
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+        if len(vectors):
+            index.add_with_ids(vectors, np.array(manifest["row_ids"], dtype="int64"))
+    else:
+        index = faiss.read_index(index_path)
+        if not hasattr(index, "id_map"):
+            return None
+    ids = faiss.vector_to_array(index.id_map)
+    if sorted(ids.tolist()) != sorted(d["id"] for d in manifest["docs"]):
+        print("⚠️ マニフェストとインデックスのIDが一致しないため、フルビルドします")
+        return None
+    return index
+
+
+def _save_index(index, index_path, vector_path, config):
+    # ベクトルはインデックス内部の並び（追加順）で保存し、行の位置を安定させる
+    base = faiss.downcast_index(index.index)
+    vector_data = base.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, base.d), dtype="float32")
+    row_ids = faiss.vector_to_array(index.id_map)
+    search_index, used = build_search_index(config, vector_data, row_ids)
+    stored, storage_params = encode_vectors(vector_data, used["storage"])
+    storage = {"dtype": used["storage"], "params": storage_params}
+    if used["storage"] != "float32":
+        # 圧縮による検索精度の変化（float32 の厳密検索が基準）
+        backend = load_backend(search_index, stored, used, storage_params)
+        storage["recall_at_10"] = storage_recall(vector_data, row_ids, backend.search)
+        storage["recall_at_10_without_rescore"] = storage_recall(vector_data, row_ids, getattr(backend, "inner", backend).search)
+        print(
+            f"🗜️ 保存形式 {used['storage']}: recall@10 {storage['recall_at_10']}"
+            f"（再スコアなし {storage['recall_at_10_without_rescore']}）"
+        )
+    # 稼働中のアプリが memmap で開いているファイルを上書きしないよう、別名で書いてから置き換える
+    with open(f"{vector_path}.tmp", "wb") as f:
+        np.save(f, stored)
+    faiss.write_index(search_index, f"{index_path}.tmp")
+    os.replace(f"{vector_path}.tmp", vector_path)
+    os.replace(f"{index_path}.tmp", index_path)
+    print(f"🧭 検索バックエンド: {used['name']} {used['params']}")
+    return {"row_ids": [int(i) for i in row_ids], "backend": used, "backend_config": config, "storage": storage}
+
+
+def update_index(texts, embed, index_path, vector_path, keys=None, full=False, backend=None, embedding=None):
+    """texts（コーパス順）に合わせてインデックスを更新する。
+
+    embed(list[str]) -> np.ndarray(float32) は追加・変更された行にだけ呼ばれる。
+    keys を渡すと、同じキーで内容が変わった行は同じIDのままベクトルを差し替える。
+    backend（未指定なら VECTOR_BACKEND）が前回と違えば、埋め込みは再利用して検索用だけ作り直す。
+    embedding（埋め込みの provider・モデル・次元）が前回と違えば、ベクトルは再利用できないのでフルビルドする。
+    """
+    config = backend_config(backend)
+    manifest_path = manifest_path_for(index_path)
+    manifest = None if full else load_manifest(manifest_path)
+    if manifest and embedding and manifest.get("embedding", embedding) != embedding:
+        print(f"⚠️ 埋め込みの種類が変わったため、フルビルドします: {manifest['embedding']} → {embedding}")
+        manifest = None
+    index = _load_id_index(index_path, vector_path, manifest)
+
+    row_keys = doc_keys(texts, keys)
+    hashes = [content_hash(t) for t in texts]
+
+    if index is None:
+        print(f"🧱 フルビルド: {len(texts)} 件")
+        vectors = embed(texts)
+        ids = np.arange(len(texts), dtype="int64")
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+        index.add_with_ids(vectors, ids)
+        docs = [{"id": int(i), "key": k, "hash": h} for i, k, h in zip(ids, row_keys, hashes)]
+        saved = _save_index(index, index_path, vector_path, config)
+        if embedding:
+            saved["embedding"] = embedding
+        save_manifest(manifest_path, {"version": MANIFEST_VERSION, "next_id": len(texts), "docs": docs, **saved})
+        return index
+
+    previous = {d["key"]: d for d in manifest["docs"]}
+    next_id = manifest["next_id"]
+    docs = []
+    added = []
+    changed = []
+    for pos, (key, h) in enumerate(zip(row_keys, hashes)):
+        prev = previous.pop(key, None)
+        if prev and prev["hash"] == h:
+            docs.append(prev)
+            continue
+        if prev:
+            changed.append(prev["id"])
+            doc_id = prev["id"]
+        else:
+            doc_id = next_id
+            next_id += 1
+        docs.append({"id": doc_id, "key": key, "hash": h})
+        added.append(pos)
+    deleted = [d["id"] for d in previous.values()]
+    removed = changed + deleted
+
+    print(
+        f"🔁 差分更新: 追加 {len(added) - len(changed)} 件 / 変更 {len(changed)} 件 / "
+        f"削除 {len(deleted)} 件 / 変更なし {len(docs) - len(added)} 件"
+    )
+
+    if removed:
+        index.remove_ids(np.array(removed, dtype="int64"))
+    if added:
+        vectors = embed([texts[p] for p in added])
+        index.add_with_ids(vectors, np.array([docs[p]["id"] for p in added], dtype="int64"))
+
+    saved = {k: manifest[k] for k in ("row_ids", "backend", "backend_config", "storage") if k in manifest}
+    if removed or added or manifest.get("backend_config") != config or "row_ids" not in manifest:
+        saved = _save_index(index, index_path, vector_path, config)
+    if embedding or "embedding" in manifest:
+        saved["embedding"] = embedding or manifest["embedding"]
+    if saved != {k: manifest.get(k) for k in saved} or [d["id"] for d in docs] != [d["id"] for d in manifest["docs"]]:
+        save_manifest(manifest_path, {"version": MANIFEST_VERSION, "next_id": next_id, "docs": docs, **saved})
+    else:
+        print("✅ 変更はありません（インデックスは書き換えません）")
+    return index
+
+
+def ids_to_positions(I, position_map):
+    if position_map is None:
+        return I
+    return np.array([[position_map.get(int(i), -1) for i in row] for row in I], dtype="int64")
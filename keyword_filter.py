@@ -1,47 +1,107 @@
-import re
+# keyword_filter.py
+# 質問から製品・フィルム・印刷色のキーワードを抽出する
+# ・キーワードと表記ゆれ（正規化マッピング）は data/keyword_dictionary.json で定義する（コード変更なしで追加できる）
+# ・辞書は最初の呼び出しで 1 回だけ Aho-Corasick オートマトンにまとめ、質問は 1 回の走査で調べる
+#   （表記ゆれはキーワードの別表記としてオートマトンに登録するので、置換のための走査は不要）
+# ・語彙が増えても 1 質問あたりの処理は質問の長さにしか比例しない
+import os
+import json
+import logging
+import itertools
 
-def extract_keywords(text):
-    # 正規化マッピング
-    normalize_map = {
-        "シルバ": "シルバー",
-        "金": "ゴールド",
-        "銀": "シルバー",
-        "白色": "白",
-        "黒色": "黒",
-        "赤色": "赤",
-        "青色": "青",
-        "茶色": "茶",
-        "金色": "ゴールド",
-        "銀色": "シルバー"
-    }
-
-    # 正規化処理（すべて統一表記に変換）
-    for k, v in normalize_map.items():
-        text = text.replace(k, v)
-
-    # キーワード定義
-    color_keywords = ["黒", "青", "赤", "茶", "白", "シルバー", "ゴールド"]
-    product_keywords = ["X型", "X増量タイプ", "VFR型", "VFR増量タイプ", "ディップスタイル", "個包装コーヒーバッグ"]
-    film_keywords = [
-        "白光沢フィルム", "白マットフィルム", "黒光沢フィルム", "黒マットフィルム", "赤フィルム",
-        "クラフト包材", "紙リサイクルマーク付き包材", "ハイバリア特殊紙"
-    ]
-
-    result = {"product": [], "film": [], "color": []}
-
-    # キーワード検出（完全一致ではなく正規表現で柔軟に）
-    for word in product_keywords:
-        if re.search(re.escape(word), text):
-            result["product"].append(word)
-
-    for word in film_keywords:
-        if re.search(re.escape(word), text):
-            result["film"].append(word)
-
-    for word in color_keywords:
-        if re.search(re.escape(word), text):
-            result["color"].append(word)
-
-    print("🟡 抽出結果:", result)  # デバッグログ
+KEYWORD_DICTIONARY_PATH = os.getenv("KEYWORD_DICTIONARY_PATH", "data/keyword_dictionary.json")
+
+logger = logging.getLogger(__name__)
+
+
+class KeywordExtractor:
+    def __init__(self, dictionary):
+        # dictionary: {"normalize": {表記ゆれ: 統一表記}, "<カテゴリ>": [キーワード, ...], ...}
+        normalize = dictionary.get("normalize", {})
+        self.categories = [c for c in dictionary if c != "normalize"]
+        self._variants = {}
+        for source, canonical in normalize.items():
+            self._variants.setdefault(canonical, [canonical]).append(source)
+
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for cat_rank, category in enumerate(self.categories):
+            for rank, word in enumerate(dictionary[category]):
+                hit = (cat_rank, rank, word)
+                for spelling in self._spellings(word):
+                    self._add(spelling, hit)
+        self._link()
+
+    def _spellings(self, word):
+        # キーワードの表記（統一表記の部分を表記ゆれに置き換えたものも含む）
+        # 例: 白光沢フィルム → 白色光沢フィルム、ゴールド → 金 / 金色
+        segments = []
+        i = 0
+        while i < len(word):
+            canonical = max((c for c in self._variants if word.startswith(c, i)), key=len, default=None)
+            if canonical is None:
+                segments.append([word[i]])
+                i += 1
+            else:
+                segments.append(self._variants[canonical])
+                i += len(canonical)
+        return {"".join(parts) for parts in itertools.product(*segments)}
+
+    def _add(self, pattern, hit):
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        self._out[state] += (hit,)
+
+    def _link(self):
+        # 失敗リンクを幅優先で張り、各状態の出力に失敗リンク先の出力（より短い一致）を含める
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
 
+    def extract(self, text):
+        # 各カテゴリのキーワードを辞書の並び順で返す（重なり合う一致もすべて拾う）
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        result = {category: [] for category in self.categories}
+        for cat_rank, _, word in sorted(found):
+            result[self.categories[cat_rank]].append(word)
+        return result
+
+
+def load_extractor(path=None):
+    with open(path or KEYWORD_DICTIONARY_PATH, "r", encoding="utf-8") as f:
+        return KeywordExtractor(json.load(f))
+
+
+_extractor = None
+
+
+def extract_keywords(text):
+    global _extractor
+    if _extractor is None:
+        _extractor = load_extractor()
+    result = _extractor.extract(text)
+    logger.debug("🟡 抽出結果: %s", result)
     return result
@@ -0,0 +1,317 @@
+# knowledge_base.py
+# 検索対象コーパス（FAQ・ナレッジ・メタ情報）とベクトルストアをまとめて扱う
+# ・コーパスの組み立て方（どの行をどの順で埋め込むか）はここだけで定義し、
+#   アプリ（app.py）とインデックス更新スクリプトの両方が同じ build_corpus を使う
+# ・ベクトルは全コーパス共通のストア（vector_store）に 1 組だけ持ち、
+#   KnowledgeBase はそのうち自分のコーパスの行（名前空間）だけを検索する
+# ・KnowledgeSnapshot は通常用・予約用をまとめた 1 世代分（ホットリロードの差し替え単位）
+import os
+import json
+import time
+
+import numpy as np
+
+from artifact_reloader import artifact_version
+from faq_shortcut import FaqShortcut
+from corpus_router import CorpusRouter
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from incremental_index import ids_to_positions, manifest_path_for
+from vector_store import STORE_INDEX_PATH, VectorStore, unique_rows, update_store
+
+# 検索方式: hybrid（ベクトル + 文字 n-gram BM25 を RRF で統合）/ vector / lexical（埋め込みなし）
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# hybrid のとき、それぞれの検索から k の何倍の候補を統合に回すか
+FUSION_CANDIDATES = int(os.getenv("FUSION_CANDIDATES", "3"))
+
+# コーパスごとの入力ファイルと、FAQ 行に埋め込むテキスト（質問のみ / 質問＋回答）
+# 通常用と予約用の FAQ は同じ質問を持つが、埋め込むテキストが違うので共通ストアでも別の行になり、重複は除かれない。
+# 通常用は FAQ 直接回答のしきい値を質問どうしの距離で校正し、予約用は回答の語句でも引けるよう質問＋回答で検索するため、
+# どちらかに揃えると検索結果が変わる。ストアで 1 回にまとまるのは、テキストまで同じ行（両方にあるナレッジ）だけ
+CORPORA = {
+    "general": {
+        "faq_path": "data/faq.json",
+        "knowledge_path": "data/knowledge.json",
+        "metadata_path": "data/metadata.json",
+        "faq_text": "question",
+    },
+    "reserve": {
+        "faq_path": "data/reserve_faq.json",
+        "knowledge_path": "data/reserve_knowledge.json",
+        "metadata_path": "data/reserve_metadata.json",
+        "faq_text": "question_answer",
+    },
+}
+
+
+def load_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_metadata(path):
+    # メタ情報（任意）
+    if path and os.path.exists(path):
+        return load_json(path)
+    return None
+
+
+def knowledge_items(knowledge_data):
+    # knowledge.json が dict（カテゴリ: [本文, ...]）または list（title, content）の可能性に対応
+    if isinstance(knowledge_data, dict):
+        return [(category, text) for category, texts in knowledge_data.items() for text in texts]
+    if isinstance(knowledge_data, list):
+        return [(item["title"], item["content"]) for item in knowledge_data]
+    raise ValueError("knowledge の形式が不正です。")
+
+
+def metadata_index_text(metadata):
+    return f"【ファイル情報】{metadata.get('title', '')}（種類：{metadata.get('type', '')}、優先度：{metadata.get('priority', '')}）"
+
+
+def build_corpus(faq_items, knowledge_data, metadata=None, faq_text="question"):
+    """検索コーパスの行を組み立てる（この順でインデックスに登録する）。
+
+    各行は {"key", "text", "source", "ref"}。key は差分更新用の同一性キー（内容を直しても変わらない。
+    ナレッジはカテゴリとカテゴリ内の位置）、ref は source（faq / knowledge / metadata）ごとの元データ上の位置。
+    """
+    entries = []
+    for ref, item in enumerate(faq_items):
+        question, answer = item.get("question", ""), item.get("answer", "")
+        if faq_text == "question_answer":
+            if not (question and answer):
+                continue
+            text = f"{question} {answer}"
+        else:
+            text = question
+        entries.append({"key": f"faq:{question}", "text": text, "source": "faq", "ref": ref})
+    seen = {}
+    for ref, (category, text) in enumerate(knowledge_items(knowledge_data)):
+        n = seen.get(category, 0)
+        seen[category] = n + 1
+        entries.append({"key": f"knowledge:{category}:{n}", "text": f"{category}：{text}", "source": "knowledge", "ref": ref})
+    if metadata:
+        entries.append({"key": "metadata", "text": metadata_index_text(metadata), "source": "metadata", "ref": 0})
+    return [e for e in entries if e["text"].strip()]
+
+
+def load_corpus(name):
+    # ファイルに保存済みのデータからコーパスを組み立てる（更新スクリプト用）
+    cfg = CORPORA[name]
+    return build_corpus(
+        load_json(cfg["faq_path"]),
+        load_json(cfg["knowledge_path"]),
+        read_metadata(cfg["metadata_path"]),
+        cfg["faq_text"],
+    )
+
+
+def store_rows(names=None):
+    # ベクトルストアに登録する (キー, テキスト)（全コーパスの行、同じテキストは 1 回）
+    return unique_rows(load_corpus(name) for name in (names or CORPORA))
+
+
+def rebuild_store(embed, full=False, embedding=None):
+    # 保存済みのコーパスファイルからベクトルストアを更新する（更新スクリプト用）
+    keys, texts = store_rows()
+    return update_store(texts, embed, full=full, embedding=embedding, keys=keys)
+
+
+class KnowledgeBase:
+    def __init__(self, name, store, faq_path, knowledge_path, metadata_path=None, faq_text="question"):
+        # store（VectorStore）のうち、このコーパスの行を名前空間 name として登録して検索する
+        self.name = name
+        self.store = store
+        self.faq_path = faq_path
+        self.knowledge_path = knowledge_path
+        self.metadata_path = metadata_path
+
+        self.faq_items = load_json(faq_path)
+        self.faq_questions = [item["question"] for item in self.faq_items]
+        self.faq_answers = [item["answer"] for item in self.faq_items]
+
+        knowledge_data = load_json(knowledge_path)
+        self.knowledge_contents = [f"{category}：{text}" for category, text in knowledge_items(knowledge_data)]
+
+        self.metadata = read_metadata(metadata_path)
+
+        self.entries = build_corpus(self.faq_items, knowledge_data, self.metadata, faq_text)
+        self.source_flags = [e["source"] for e in self.entries]
+
+        self.dimension = store.dimension
+        self.position_map = self._align()
+        store.register(name, list(self.position_map))
+        # 語彙検索用の n-gram 転置インデックス（ファイルには保存せず、読み込みのたびに作る）
+        self.lexical = LexicalIndex([self._lexical_text(e) for e in self.entries])
+        print(f"📚 {name}: {len(self.entries)} 件（FAQ {len(self.faq_items)} / ナレッジ {len(self.knowledge_contents)}）")
+
+    @classmethod
+    def from_config(cls, name, store):
+        return cls(name, store, **CORPORA[name])
+
+    def _align(self):
+        # ストアの文書 ID → コーパス上の位置（コーパス内で同じテキストが重なる場合は先の行）
+        position_map = {}
+        missing = 0
+        for pos, doc_id in enumerate(self.store.ids_for([e["text"] for e in self.entries])):
+            if doc_id < 0:
+                missing += 1
+            elif doc_id not in position_map:
+                position_map[doc_id] = pos
+        if missing:
+            print(f"⚠️ {self.name}: ベクトルストアに無い行が {missing} 件あります。インデックスを更新してください。")
+        return position_map
+
+    def search(self, q_vector, k=7):
+        # (距離, コーパス上の位置) を返す。対応する行がない結果は -1
+        D, I = self.store.search(q_vector, k, self.name)
+        return D, ids_to_positions(I, self.position_map)
+
+    def hits_from(self, D, I, k):
+        # 複数の名前空間をまとめて検索した (距離, 文書 ID) から、このコーパスの行を上位 k 件取り出す
+        out_D = np.full((1, k), np.inf, dtype="float32")
+        out_I = np.full((1, k), -1, dtype="int64")
+        rank = 0
+        for d, doc_id in zip(D[0], I[0]):
+            pos = self.position_map.get(int(doc_id))
+            if pos is None or rank >= k:
+                continue
+            out_D[0, rank] = d
+            out_I[0, rank] = pos
+            rank += 1
+        return out_D, out_I
+
+    def _lexical_text(self, entry):
+        # FAQ は質問だけでなく回答の語句でも引けるようにする
+        if entry["source"] == "faq":
+            item = self.faq_items[entry["ref"]]
+            return f"{item.get('question', '')} {item.get('answer', '')}"
+        return entry["text"]
+
+    def retrieve(self, q_vector, query_text, k=7, mode=None, vector_hits=None):
+        """検索方式に応じて (距離, 位置) を返す。q_vector が None なら語彙検索のみ。
+
+        距離はベクトル検索で得た行だけに入り、語彙検索だけで拾った行は inf
+        （FAQ 直接回答のしきい値判定はベクトルの距離でしか行わない）。
+        vector_hits（hits_from の結果）を渡すと、ベクトル検索をやり直さずにそれを使う。
+        """
+        mode = mode or RETRIEVAL_MODE
+        if q_vector is None:
+            mode = "lexical"
+        if mode == "vector":
+            if vector_hits is not None:
+                return vector_hits[0][:, :k], vector_hits[1][:, :k]
+            return self.search(q_vector, k)
+
+        _, lexical_positions = self.lexical.search(query_text, k * FUSION_CANDIDATES)
+        distances = {}
+        if mode == "lexical":
+            positions = list(lexical_positions[:k])
+        else:
+            D, I = vector_hits if vector_hits is not None else self.search(q_vector, k * FUSION_CANDIDATES)
+            distances = {int(pos): float(d) for d, pos in zip(D[0], I[0]) if pos >= 0}
+            positions = reciprocal_rank_fusion([I[0], lexical_positions], k)
+
+        D = np.full((1, k), np.inf, dtype="float32")
+        I = np.full((1, k), -1, dtype="int64")
+        for rank, pos in enumerate(positions):
+            D[0, rank] = distances.get(int(pos), np.inf)
+            I[0, rank] = pos
+        return D, I
+
+    def entry(self, pos):
+        if 0 <= pos < len(self.entries):
+            return self.entries[pos]
+        return None
+
+    def texts(self, I):
+        # 検索結果の行テキスト（予約用の Q+A 検索など）
+        return [self.entries[pos]["text"] for pos in I[0] if 0 <= pos < len(self.entries)]
+
+    def faq_vectors(self):
+        # FAQ 行のベクトルをインデックスから復元（FAQ 直接回答のしきい値校正用）
+        return self.entry_vectors([pos for pos, src in enumerate(self.source_flags) if src == "faq"])
+
+    def entry_vectors(self, positions):
+        # コーパス上の位置の行のベクトル（順不同。ストアに無い行は除く）
+        wanted = set(positions)
+        return self.store.vectors_for([doc_id for doc_id, pos in self.position_map.items() if pos in wanted])
+
+
+def artifact_paths(names=("general", "reserve")):
+    # 1 世代を構成するファイル（変更検知と版の計算に使う）
+    paths = [STORE_INDEX_PATH, manifest_path_for(STORE_INDEX_PATH)]
+    for name in names:
+        cfg = CORPORA[name]
+        paths += [cfg["faq_path"], cfg["knowledge_path"], cfg["metadata_path"]]
+    return paths
+
+
+class KnowledgeSnapshot:
+    def __init__(self, store, general, reserve, version):
+        self.store = store
+        self.general = general
+        self.reserve = reserve
+        self.version = version
+        self.loaded_at = time.time()
+
+        # FAQ とほぼ同じ質問は LLM を呼ばずに回答（しきい値は FAQ ベクトルから自動校正）
+        self.faq_shortcut = FaqShortcut(general.faq_questions, general.faq_answers, faq_vectors=general.faq_vectors())
+        self.reserve_faq_shortcut = FaqShortcut(reserve.faq_questions, reserve.faq_answers, faq_vectors=reserve.faq_vectors())
+        print(
+            f"⚡ FAQ 直接回答しきい値: 通常 {self.faq_shortcut.max_distance:.4f} / "
+            f"予約 {self.reserve_faq_shortcut.max_distance:.4f}"
+        )
+        # 質問の埋め込みで検索するコーパスを選ぶ（各コーパスにしかない行がプロトタイプ）
+        self.router = CorpusRouter.from_knowledge(general, reserve)
+
+    @classmethod
+    def load(cls, embed=None, embedding=None):
+        # embed・embedding は、ベクトルストアがまだ無いときの初回構築にだけ使う
+        version = artifact_version(artifact_paths())
+        keys, texts = (None, None) if os.path.exists(STORE_INDEX_PATH) else store_rows()
+        store = VectorStore(texts=texts, embed=embed, embedding=embedding, keys=keys)
+        snapshot = cls(
+            store,
+            KnowledgeBase.from_config("general", store),
+            KnowledgeBase.from_config("reserve", store),
+            version,
+        )
+        snapshot.validate(embedding)
+        print(f"📦 データ版: {version}")
+        return snapshot
+
+    def validate(self, embedding=None):
+        # 差し替え前の検証
+        store = self.store
+        if store.ntotal == 0:
+            raise ValueError("ベクトルストアが空です")
+        built_with = store.manifest.get("embedding")
+        if embedding and built_with and built_with != embedding:
+            # 種類の違う埋め込み同士の距離は意味を持たない
+            raise ValueError(
+                f"インデックスの埋め込み（{built_with}）と質問の埋め込み（{embedding}）が一致しません。"
+                "同じ EMBED_PROVIDER でインデックスを再構築してください。"
+            )
+        if embedding and store.dimension != embedding["dimensions"]:
+            raise ValueError(f"インデックスの次元（{store.dimension}）が埋め込みの次元（{embedding['dimensions']}）と一致しません")
+        for kb in (self.general, self.reserve):
+            if not kb.entries or not kb.position_map:
+                raise ValueError(f"{kb.name}: コーパスが空か、ベクトルストアに行がありません")
+            D, I = kb.search(np.zeros(kb.dimension, dtype="float32"), k=1)
+            if I.shape[1] == 0 or I[0, 0] < 0:
+                raise ValueError(f"{kb.name}: インデックスを検索できません")
+
+    def search_both(self, q_vector, k):
+        # 通常用・予約用の行をまとめて 1 回で検索し、コーパスごとの (距離, 位置) に分ける
+        D, I = self.store.search(q_vector, k, ("general", "reserve"))
+        return {kb.name: kb.hits_from(D, I, k) for kb in (self.general, self.reserve)}
+
+    def mapped_paths(self):
+        # memmap しているファイル（メモリ使用量の内訳用）
+        return [self.store.index_path, self.store.vector_path]
+
+    def kb_for(self, use_reserve):
+        return self.reserve if use_reserve else self.general
+
+    def shortcut_for(self, use_reserve):
+        return self.reserve_faq_shortcut if use_reserve else self.faq_shortcut
@@ -0,0 +1,84 @@
+# lexical_index.py
+# 文字 n-gram（2-gram / 3-gram）の転置インデックスによる BM25 検索
+# 日本語は分かち書きせずに文字 n-gram で引く（「VFR増量タイプ」のような製品名の完全一致に強い）
+# 埋め込み（OpenAI）を使わないので、ネットワークなしで検索できる
+import os
+import re
+import math
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+NGRAM_SIZES = (2, 3)
+# RRF（Reciprocal Rank Fusion）の定数。大きいほど下位の順位の差が効きにくくなる
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+_NON_WORD = re.compile(r"[\s\W_]+")
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _NON_WORD.sub("", text)
+
+
+def char_ngrams(text, sizes=NGRAM_SIZES):
+    text = normalize_text(text)
+    grams = []
+    for n in sizes:
+        grams += [text[i:i + n] for i in range(len(text) - n + 1)]
+    if not grams and text:
+        grams.append(text)  # 1 文字だけの質問
+    return grams
+
+
+class LexicalIndex:
+    def __init__(self, texts, k1=None, b=None):
+        k1 = BM25_K1 if k1 is None else k1
+        b = BM25_B if b is None else b
+        self.size = len(texts)
+        counts = [Counter(char_ngrams(t)) for t in texts]
+        lengths = np.array([sum(c.values()) for c in counts], dtype="float32")
+        avg_length = float(lengths.mean()) if self.size and lengths.sum() else 1.0
+
+        postings = {}
+        for doc, c in enumerate(counts):
+            for gram, tf in c.items():
+                postings.setdefault(gram, ([], []))
+                postings[gram][0].append(doc)
+                postings[gram][1].append(tf)
+
+        # 文書側の BM25 の重みは構築時に計算しておき、検索時は足し合わせるだけにする
+        self.postings = {}
+        for gram, (docs, tfs) in postings.items():
+            docs = np.array(docs, dtype="int64")
+            tfs = np.array(tfs, dtype="float32")
+            idf = math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1 - b + b * lengths[docs] / avg_length)
+            self.postings[gram] = (docs, (idf * tfs * (k1 + 1) / (tfs + norm)).astype("float32"))
+
+    def search(self, query, k):
+        # (スコア, 位置) をスコアの高い順に返す。一致する n-gram がない文書は返さない
+        scores = np.zeros(self.size, dtype="float32")
+        for gram, qtf in Counter(char_ngrams(query)).items():
+            posting = self.postings.get(gram)
+            if posting is not None:
+                scores[posting[0]] += qtf * posting[1]
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return scores[hits], hits
+
+
+def reciprocal_rank_fusion(rankings, k=None, rrf_k=None):
+    # 複数の順位リスト（位置の配列、-1 は無視）を RRF で 1 つにまとめ、上位 k 件の位置を返す
+    rrf_k = RRF_K if rrf_k is None else rrf_k
+    fused = {}
+    for ranking in rankings:
+        for rank, pos in enumerate(int(p) for p in ranking if p >= 0):
+            fused[pos] = fused.get(pos, 0.0) + 1.0 / (rrf_k + rank + 1)
+    ordered = sorted(fused, key=lambda pos: -fused[pos])
+    return ordered[:k] if k is not None else ordered
@@ -0,0 +1,183 @@
+# metrics.py
+# 処理ステージごとの所要時間（ヒストグラム）と件数（カウンター）を集め、Prometheus のテキスト形式で返す
+# ・外部ライブラリは使わない。1 回の記録はロック 1 回と配列の加算だけ
+# ・with span("search"): ... でステージの所要時間を記録し、例外で抜けたときはエラー件数にも数える
+# ・各モジュールが自前で持っている統計（キャッシュのヒット数など）は、collector として
+#   /metrics の出力時にだけ読み出す（リクエスト処理には負荷をかけない）
+# ・値はプロセス（gunicorn の worker）ごと。worker をまたいだ合計は Prometheus 側で集計する
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# 所要時間のバケット（秒）。LLM の呼び出しは数秒かかるので 30 秒まで
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # ラベル値 → [バケットごとの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        # 該当する最初のバケットだけに数え、累積は出力時に計算する
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        result = []
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                result.append((f"{self.name}_bucket", _labels(self.labelnames, key, [("le", _number(bound))]), cumulative))
+            result.append((f"{self.name}_sum", _labels(self.labelnames, key), round(values[-2], 6)))
+            result.append((f"{self.name}_count", _labels(self.labelnames, key), values[-1]))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        # collect() -> [(名前, 種類（counter / gauge）, 説明, 値 または [(ラベルの dict, 値), ...]), ...]
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += [f"{name}{labels} {_number(value)}" for name, labels, value in metric.samples()]
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print("⚠️ metrics collector error:", e)
+                continue
+            for name, kind, help_text, values in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if not isinstance(values, list):
+                    values = [({}, values)]
+                for labels, value in values:
+                    lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "chatbot_stage_duration_seconds", "Time spent in each /chat pipeline stage.", ["stage"]
+)
+STAGE_ERRORS = registry.counter(
+    "chatbot_stage_errors_total", "Pipeline stages that raised an exception.", ["stage"]
+)
+REQUEST_SECONDS = registry.histogram(
+    "chatbot_request_duration_seconds",
+    "End-to-end request time by endpoint and answer path (greeting, faq_exact, faq_vector, out_of_scope, "
+    "semantic_cache, llm, error). The _count series counts short-circuits per path.",
+    ["endpoint", "path"],
+)
+ROUTES = registry.counter(
+    "chatbot_route_total", "Corpus routing decisions (route) and the corpus finally searched (corpus).", ["route", "corpus"]
+)
+PROMPT_TOKENS = registry.histogram(
+    "chatbot_prompt_tokens",
+    "Prompt tokens per LLM answer by part (system, context, total), counted locally before the request.",
+    ["part"],
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000),
+)
+PROMPT_CONTEXT_DROPPED = registry.counter(
+    "chatbot_prompt_context_dropped_total",
+    "Retrieved context entries left out of the prompt by reason (duplicate, budget, limit).",
+    ["reason"],
+)
+
+
+@contextmanager
+def span(stage):
+    # ステージの所要時間を記録する（例外はそのまま呼び出し側へ）
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,60 @@
+# process_memory.py
+# プロセスのメモリ使用量（/stats 用）
+# RSS のうち他プロセス（gunicorn の master / 他の worker）と共有しているページと、
+# この worker 固有のページを分けて返す。memmap したデータファイルごとの内訳も出す
+import os
+import resource
+
+SMAPS_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty", "Swap")
+
+
+def _read_smaps_rollup():
+    totals = {}
+    with open("/proc/self/smaps_rollup", "r") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in SMAPS_FIELDS:
+                totals[name] = int(value.split()[0])
+    return totals
+
+
+def _mapped_files(paths):
+    # 指定したファイルの memmap 部分の Rss / Pss（kB）
+    wanted = {os.path.abspath(p) for p in paths}
+    usage = {}
+    current = None
+    with open("/proc/self/smaps", "r") as f:
+        for line in f:
+            head = line.split(None, 1)[0]
+            if not head.endswith(":"):
+                # マッピングの見出し行（アドレス 権限 オフセット デバイス inode パス）
+                parts = line.split(None, 5)
+                path = parts[5].strip() if len(parts) == 6 else ""
+                current = path if path in wanted else None
+                if current:
+                    usage.setdefault(current, {"rss_kb": 0, "pss_kb": 0})
+            elif current and head in ("Rss:", "Pss:"):
+                key = "rss_kb" if head == "Rss:" else "pss_kb"
+                usage[current][key] += int(line.split()[1])
+    return usage
+
+
+def memory_stats(paths=()):
+    stats = {"pid": os.getpid(), "ppid": os.getppid()}
+    try:
+        totals = _read_smaps_rollup()
+    except OSError:
+        # Linux 以外は最大 RSS のみ
+        stats["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return stats
+
+    stats.update({
+        "rss_kb": totals.get("Rss", 0),
+        "pss_kb": totals.get("Pss", 0),
+        "shared_kb": totals.get("Shared_Clean", 0) + totals.get("Shared_Dirty", 0),
+        "private_kb": totals.get("Private_Clean", 0) + totals.get("Private_Dirty", 0),
+        "swap_kb": totals.get("Swap", 0),
+    })
+    if paths:
+        stats["mapped_files"] = _mapped_files(paths)
+    return stats
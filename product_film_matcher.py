@@ -1,15 +1,93 @@
 import json
+import logging
 from keyword_filter import extract_keywords
 
+# 質問側の名前（部分一致）→ 該当するキーの解決結果を覚えておく上限
+RESOLVE_CACHE_SIZE = 4096
+
+logger = logging.getLogger(__name__)
+
+
+def bits_to_names(mask, names):
+    # ビット集合 → 名前のリスト（ビットの位置 = names 上の位置）
+    result = []
+    while mask:
+        low = mask & -mask
+        result.append(names[low.bit_length() - 1])
+        mask ^= low
+    return result
+
+
 class ProductFilmMatcher:
     def __init__(self, json_path="data/product_film_color_matrix.json"):
         with open(json_path, "r", encoding="utf-8") as f:
             self.data = json.load(f)
+        self._compile()
+
+    def _compile(self):
+        # 製品 × フィルム × 印刷色の行列を、読み込み時に転置インデックスとビット集合に変換する
+        # （製品・フィルム・色それぞれに番号を振り、集合は int のビットで持つ）
+        self.products = list(self.data)
+        self.films = list(dict.fromkeys(film for films in self.data.values() for film in films))
+        self.colors = list(dict.fromkeys(c for films in self.data.values() for colors in films.values() for c in colors))
+        self.product_bit = {p: 1 << i for i, p in enumerate(self.products)}
+        self.film_bit = {f: 1 << i for i, f in enumerate(self.films)}
+        self.color_bit = {c: 1 << i for i, c in enumerate(self.colors)}
+
+        self.films_by_product = {}          # 製品 → フィルム
+        self.products_by_film = {}          # フィルム → 製品
+        self.films_by_color = {}            # 色 → フィルム（製品問わず）
+        self.products_by_color = {}         # 色 → 製品
+        self.colors_by_pair = {}            # (製品, フィルム) → 色
+        self.films_by_product_color = {}    # (製品, 色) → フィルム（複数色の絞り込み用）
+        for product, films in self.data.items():
+            pbit = self.product_bit[product]
+            self.films_by_product[product] = 0
+            for film, colors in films.items():
+                fbit = self.film_bit[film]
+                self.films_by_product[product] |= fbit
+                self.products_by_film[film] = self.products_by_film.get(film, 0) | pbit
+                self.colors_by_pair[(product, film)] = self.color_mask(colors)
+                for c in colors:
+                    self.films_by_color[c] = self.films_by_color.get(c, 0) | fbit
+                    self.products_by_color[c] = self.products_by_color.get(c, 0) | pbit
+                    key = (product, c)
+                    self.films_by_product_color[key] = self.films_by_product_color.get(key, 0) | fbit
+        self._resolved = {}
+
+    def color_mask(self, color_names):
+        mask = 0
+        for c in color_names:
+            mask |= self.color_bit.get(c, 0)
+        return mask
+
+    def _resolve(self, kind, name):
+        # 部分一致の解決は名前ごとに 1 回だけ行う（キーワード抽出の語彙は限られている）
+        key = (kind, name)
+        mask = self._resolved.get(key)
+        if mask is None:
+            if kind == "product_in_name":
+                mask = next((self.product_bit[p] for p in self.products if p in name), 0)
+            elif kind == "product":
+                mask = sum(self.product_bit[p] for p in self.products if name in p)
+            else:
+                mask = sum(self.film_bit[f] for f in self.films if name in f)
+            if len(self._resolved) >= RESOLVE_CACHE_SIZE:
+                self._resolved.clear()
+            self._resolved[key] = mask
+        return mask
+
+    def _film_in_product(self, product, film_mask):
+        # 製品のフィルムのうち film_mask に含まれる最初のもの（行列上の並び順）
+        if not self.films_by_product[product] & film_mask:
+            return None
+        return next(f for f in self.data[product] if self.film_bit[f] & film_mask)
 
     def get_films_for_product(self, product_name):
-        product = next((p for p in self.data if p in product_name), None)
+        product = bits_to_names(self._resolve("product_in_name", product_name), self.products)
         if not product:
             return {"matched": False, "type": "product_to_films", "message": "該当する製品種が見つかりませんでした。"}
+        product = product[0]
         films = list(self.data[product].keys())
         return {
             "matched": True,
@@ -19,82 +97,91 @@ class ProductFilmMatcher:
         }
 
     def get_colors_for_film_in_product(self, product_name, film_name):
-        for product, films in self.data.items():
-            if product_name in product:
-                for film, colors in films.items():
-                    if film_name in film:
-                        return {
-                            "matched": True,
-                            "type": "product_film_to_colors",
-                            "product": product,
-                            "film": film,
-                            "colors": colors
-                        }
+        film_mask = self._resolve("film", film_name)
+        for product in bits_to_names(self._resolve("product", product_name), self.products):
+            film = self._film_in_product(product, film_mask)
+            if film is not None:
+                return {
+                    "matched": True,
+                    "type": "product_film_to_colors",
+                    "product": product,
+                    "film": film,
+                    "colors": self.data[product][film]
+                }
         return {"matched": False, "type": "product_film_to_colors", "message": "該当する製品とフィルムの組み合わせが見つかりませんでした。"}
 
     def get_products_for_film(self, film_name):
-        matched_products = []
-        for product, films in self.data.items():
-            if any(film_name in film for film in films):
-                matched_products.append(product)
-        if matched_products:
+        mask = 0
+        for film in bits_to_names(self._resolve("film", film_name), self.films):
+            mask |= self.products_by_film[film]
+        if mask:
             return {
                 "matched": True,
                 "type": "film_to_products",
                 "film": film_name,
-                "products": matched_products
+                "products": bits_to_names(mask, self.products)
             }
         return {"matched": False, "type": "film_to_products", "message": "該当するフィルムに対応する製品が見つかりませんでした。"}
 
     def get_films_for_color(self, color_names):
-        matched = set()
-        for product, films in self.data.items():
-            for film, colors in films.items():
-                if any(c in colors for c in color_names):
-                    matched.add(film)
-        if matched:
+        mask = 0
+        for c in color_names:
+            mask |= self.films_by_color.get(c, 0)
+        if mask:
             return {
                 "matched": True,
                 "type": "color_to_films",
                 "color": ", ".join(color_names),
-                "films": list(matched)
+                "films": bits_to_names(mask, self.films)
             }
         return {"matched": False, "type": "color_to_films", "message": "該当する印刷色が見つかりませんでした。"}
 
     def get_products_for_color(self, color_names):
-        matched_products = set()
-        for product, films in self.data.items():
-            for colors in films.values():
-                if any(c in colors for c in color_names):
-                    matched_products.add(product)
-        if matched_products:
+        mask = 0
+        for c in color_names:
+            mask |= self.products_by_color.get(c, 0)
+        if mask:
             return {
                 "matched": True,
                 "type": "color_to_products",
                 "color": ", ".join(color_names),
-                "products": list(matched_products)
+                "products": bits_to_names(mask, self.products)
             }
         return {"matched": False, "type": "color_to_products", "message": "該当する印刷色に対応する製品が見つかりませんでした。"}
 
     def get_film_colors_for_color(self, color_names):
-        matched_colors = set()
-        for product, films in self.data.items():
-            for film, colors in films.items():
-                if any(c in colors for c in color_names):
-                    matched_colors.add(film)
-        if matched_colors:
+        mask = 0
+        for c in color_names:
+            mask |= self.films_by_color.get(c, 0)
+        if mask:
             return {
                 "matched": True,
                 "type": "color_to_film_colors",
                 "color": ", ".join(color_names),
-                "film_colors": list(matched_colors)
+                "film_colors": bits_to_names(mask, self.films)
             }
         return {"matched": False, "type": "color_to_film_colors", "message": "印刷色に対応するフィルム色が見つかりませんでした。"}
 
+    def get_films_for_colors_in_product(self, product_name, color_names):
+        # 製品のフィルムのうち、指定した印刷色をすべて使えるもの（例: VFR型 で 白 と ゴールド の両方）
+        for product in bits_to_names(self._resolve("product", product_name), self.products):
+            mask = self.films_by_product[product]
+            for c in color_names:
+                mask &= self.films_by_product_color.get((product, c), 0)
+            if mask:
+                return {
+                    "matched": True,
+                    "type": "product_colors_to_films",
+                    "product": product,
+                    "color": ", ".join(color_names),
+                    "films": [f for f in self.data[product] if self.film_bit[f] & mask]
+                }
+        return {"matched": False, "type": "product_colors_to_films", "message": "指定した印刷色をすべて使えるフィルムが見つかりませんでした。"}
+
     def match(self, user_input, history=None):
         try:
             keywords = extract_keywords(user_input)
-            print("🔍 extract_keywords:", keywords)
+            logger.debug("🔍 extract_keywords: %s", keywords)
 
             if not isinstance(keywords, dict):
                 return {"matched": False, "type": "no_match", "message": "キーワード抽出でエラーが発生しました。"}
@@ -111,8 +198,8 @@ class ProductFilmMatcher:
                 for p in products:
                     for f in films:
                         info = self.get_colors_for_film_in_product(p, f)
-                        if info["matched"] and any(c in info.get("colors", []) for c in colors):
-                            print(f"✅ match type: {info['type']}")
+                        if info["matched"] and self.colors_by_pair[(info["product"], info["film"])] & self.color_mask(colors):
+                            logger.debug("✅ match type: %s", info["type"])
                             return info
 
             if products and films:
@@ -120,21 +207,30 @@ class ProductFilmMatcher:
                     for f in films:
                         info = self.get_colors_for_film_in_product(p, f)
                         if info["matched"]:
-                            print(f"✅ match type: {info['type']}")
+                            logger.debug("✅ match type: %s", info["type"])
                             return info
 
+            # 「赤フィルム」の「赤」のようにフィルム名の一部として出てきた色は、印刷色の指定として扱わない
+            print_colors = [c for c in colors if not any(c in f for f in films)]
+            if products and print_colors:
+                for p in products:
+                    result = self.get_films_for_colors_in_product(p, print_colors)
+                    if result["matched"]:
+                        logger.debug("✅ match type: %s", result["type"])
+                        return result
+
             if products:
                 for p in products:
                     result = self.get_films_for_product(p)
                     if result["matched"]:
-                        print(f"✅ match type: {result['type']}")
+                        logger.debug("✅ match type: %s", result["type"])
                         return result
 
             if films:
                 for f in films:
                     result = self.get_products_for_film(f)
                     if result["matched"]:
-                        print(f"✅ match type: {result['type']}")
+                        logger.debug("✅ match type: %s", result["type"])
                         return result
 
             if colors:
@@ -145,10 +241,10 @@ class ProductFilmMatcher:
                 ]:
                     result = getter(colors)
                     if result["matched"]:
-                        print(f"✅ match type: {result['type']}")
+                        logger.debug("✅ match type: %s", result["type"])
                         return result
 
-            print("⚠️ No match found")
+            logger.debug("⚠️ No match found")
             return {"matched": False, "type": "no_match", "message": "製品・フィルム・色のいずれも該当する情報が見つかりませんでした。"}
 
         except Exception as e:
@@ -180,6 +276,10 @@ class ProductFilmMatcher:
             lines.append(f"- フィルム「{info['film']}」が使用できる製品：")
             lines.append(f"- {', '.join(info['products'])}")
 
+        elif match_type == "product_colors_to_films":
+            lines.append(f"- 製品「{info['product']}」で印刷色「{info['color']}」をすべて使えるフィルム：")
+            lines.append(f"- {', '.join(info['films'])}")
+
         elif match_type == "color_to_films":
             lines.append(f"- 印刷色「{info['color']}」に対応可能なフィルム：")
             lines.append(f"- {', '.join(info['films'])}")
@@ -0,0 +1,209 @@
+# prompt_builder.py
+# /chat の LLM に渡すプロンプトの組み立て
+# ・コンテキスト（製品フィルム情報・FAQ・参考知識）は関連度の高い順（検索の順位）に、
+#   トークン数の予算（PROMPT_CONTEXT_TOKENS）に収まるだけ入れる。入りきらない候補は飛ばして次を見る
+# ・ほぼ同じ内容の候補（回答・本文の文字 n-gram の Jaccard 係数がしきい値以上）は、順位の高い方だけ残す
+#   （FAQ を言い回しだけ変えて追加したものや、FAQ の回答を写したナレッジ）
+# ・トークン数はローカルで数える（tiktoken があれば送信先のモデルと同じ符号化、なければ文字種からの概算）
+# ・プロンプトのトークン数（system / コンテキスト / 全体）を結果に含め、/metrics に記録する
+import os
+import math
+import threading
+
+from lexical_index import char_ngrams
+import metrics
+
+try:
+    import tiktoken
+except ImportError:  # 未インストールなら概算で数える
+    tiktoken = None
+
+PROMPT_MODEL = os.getenv("PROMPT_MODEL", "gpt-4o")
+# コンテキスト（FAQ・参考情報）に使うトークン数の上限。system プロンプトと質問は含まない
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "1500"))
+PROMPT_MAX_FAQ = int(os.getenv("PROMPT_MAX_FAQ", "3"))
+PROMPT_MAX_REFERENCES = int(os.getenv("PROMPT_MAX_REFERENCES", "2"))
+# 下げると言い換えの FAQ もまとめるが、0.5〜0.6 には充填量違い・箱の種類違いなど別内容の組も入る
+PROMPT_DEDUP_THRESHOLD = float(os.getenv("PROMPT_DEDUP_THRESHOLD", "0.7"))
+
+FILM_INFO_MARK = "製品フィルム・カラー情報"
+NO_FAQ_TEXT = "該当するFAQは見つかりませんでした。"
+MODE_INSTRUCTIONS = {
+    "short": "\n\n可能な限り簡潔かつ要点のみで回答してください。",
+    "long": "\n\n詳細な説明や具体例を含めて丁寧に回答してください。",
+}
+# chat 形式のメッセージ 1 件ごと・応答の開始に加わるトークン
+TOKENS_PER_MESSAGE = 3
+REPLY_PRIMING_TOKENS = 3
+
+
+class TokenCounter:
+    def __init__(self, model=None):
+        self.model = model or PROMPT_MODEL
+        self._encoding = None
+        if tiktoken is not None:
+            # 符号化表は初回にダウンロードされる。オフラインで取れなければ概算で数える
+            try:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print("⚠️ tiktoken の符号化表を読み込めないため、トークン数は概算で数えます:", e)
+                self._encoding = None
+        self.name = self._encoding.name if self._encoding else "estimate"
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # 概算: 日本語などの非 ASCII は 1 文字 1 トークン、ASCII は 4 文字 1 トークン（どちらもやや多めに見積もる）
+        non_ascii = sum(1 for ch in text if ord(ch) > 0x7F)
+        ascii_chars = sum(1 for ch in text if ord(ch) <= 0x7F and not ch.isspace())
+        return non_ascii + math.ceil(ascii_chars / 4)
+
+
+def similarity(a, b):
+    # 文字 n-gram の集合の Jaccard 係数
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class PromptBuilder:
+    def __init__(self, system_prompt, context_tokens=None, max_faq=None, max_references=None,
+                 dedup_threshold=None, counter=None):
+        self.system_prompt = system_prompt
+        self.context_tokens = PROMPT_CONTEXT_TOKENS if context_tokens is None else context_tokens
+        self.max_faq = PROMPT_MAX_FAQ if max_faq is None else max_faq
+        self.max_references = PROMPT_MAX_REFERENCES if max_references is None else max_references
+        self.dedup_threshold = PROMPT_DEDUP_THRESHOLD if dedup_threshold is None else dedup_threshold
+        self.counter = counter or TokenCounter()
+
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.dropped = {"duplicate": 0, "budget": 0, "limit": 0}
+        self._lock = threading.Lock()
+        self._system_tokens = {}  # mode → system プロンプトのトークン数
+
+    def system_for(self, mode):
+        return self.system_prompt + MODE_INSTRUCTIONS.get(mode, "")
+
+    def _system_tokens_for(self, mode):
+        tokens = self._system_tokens.get(mode)
+        if tokens is None:
+            tokens = self._system_tokens[mode] = self.counter.count(self.system_for(mode))
+        return tokens
+
+    def pack(self, context, film_info_text=""):
+        """関連度の高い順の候補から、予算内に入れるものを選ぶ。返り値は (選んだ候補, 除いた理由ごとの件数)。
+
+        context の各要素は {"source": "faq" | "knowledge", "text": プロンプトに入れる文, "body": 重複判定に使う文}。
+        製品フィルム情報は質問の語句から引いた確かな情報なので、最初の候補として扱う。
+        """
+        candidates = list(context)
+        if film_info_text.strip():
+            candidates.insert(0, {"source": "film", "text": film_info_text, "body": film_info_text})
+
+        selected = []
+        seen = []
+        dropped = {"duplicate": 0, "budget": 0, "limit": 0}
+        used = 0
+        counts = {"faq": 0, "knowledge": 0}
+        limits = {"faq": self.max_faq, "knowledge": self.max_references}
+        for item in candidates:
+            source = item["source"]
+            grams = set(char_ngrams(item.get("body") or item["text"]))
+            if any(similarity(grams, other) >= self.dedup_threshold for other in seen):
+                dropped["duplicate"] += 1
+                continue
+            if source in limits and counts[source] >= limits[source]:
+                dropped["limit"] += 1
+                continue
+            tokens = self.counter.count(item["text"])
+            if used + tokens > self.context_tokens:
+                dropped["budget"] += 1
+                continue
+            used += tokens
+            seen.append(grams)
+            selected.append(dict(item, tokens=tokens))
+            if source in counts:
+                counts[source] += 1
+        return selected, dropped
+
+    def build(self, user_q, context, film_info_text="", mode="default"):
+        # 回答に使えるコンテキストが一つもなければ None
+        if not context and not film_info_text.strip():
+            return None
+
+        selected, dropped = self.pack(context, film_info_text)
+        if not selected:
+            # 候補がすべて予算・重複で落ちた場合も、コンテキストなしでは回答させない
+            self._count_dropped(dropped)
+            return None
+        faq_context = [item["text"] for item in selected if item["source"] == "faq"]
+        references = [item["text"] for item in selected if item["source"] != "faq"]
+
+        faq_part = "\n\n".join(faq_context) if faq_context else NO_FAQ_TEXT
+        ref_texts = [text for text in references if FILM_INFO_MARK in text]
+        other_refs = [text for text in references if FILM_INFO_MARK not in text]
+        ref_part = "\n".join(ref_texts + other_refs)
+
+        prompt = f"""以下は当社のFAQおよび参考情報です。これらを参考に、ユーザーの質問に製造元の立場でご回答ください。
+
+【FAQ】
+{faq_part}
+
+【参考情報】
+{ref_part}
+
+ユーザーの質問: {user_q}
+回答："""
+
+        messages = [
+            {"role": "system", "content": self.system_for(mode)},
+            {"role": "user", "content": prompt},
+        ]
+        system_tokens = self._system_tokens_for(mode)
+        user_tokens = self.counter.count(prompt)
+        total = system_tokens + user_tokens + 2 * TOKENS_PER_MESSAGE + REPLY_PRIMING_TOKENS
+        context_tokens = sum(item["tokens"] for item in selected)
+        self._observe(total, system_tokens, context_tokens, dropped)
+
+        return {
+            "messages": messages,
+            "faq_part": faq_part,
+            "mode": mode,
+            "prompt_tokens": total,
+            "context_tokens": context_tokens,
+            "context_used": len(selected),
+            "context_dropped": dropped,
+        }
+
+    def _observe(self, total, system_tokens, context_tokens, dropped):
+        metrics.PROMPT_TOKENS.observe(total, part="total")
+        metrics.PROMPT_TOKENS.observe(system_tokens, part="system")
+        metrics.PROMPT_TOKENS.observe(context_tokens, part="context")
+        self._count_dropped(dropped)
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += total
+
+    def _count_dropped(self, dropped):
+        for reason, count in dropped.items():
+            if count:
+                metrics.PROMPT_CONTEXT_DROPPED.inc(count, reason=reason)
+        with self._lock:
+            for reason, count in dropped.items():
+                self.dropped[reason] += count
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tokenizer": self.counter.name,
+                "context_budget": self.context_tokens,
+                "requests": self.requests,
+                "avg_prompt_tokens": round(self.prompt_tokens / self.requests, 1) if self.requests else 0.0,
+                "dropped": dict(self.dropped),
+            }
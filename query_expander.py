@@ -1,25 +1,31 @@
 import openai
 import os
+from query_rewrite import QueryRewriter, prior_history
 
 # 明示的に APIキー を設定（app.pyで設定済みなら不要）
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def expand_query(user_input, session_history):
-    try:
-        if not session_history:
-            return user_input
-
-        context = session_history[-4:]
-        context_text = "\n".join([f"{m['role']}: {m['content']}" for m in context])
-
-        prompt = [
-            {
-                "role": "system",
-                "content": "あなたは、ユーザーのあいまいな質問を、FAQ検索に最適な形式に言い換えるアシスタントです。意味を変えず、キーワードを補って明確な文章にしてください。"
-            },
-            {
-                "role": "user",
-                "content": f"""以下は直前のやり取りです：
+_async_client = None
+
+def _get_async_client():
+    # 非同期版（asgi_app.py）用のクライアントは初回利用時に生成
+    global _async_client
+    if _async_client is None:
+        _async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _async_client
+
+def build_expand_messages(user_input, session_history):
+    context = session_history[-4:]
+    context_text = "\n".join([f"{m['role']}: {m['content']}" for m in context])
+
+    return [
+        {
+            "role": "system",
+            "content": "あなたは、ユーザーのあいまいな質問を、FAQ検索に最適な形式に言い換えるアシスタントです。意味を変えず、キーワードを補って明確な文章にしてください。"
+        },
+        {
+            "role": "user",
+            "content": f"""以下は直前のやり取りです：
 
 {context_text}
 
@@ -29,18 +35,36 @@ def expand_query(user_input, session_history):
 
 → 言い換え後：
 """
-            }
-        ]
+        }
+    ]
 
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=prompt,
-            temperature=0.3,
-            max_tokens=100
-        )
+def _rewrite(user_input, session_history):
+    response = openai.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=build_expand_messages(user_input, session_history),
+        temperature=0.3,
+        max_tokens=100
+    )
+    return response.choices[0].message.content.strip()
 
-        return response.choices[0].message.content.strip()
+async def _arewrite(user_input, session_history):
+    response = await _get_async_client().chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=build_expand_messages(user_input, session_history),
+        temperature=0.3,
+        max_tokens=100
+    )
+    return response.choices[0].message.content.strip()
+
+# それだけで意味が通る質問は LLM を呼ばず、同じ質問・同じ流れのリライトは再利用する
+rewriter = QueryRewriter("query_expander", _rewrite, _arewrite)
+
+def expand_query(user_input, session_history):
+    if not prior_history(user_input, session_history):
+        return user_input
+    return rewriter.expand(user_input, session_history)
 
-    except Exception as e:
-        print("❌ query_expander error:", e)
+async def aexpand_query(user_input, session_history):
+    if not prior_history(user_input, session_history):
         return user_input
+    return await rewriter.aexpand(user_input, session_history)
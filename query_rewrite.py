@@ -0,0 +1,162 @@
+# query_rewrite.py
+# 質問のリライト（query_expander / expand_reserve_query）の共通部分
+# ・それだけで意味が通る質問（十分な長さ・業務の用語を含む・指示語や省略がない）は LLM を呼ばない
+# ・リライト結果は (質問, 直近 4 件の履歴のダイジェスト) をキーに LRU + TTL でキャッシュする
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from metrics import span
+
+QUERY_REWRITE_CACHE_SIZE = int(os.getenv("QUERY_REWRITE_CACHE_SIZE", "1000"))
+QUERY_REWRITE_CACHE_TTL = int(os.getenv("QUERY_REWRITE_CACHE_TTL", "3600"))
+QUERY_REWRITE_SKIP = os.getenv("QUERY_REWRITE_SKIP", "true").lower() == "true"
+# これより短い質問は省略が多いので、業務の用語を含んでいてもリライトする
+QUERY_REWRITE_MIN_LENGTH = int(os.getenv("QUERY_REWRITE_MIN_LENGTH", "10"))
+HISTORY_TURNS = 4
+
+# 業務の用語（どれかを含めば、質問の対象がはっきりしているとみなす）
+DOMAIN_KEYWORDS = [
+    "予約", "仮押さえ", "キャンセル", "ログイン", "アカウント", "マニュアル", "登録", "カレンダー",
+    "納品", "納期", "配送", "発送", "送料", "見積", "価格", "料金", "支払", "請求",
+    "ロット", "在庫", "資材", "サンプル", "製造", "充填", "挽き", "焙煎", "オプション", "二次加工",
+    "フィルム", "包材", "外装", "印刷", "デザイン", "入稿", "データ", "一括表示", "JAN", "QR",
+    "賞味期限", "ドリップ", "コーヒーバッグ", "ディップ", "X型", "VFR", "増量", "ケース", "入数", "入り数",
+]
+# 前の発言を指す語・省略を示す言い回し（これがあれば履歴を踏まえたリライトが必要）
+REFERRING_WORDS = [
+    "それ", "これ", "その", "この", "あの", "そちら", "こちら", "そっち", "こっち",
+    "同じ", "さっき", "先ほど", "前の", "上記", "上の", "他に", "ほかに", "他の", "ほかの", "残り",
+]
+ELLIPSIS_PREFIXES = ["では", "じゃあ", "じゃ", "なら", "それなら", "あと", "また", "ちなみに", "で、", "それと"]
+_ELLIPSIS_SUFFIX = re.compile(r"(は|も|って|とか|の場合|なら)[?？]?$")
+
+
+def normalize_question(text):
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def prior_history(question, history):
+    # セッション履歴には今回の質問も追加済みなので、それを除いた「前のやり取り」
+    history = list(history or [])
+    if history and history[-1].get("role") == "user" and history[-1].get("content") == question:
+        history = history[:-1]
+    return history
+
+
+def history_digest(history):
+    # リライトのプロンプトに渡すのと同じ直近 HISTORY_TURNS 件
+    context = [(m.get("role"), m.get("content")) for m in (history or [])[-HISTORY_TURNS:]]
+    return hashlib.sha256(json.dumps(context, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def is_self_contained(question):
+    """それだけで検索できる質問か（長さ・業務の用語・指示語や省略の有無で判定）。"""
+    text = normalize_question(question)
+    if len(text) < QUERY_REWRITE_MIN_LENGTH:
+        return False
+    if not any(word.lower() in text.lower() for word in DOMAIN_KEYWORDS):
+        return False
+    if any(word in text for word in REFERRING_WORDS):
+        return False
+    if any(text.startswith(prefix) for prefix in ELLIPSIS_PREFIXES):
+        return False
+    return not _ELLIPSIS_SUFFIX.search(text)
+
+
+class QueryRewriter:
+    def __init__(self, name, rewrite, arewrite=None, max_entries=None, ttl=None, skip=None):
+        # rewrite(question, history) -> str（失敗時は例外を投げる）。arewrite はその非同期版
+        self.name = name
+        self.rewrite = rewrite
+        self.arewrite = arewrite
+        self.max_entries = max_entries or QUERY_REWRITE_CACHE_SIZE
+        self.ttl = QUERY_REWRITE_CACHE_TTL if ttl is None else ttl
+        self.skip = QUERY_REWRITE_SKIP if skip is None else skip
+
+        self.requests = 0
+        self.skipped = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (リライト結果, 保存時刻)
+
+    def _key(self, question, history):
+        return (normalize_question(question), history_digest(history))
+
+    def _lookup(self, question, history):
+        # (結果, キー)。結果が None ならリライトが必要
+        with self._lock:
+            self.requests += 1
+            if self.skip and is_self_contained(question):
+                self.skipped += 1
+                return question, None
+            key = self._key(question, history)
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], None
+            self.misses += 1
+            return None, key
+
+    def _store(self, key, rewritten):
+        with self._lock:
+            self._entries[key] = (rewritten, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _failed(self, error):
+        with self._lock:
+            self.errors += 1
+        print(f"❌ {self.name} error:", error)
+
+    def expand(self, question, history):
+        result, key = self._lookup(question, history)
+        if result is not None:
+            return result
+        try:
+            with span("rewrite"):
+                rewritten = self.rewrite(question, history)
+        except Exception as e:
+            # 失敗時は元の質問で検索を続ける（キャッシュはしない）
+            self._failed(e)
+            return question
+        self._store(key, rewritten)
+        return rewritten
+
+    async def aexpand(self, question, history):
+        result, key = self._lookup(question, history)
+        if result is not None:
+            return result
+        try:
+            with span("rewrite"):
+                rewritten = await self.arewrite(question, history)
+        except Exception as e:
+            self._failed(e)
+            return question
+        self._store(key, rewritten)
+        return rewritten
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "requests": self.requests,
+                "skipped": self.skipped,
+                "hits": self.hits,
+                "llm_calls": self.misses,
+                "errors": self.errors,
+                "skip_rate": round(self.skipped / self.requests, 4) if self.requests else 0.0,
+                "hit_rate": round(self.hits / (self.requests - self.skipped), 4) if self.requests > self.skipped else 0.0,
+            }
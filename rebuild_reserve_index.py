@@ -1,59 +1,24 @@
 import os
-import json
-import numpy as np
-import faiss
-import openai
 from dotenv import load_dotenv
 
-# === 初期設定 ===
+# === 初期設定（各モジュールは import 時に環境変数を読むので、.env を先に読み込む）===
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# === パス設定（予約用） ===
-FAQ_PATH = "data/reserve_faq.json"
-KNOWLEDGE_PATH = "data/reserve_knowledge.json"
-VECTOR_PATH = "data/reserve_vector_data.npy"
-INDEX_PATH = "data/reserve_index.faiss"
-EMBED_MODEL = "text-embedding-3-small"
+from embedding_cache import EmbeddingCache
+from embedding_provider import get_provider
+from knowledge_base import rebuild_store
 
-# === Embedding取得関数 ===
-def get_embedding(text):
-    response = openai.embeddings.create(
-        model=EMBED_MODEL,
-        input=text
-    )
-    return np.array(response.data[0].embedding, dtype="float32")
+# === Embedding取得（EMBED_PROVIDER: openai / local。バッチ・リトライ・キャッシュ対応） ===
+embedding_provider = get_provider()
+embedding_cache = EmbeddingCache(embedding_provider.model, embedding_provider.dimensions)
 
-# === データ読み込み ===
-with open(FAQ_PATH, "r", encoding="utf-8") as f:
-    faq_items = json.load(f)
-faq_questions = [item["question"] for item in faq_items]
-
-with open(KNOWLEDGE_PATH, "r", encoding="utf-8") as f:
-    knowledge_data = json.load(f)
-
-# reserve_knowledge.json は list 構造（title, content）を想定
-if isinstance(knowledge_data, list):
-    knowledge_contents = [
-        f"{item['title']}：{item['content']}" for item in knowledge_data
-    ]
-else:
-    raise ValueError("reserve_knowledge.json の形式が不正です。")
-
-# === コーパス構築 ===
-search_corpus = faq_questions + knowledge_contents
-
-# === ベクトル生成 & インデックス構築 ===
+# === ベクトル化 & FAISS保存（全件再構築）===
+# ベクトルストアは全コーパス共通なので、通常用・予約用の行をまとめて作り直す
 print("🔄 予約用ベクトル生成中...")
-vector_data = np.array([get_embedding(text) for text in search_corpus], dtype="float32")
-
-print("🧠 FAISSインデックス作成...")
-index = faiss.IndexFlatL2(vector_data.shape[1])
-index.add(vector_data)
-
-# === 保存 ===
-print("💾 ファイル保存中...")
-np.save(VECTOR_PATH, vector_data)
-faiss.write_index(index, INDEX_PATH)
+rebuild_store(
+    lambda texts: embedding_cache.embed(texts, embedding_provider.embed),
+    full=True,
+    embedding=embedding_provider.info(),
+)
 
 print("✅ 予約用インデックスの再構築が完了しました。")
@@ -0,0 +1,453 @@
+# scripts/benchmark.py
+# リクエスト処理のうち CPU で完結する部分のマイクロベンチマーク
+# ・キーワード抽出、製品フィルム照合（match + format_match_info）、コンテキストの組み立て（build_context / build_prompt）、
+#   セッション履歴の更新と掃除（SESSION_BACKEND の保存先）、コーパスの振り分け、ベクトル検索（名前空間つき）、
+#   検索（hybrid）を、実際の日本語の質問で計測する
+# ・--scales 1,10,100 で、キーワード語彙・製品フィルム行列・コーパス・同時セッション数を 10 倍・100 倍にして同じ計測を行い、
+#   どの処理が規模に比例しなくなるか（最初に伸びなくなるか）を倍率で示す
+# ・拡大したコーパスの各行のベクトルは、元の行の（保存済みの）ベクトルに小さなノイズを加えたもの。
+#   インデックスは VECTOR_BACKEND / VECTOR_STORAGE の設定で一時ディレクトリに作る（data/ は書き換えない）
+# ・結果は JSON で保存する。--baseline で前回の結果と比べ、p50 が --threshold を超えて遅くなった項目を回帰として示す
+#
+# 実行例:
+#   python scripts/benchmark.py
+#   python scripts/benchmark.py --scales 1,10 --baseline .cache/benchmarks/benchmark-20260101-000000.json --fail-on-regression
+import os
+import sys
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "scripts"))
+
+import numpy as np
+import faiss
+
+from fake_services import fake_google_credentials
+import keyword_filter
+from keyword_filter import KeywordExtractor, KEYWORD_DICTIONARY_PATH
+from product_film_matcher import ProductFilmMatcher
+from knowledge_base import (
+    CORPORA, FUSION_CANDIDATES, RETRIEVAL_MODE, KnowledgeBase, KnowledgeSnapshot, build_corpus, load_json, read_metadata,
+)
+from vector_backend import VECTOR_BACKEND, VECTOR_STORAGE
+from vector_store import VectorStore, unique_rows
+
+RESULTS_DIR = ".cache/benchmarks"
+MATRIX_PATH = "data/product_film_color_matrix.json"
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+PRODUCT_SUFFIXES = ["型", "タイプ", "パック", "バッグ", "増量タイプ"]
+FILM_SUFFIXES = ["フィルム", "光沢フィルム", "マットフィルム", "包材", "特殊紙"]
+COLOR_SUFFIXES = ["", "ブルー", "グレー", "ピンク"]
+QUESTION_TEMPLATES = [
+    "{product}で{film}に{color}の印刷はできますか？",
+    "{product}で使えるフィルムを教えてください",
+    "{film}はどの製品で使えますか？",
+    "{color}で印刷できるフィルムはありますか？",
+    "{product}で{color}の印刷ができるフィルムは？",
+    "{product}の{film}だと、印刷色は何色から選べますか？",
+]
+# 拡大したコーパスの行に付ける印（行のテキストを重複させないため）
+VARIANT_MARK = "（事例{n}）"
+VARIANT_PATTERN = re.compile(r"（事例\d+）")
+# 拡大した行のベクトルに加えるノイズ（元のベクトルは L2 正規化済み。ノイズのノルムがおよそこの値になる）
+VARIANT_NOISE = 0.3
+SESSION_BASE = 1000
+
+
+def synthetic_names(rng, count, suffixes, taken):
+    # 実在しない製品・フィルム・色の名前（カタカナ 2〜4 文字 + 種類ごとの語尾）
+    names = []
+    while len(names) < count:
+        name = "".join(rng.choice(KATAKANA) for _ in range(rng.randint(2, 4))) + rng.choice(suffixes)
+        if name not in taken:
+            taken.add(name)
+            names.append(name)
+    return names
+
+
+def scaled_vocabulary(dictionary, scale, rng):
+    # 製品・フィルム・色の語彙を scale 倍にする（元の語彙と表記ゆれの正規化はそのまま残す）
+    taken = {w for c, words in dictionary.items() if c != "normalize" for w in words}
+    result = {"normalize": dict(dictionary.get("normalize", {}))}
+    for category, suffixes in (("product", PRODUCT_SUFFIXES), ("film", FILM_SUFFIXES), ("color", COLOR_SUFFIXES)):
+        words = list(dictionary.get(category, []))
+        result[category] = words + synthetic_names(rng, len(words) * (scale - 1), suffixes, taken)
+    for category in dictionary:
+        result.setdefault(category, list(dictionary[category]))
+    return result
+
+
+def scaled_matrix(matrix, vocabulary, scale, rng):
+    # 製品 × フィルム × 色の行列を scale 倍にする。追加の製品は、元の製品と同じくらいの数のフィルム・色を持つ
+    result = {product: dict(films) for product, films in matrix.items()}
+    if scale == 1:
+        return result
+    films_per_product = max(1, round(np.mean([len(films) for films in matrix.values()])))
+    colors_per_film = max(1, round(np.mean([len(c) for films in matrix.values() for c in films.values()])))
+    films = list(dict.fromkeys([f for fs in matrix.values() for f in fs] + vocabulary["film"]))
+    colors = list(dict.fromkeys([c for fs in matrix.values() for cs in fs.values() for c in cs] + vocabulary["color"]))
+    for product in vocabulary["product"]:
+        if product in result:
+            continue
+        result[product] = {
+            film: rng.sample(colors, min(colors_per_film, len(colors)))
+            for film in rng.sample(films, min(films_per_product, len(films)))
+        }
+    return result
+
+
+def question_pool(vocabulary, matrix, faq_questions, rng, size):
+    # 半分は製品・フィルム・色を含む質問（行列にある組み合わせ）、残りは実際の FAQ の質問
+    products = list(matrix)
+    questions = []
+    while len(questions) < size // 2:
+        product = rng.choice(products)
+        film = rng.choice(list(matrix[product]) or vocabulary["film"])
+        color = rng.choice(matrix[product].get(film) or vocabulary["color"])
+        questions.append(rng.choice(QUESTION_TEMPLATES).format(product=product, film=film, color=color))
+    questions += [rng.choice(faq_questions) for _ in range(size - len(questions))]
+    rng.shuffle(questions)
+    return questions
+
+
+def scaled_corpus_files(workdir, scale):
+    # 各コーパスの FAQ・ナレッジを scale 倍にして書き出し、CORPORA と同じ形の設定を返す
+    corpora = {}
+    for name, cfg in CORPORA.items():
+        faq_items = load_json(cfg["faq_path"])
+        knowledge = load_json(cfg["knowledge_path"])
+        if isinstance(knowledge, list):
+            knowledge = {item["title"]: [item["content"]] for item in knowledge}
+        scaled_faq = list(faq_items)
+        scaled_knowledge = dict(knowledge)
+        for n in range(1, scale):
+            mark = VARIANT_MARK.format(n=n)
+            scaled_faq += [dict(item, question=item.get("question", "") + mark) for item in faq_items]
+            scaled_knowledge.update({category + mark: texts for category, texts in knowledge.items()})
+        paths = {
+            "faq_path": os.path.join(workdir, f"{name}_faq.json"),
+            "knowledge_path": os.path.join(workdir, f"{name}_knowledge.json"),
+            "metadata_path": cfg["metadata_path"],
+            "faq_text": cfg["faq_text"],
+        }
+        for path, data in ((paths["faq_path"], scaled_faq), (paths["knowledge_path"], scaled_knowledge)):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        corpora[name] = paths
+    return corpora
+
+
+def variant_embedder(base_store, seed):
+    # 拡大した行のテキスト → 元の行のベクトル + ノイズ（元の行はそのまま）
+    def embed(texts):
+        rng = np.random.default_rng(seed)
+        bases = [VARIANT_PATTERN.sub("", t, count=1) for t in texts]
+        ids = base_store.ids_for(bases)
+        vectors = np.zeros((len(texts), base_store.dimension), dtype="float32")
+        known = [i for i, doc_id in enumerate(ids) if doc_id >= 0]
+        if known:
+            vectors[known] = base_store.vectors_for([ids[i] for i in known])
+        for i, (text, base) in enumerate(zip(texts, bases)):
+            if ids[i] < 0 or text != base:
+                noise = rng.normal(0.0, VARIANT_NOISE / np.sqrt(base_store.dimension), base_store.dimension)
+                vector = vectors[i] + noise.astype("float32")
+                vectors[i] = vector / (np.linalg.norm(vector) or 1.0)
+        return vectors
+
+    return embed
+
+
+def build_snapshot(workdir, scale, base_store, seed):
+    # scale 倍のコーパスで、アプリと同じ構成の 1 世代（ストア・通常用・予約用・振り分け）を作る
+    os.makedirs(workdir, exist_ok=True)
+    corpora = scaled_corpus_files(workdir, scale)
+    keys, texts = unique_rows(
+        build_corpus(load_json(cfg["faq_path"]), load_json(cfg["knowledge_path"]), read_metadata(cfg["metadata_path"]), cfg["faq_text"])
+        for cfg in corpora.values()
+    )
+    store = VectorStore(
+        index_path=os.path.join(workdir, "index.faiss"),
+        vector_path=os.path.join(workdir, "vectors.npy"),
+        texts=texts,
+        keys=keys,
+        embed=variant_embedder(base_store, seed),
+    )
+    general = KnowledgeBase("general", store, **corpora["general"])
+    reserve = KnowledgeBase("reserve", store, **corpora["reserve"])
+    return KnowledgeSnapshot(store, general, reserve, f"bench-{scale}x")
+
+
+def query_vectors(snapshot, questions, seed):
+    # 実際の FAQ の質問のベクトルにノイズを加えたもの（言い回しの違う質問の代わり）
+    rng = np.random.default_rng(seed)
+    store = snapshot.store
+    base = store.vectors_for(store.ids_for(questions))
+    noise = rng.normal(0.0, VARIANT_NOISE / np.sqrt(store.dimension), base.shape).astype("float32")
+    vectors = base + noise
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def measure(fn, inputs, min_time, min_rounds):
+    # inputs を 1 巡するのを 1 ラウンドとして、min_time 秒かつ min_rounds ラウンド以上繰り返す。1 回ごとの所要時間を集める
+    for item in inputs[: max(1, len(inputs) // 10)]:
+        fn(item)
+    samples = []
+    started = time.perf_counter()
+    rounds = 0
+    while rounds < min_rounds or time.perf_counter() - started < min_time:
+        for item in inputs:
+            t0 = time.perf_counter()
+            fn(item)
+            samples.append(time.perf_counter() - t0)
+        rounds += 1
+    samples = np.asarray(samples) * 1e6
+    return {
+        "ops": int(len(samples)),
+        "mean_us": round(float(samples.mean()), 3),
+        "p50_us": round(float(np.percentile(samples, 50)), 3),
+        "p95_us": round(float(np.percentile(samples, 95)), 3),
+        "p99_us": round(float(np.percentile(samples, 99)), 3),
+        "ops_per_sec": round(float(1e6 / samples.mean()), 1),
+    }
+
+
+def import_app(workdir):
+    # build_context / build_prompt は app.py の関数をそのまま使う
+    # （外部 API は呼ばない。読み込みに必要な認証情報はダミー、キャッシュ類は一時ディレクトリ）
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    os.environ.setdefault("GOOGLE_CREDENTIALS", fake_google_credentials("http://127.0.0.1:9/token"))
+    os.environ["EMBED_CACHE_DIR"] = os.path.join(workdir, "embeddings")
+    os.environ["SHEETS_SPOOL_PATH"] = os.path.join(workdir, "sheets_spool.jsonl")
+    os.environ["SESSION_SQLITE_PATH"] = os.path.join(workdir, "sessions.sqlite3")
+    os.environ["RELOAD_WATCH_INTERVAL"] = "0"
+    import app
+    return app
+
+
+def run_scale(scale, args, app, base_store, dictionary, matrix, faq_questions, workdir):
+    rng = random.Random(args.seed + scale)
+    results = {}
+
+    def record(name, stats, size):
+        stats.update({"name": name, "scale": scale, "size": size})
+        results[name] = stats
+        print(f"  {name:<18}{scale:>5}×  p50 {stats['p50_us']:>10.1f} µs  p95 {stats['p95_us']:>10.1f} µs  （{size}）")
+
+    # --- キーワード抽出（語彙 scale 倍） ---
+    vocabulary = scaled_vocabulary(dictionary, scale, rng)
+    vocab_size = sum(len(vocabulary[c]) for c in ("product", "film", "color"))
+    scaled = scaled_matrix(matrix, vocabulary, scale, rng)
+    questions = question_pool(vocabulary, scaled, faq_questions, rng, args.questions)
+    record("keyword_compile", measure(KeywordExtractor, [vocabulary], args.min_time, 3), f"語彙 {vocab_size} 語")
+    extractor = KeywordExtractor(vocabulary)
+    record("keyword_extract", measure(extractor.extract, questions, args.min_time, args.rounds), f"語彙 {vocab_size} 語")
+
+    # --- 製品フィルム照合（行列 scale 倍。match が使う抽出器も同じ語彙にする） ---
+    matrix_path = os.path.join(workdir, f"matrix_{scale}.json")
+    with open(matrix_path, "w", encoding="utf-8") as f:
+        json.dump(scaled, f, ensure_ascii=False)
+    pairs = sum(len(films) for films in scaled.values())
+    record("matcher_compile", measure(ProductFilmMatcher, [matrix_path], args.min_time, 3), f"製品×フィルム {pairs} 組")
+    matcher = ProductFilmMatcher(matrix_path)
+    saved_extractor = keyword_filter._extractor
+    keyword_filter._extractor = extractor
+    try:
+        record(
+            "matcher_match",
+            measure(lambda q: matcher.format_match_info(matcher.match(q, [])), questions, args.min_time, args.rounds),
+            f"製品×フィルム {pairs} 組",
+        )
+    finally:
+        keyword_filter._extractor = saved_extractor
+
+    # --- セッション履歴（同時セッション数 scale 倍。保存先は SESSION_BACKEND） ---
+    # （session_store は import_app で一時ディレクトリを設定した後に読み込む）
+    from session_store import SESSION_BACKEND, get_session_store
+    live = SESSION_BASE * scale
+    options = {"path": os.path.join(workdir, f"sessions_{scale}.sqlite3")} if SESSION_BACKEND == "sqlite" else {}
+    sessions = get_session_store(max_entries=live, sweep_interval=0, **options)
+    sessions.clear()
+    for i in range(live):
+        sessions.append(f"bench-{i}", "user", questions[i % len(questions)])
+    session_ids = [f"bench-{rng.randrange(live)}" for _ in range(args.questions)]
+
+    def session_turn(sid):
+        # /chat の 1 ターン分（質問の追記 → 履歴の読み出し → 回答の追記）
+        sessions.append(sid, "user", "X型で使えるフィルムを教えてください")
+        sessions.history(sid)
+        sessions.append(sid, "assistant", "白光沢フィルム・白マットフィルムなどがご利用いただけます。")
+
+    record("session_history", measure(session_turn, session_ids, args.min_time, args.rounds), f"セッション {live} 件 / {sessions.name}")
+    record("session_sweep", measure(lambda _: sessions.sweep(), [None], args.min_time, 3), f"セッション {live} 件 / {sessions.name}")
+    sessions.clear()
+
+    # --- 検索（コーパス scale 倍） ---
+    snapshot = build_snapshot(os.path.join(workdir, f"corpus_{scale}"), scale, base_store, args.seed)
+    general = snapshot.general
+    rows = snapshot.store.ntotal
+    faq_sample = [rng.choice(general.faq_questions[: len(faq_questions)]) for _ in range(args.questions)]
+    vectors = query_vectors(snapshot, faq_sample, args.seed)
+    queries = list(zip(vectors, faq_sample))
+    k = 7
+
+    record("route", measure(lambda item: snapshot.router.route(item[0]), queries, args.min_time, args.rounds), f"{rows} 行")
+    record(
+        "vector_search",
+        measure(lambda item: snapshot.store.search(item[0], k * FUSION_CANDIDATES, "general"), queries, args.min_time, args.rounds),
+        f"{rows} 行 / {snapshot.store.backend.name}",
+    )
+    record("search_both", measure(lambda item: snapshot.search_both(item[0], k * FUSION_CANDIDATES), queries, args.min_time, args.rounds), f"{rows} 行")
+    record(
+        "retrieve",
+        measure(lambda item: general.retrieve(item[0], item[1], k=k), queries, args.min_time, args.rounds),
+        f"{rows} 行 / {RETRIEVAL_MODE}",
+    )
+
+    # --- コンテキストの組み立て（検索結果 I[0] の各行 → FAQ / 参考知識、プロンプト） ---
+    hits = [(general.retrieve(v, q, k=k)[1], q) for v, q in queries]
+    record("build_context", measure(lambda item: app.build_context(item[0], general), hits, args.min_time, args.rounds), f"{rows} 行")
+    contexts = [(app.build_context(I, general), q) for I, q in hits]
+    record(
+        "build_prompt",
+        measure(lambda item: app.build_prompt(item[1], item[0], ""), contexts, args.min_time, args.rounds),
+        f"{rows} 行",
+    )
+    del snapshot, general
+    shutil.rmtree(os.path.join(workdir, f"corpus_{scale}"), ignore_errors=True)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=ROOT).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "faiss": getattr(faiss, "__version__", ""),
+        "vector_backend": VECTOR_BACKEND,
+        "vector_storage": VECTOR_STORAGE,
+        "retrieval_mode": RETRIEVAL_MODE,
+    }
+
+
+def scaling_report(results, scales):
+    # 1 倍に対する p50 の倍率。規模の倍率より大きく伸びているものほど先に伸びなくなる
+    base_scale = min(scales)
+    rows = []
+    names = list(dict.fromkeys(r["name"] for r in results))
+    for name in names:
+        by_scale = {r["scale"]: r for r in results if r["name"] == name}
+        base = by_scale.get(base_scale)
+        if not base:
+            continue
+        ratios = {s: round(by_scale[s]["p50_us"] / base["p50_us"], 2) for s in scales if s in by_scale and base["p50_us"] > 0}
+        rows.append({"name": name, "p50_us": {s: by_scale[s]["p50_us"] for s in by_scale}, "ratio": ratios})
+    largest = max(scales)
+    rows.sort(key=lambda r: -r["ratio"].get(largest, 0))
+    return rows
+
+
+def compare(results, baseline, threshold):
+    # 前回の結果と (項目, 規模) ごとに p50 を比べる
+    previous = {(r["name"], r["scale"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        old = previous.get((r["name"], r["scale"]))
+        if not old or old["p50_us"] <= 0:
+            continue
+        change = r["p50_us"] / old["p50_us"] - 1
+        if change > threshold:
+            regressions.append({
+                "name": r["name"], "scale": r["scale"],
+                "baseline_p50_us": old["p50_us"], "p50_us": r["p50_us"], "change": round(change, 3),
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU で完結する処理のマイクロベンチマーク（規模を変えて計測）")
+    parser.add_argument("--scales", default="1,10,100", help="語彙・行列・コーパス・セッション数の倍率（カンマ区切り）")
+    parser.add_argument("--questions", type=int, default=200, help="1 ラウンドで使う質問の数")
+    parser.add_argument("--rounds", type=int, default=5, help="最低ラウンド数")
+    parser.add_argument("--min-time", type=float, default=0.5, help="各項目の最低計測時間（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help=f"結果の JSON（既定: {RESULTS_DIR}/benchmark-<日時>.json）")
+    parser.add_argument("--baseline", help="比較する前回の結果（JSON）")
+    parser.add_argument("--threshold", type=float, default=0.25, help="p50 がこの割合を超えて遅くなったら回帰とする")
+    parser.add_argument("--fail-on-regression", action="store_true", help="回帰があれば終了コード 1 で終わる")
+    args = parser.parse_args()
+    scales = sorted({int(s) for s in args.scales.split(",") if s.strip()})
+
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        app = import_app(workdir)
+        base_store = app.knowledge.snapshot().store
+        with open(KEYWORD_DICTIONARY_PATH, "r", encoding="utf-8") as f:
+            dictionary = json.load(f)
+        with open(MATRIX_PATH, "r", encoding="utf-8") as f:
+            matrix = json.load(f)
+        faq_questions = load_json(CORPORA["general"]["faq_path"])
+        faq_questions = [item["question"] for item in faq_questions if item.get("question")]
+
+        results = []
+        for scale in scales:
+            print(f"\n▶️ {scale} 倍")
+            results += run_scale(scale, args, app, base_store, dictionary, matrix, faq_questions, workdir).values()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "config": vars(args),
+        "results": results,
+        "scaling": scaling_report(results, scales),
+    }
+
+    if len(scales) > 1:
+        print(f"\n📈 p50 の倍率（{min(scales)} 倍に対して。大きい順）")
+        for row in report["scaling"]:
+            print(f"  {row['name']:<18}" + "".join(f"{s:>6}×: {row['ratio'].get(s, '-'):>8}" for s in scales))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        report["baseline"] = {"path": args.baseline, "commit": baseline.get("environment", {}).get("commit"), "threshold": args.threshold}
+        report["regressions"] = regressions
+        if regressions:
+            print(f"\n⚠️ 回帰 {len(regressions)} 件（p50 が {args.threshold:.0%} を超えて悪化）")
+            for r in regressions:
+                print(f"  {r['name']} {r['scale']}×: {r['baseline_p50_us']} → {r['p50_us']} µs（+{r['change']:.0%}）")
+        else:
+            print(f"\n✅ 回帰はありません（基準: {args.baseline}）")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 結果を保存しました: {output}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+# scripts/fake_services.py
+# 負荷試験用のローカルのスタンドイン（OpenAI の埋め込み・チャット補完 / Google の OAuth トークン・Sheets 追記 / Redis）
+# ・OPENAI_BASE_URL と SHEETS_API_ENDPOINT をこのサーバーに向ければ、認証情報なしでアプリ全体を動かせる
+# ・エンドポイントごとに応答の遅延（平均とゆらぎ）とエラー率を設定できる
+# ・埋め込みは文字 n-gram のハッシュ射影（embedding_provider の local と同じ）。決定的で、似た文は近いベクトルになる
+# ・FakeRedis は会話履歴の共有（SESSION_BACKEND=redis）に使うコマンドだけを持つ Redis プロトコルのサーバー
+#
+# 単体での起動例: python scripts/fake_services.py --port 18080 --chat-latency-ms 800 --error-rate 0.01
+import os
+import sys
+import re
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# リポジトリ直下のモジュールを import できるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embedding_provider import LocalEmbeddingProvider
+
+FAKE_ANSWER = "ご質問ありがとうございます。負荷試験用の回答です。詳しくはお問い合わせフォームよりご連絡ください。"
+ENDPOINTS = ("embeddings", "chat", "sheets", "token")
+# query_expander / expand_reserve_query のリライト用プロンプトに埋め込まれた元の質問
+REWRITE_QUESTION = re.compile(r"ユーザーの質問：「(.*?)」", re.S)
+
+
+class Behavior:
+    # エンドポイントごとの遅延（ミリ秒）・ゆらぎ（割合）・エラー率
+    def __init__(self, latency_ms=0.0, jitter=0.2, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def wait(self):
+        if self.latency_ms > 0:
+            spread = self.latency_ms * self.jitter
+            time.sleep(max(0.0, random.uniform(self.latency_ms - spread, self.latency_ms + spread)) / 1000)
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class FakeServices:
+    def __init__(self, host="127.0.0.1", port=0, behaviors=None, stream_chunks=8):
+        self.behaviors = {name: Behavior() for name in ENDPOINTS}
+        self.behaviors.update(behaviors or {})
+        self.stream_chunks = stream_chunks
+        self.embedder = LocalEmbeddingProvider()
+        self.calls = {name: 0 for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+        self.sheet_rows = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name, failed=False, rows=0):
+        with self._lock:
+            self.calls[name] += 1
+            if failed:
+                self.errors[name] += 1
+            self.sheet_rows += rows
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors), "sheet_rows": self.sheet_rows}
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _json(self, status, data):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _fail(self, name):
+                services.count(name, failed=True)
+                # OpenAI SDK・googleapiclient のどちらも 500 を一時的なエラーとして扱う
+                self._json(500, {"error": {"message": f"injected {name} error", "type": "server_error", "code": 500}})
+
+            def do_POST(self):
+                try:
+                    self._handle_post()
+                except (BrokenPipeError, ConnectionResetError):
+                    # 呼び出し側（アプリ）が先に切断した。負荷試験の終了時に起こる
+                    self.close_connection = True
+
+            def _handle_post(self):
+                raw = self._body()
+                path = self.path.split("?", 1)[0]
+                if path.endswith("/embeddings"):
+                    name = "embeddings"
+                elif path.endswith("/chat/completions"):
+                    name = "chat"
+                elif path.endswith(":append"):
+                    name = "sheets"
+                elif path.endswith("/token"):
+                    name = "token"
+                else:
+                    self._json(404, {"error": {"message": f"unknown path {path}"}})
+                    return
+
+                behavior = services.behaviors[name]
+                behavior.wait()
+                if behavior.should_fail():
+                    self._fail(name)
+                    return
+
+                if name == "token":
+                    services.count(name)
+                    self._json(200, {"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600})
+                    return
+
+                data = json.loads(raw or b"{}")
+                if name == "embeddings":
+                    texts = data.get("input")
+                    texts = [texts] if isinstance(texts, str) else texts
+                    vectors = services.embedder.embed(texts)
+                    services.count(name)
+                    self._json(200, {
+                        "object": "list",
+                        "model": data.get("model"),
+                        "data": [{"object": "embedding", "index": i, "embedding": v.tolist()} for i, v in enumerate(vectors)],
+                        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                    })
+                elif name == "chat":
+                    services.count(name)
+                    if data.get("stream"):
+                        self._stream(data)
+                    else:
+                        self._json(200, self._completion(data, FAKE_ANSWER))
+                else:
+                    rows = len(data.get("values", []))
+                    services.count(name, rows=rows)
+                    self._json(200, {"updates": {"updatedRows": rows}})
+
+            def _completion(self, data, answer):
+                # リライト（質問の言い換え）の呼び出しには、プロンプト中の元の質問をそのまま返す
+                messages = data.get("messages") or []
+                question = REWRITE_QUESTION.search(messages[-1].get("content", "")) if messages else None
+                content = question.group(1) if question else answer
+                return {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": data.get("model"),
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }
+
+            def _stream(self, data):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                step = max(1, len(FAKE_ANSWER) // services.stream_chunks)
+                for start in range(0, len(FAKE_ANSWER), step):
+                    chunk = {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": data.get("model"),
+                        "choices": [{"index": 0, "delta": {"content": FAKE_ANSWER[start:start + step]}, "finish_reason": None}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+class FakeRedis:
+    # Redis プロトコル（RESP2）のスタンドイン。セッションの共有（SESSION_BACKEND=redis）に使うコマンドだけを実装する
+    # PING / AUTH / SELECT / RPUSH / LTRIM / LRANGE / EXPIRE / DEL / SCAN / DBSIZE / FLUSHDB / MULTI / EXEC
+    def __init__(self, host="127.0.0.1", port=0):
+        self._data = {}      # キー → list[bytes]
+        self._expires = {}   # キー → 期限（time.time()）
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.server = socketserver.ThreadingTCPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-redis", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _alive(self, key):
+        # 呼び出し側で self._lock を保持していること
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    @staticmethod
+    def _range(items, start, stop):
+        n = len(items)
+        start = max(0, start + n if start < 0 else start)
+        stop = stop + n if stop < 0 else stop
+        return start, min(stop, n - 1)
+
+    def execute(self, args):
+        command = args[0].decode().upper()
+        with self._lock:
+            self.commands += 1
+            if command == "PING":
+                return "+PONG"
+            if command in ("AUTH", "SELECT"):
+                return "+OK"
+            if command == "RPUSH":
+                key = args[1]
+                if not self._alive(key):
+                    self._data[key] = []
+                self._data[key].extend(args[2:])
+                return len(self._data[key])
+            if command == "LTRIM":
+                key = args[1]
+                if self._alive(key):
+                    start, stop = self._range(self._data[key], int(args[2]), int(args[3]))
+                    self._data[key] = self._data[key][start:stop + 1]
+                    if not self._data[key]:
+                        del self._data[key]
+                        self._expires.pop(key, None)
+                return "+OK"
+            if command == "LRANGE":
+                key = args[1]
+                if not self._alive(key):
+                    return []
+                start, stop = self._range(self._data[key], int(args[2]), int(args[3]))
+                return self._data[key][start:stop + 1]
+            if command == "EXPIRE":
+                if not self._alive(args[1]):
+                    return 0
+                self._expires[args[1]] = time.time() + int(args[2])
+                return 1
+            if command == "DEL":
+                removed = sum(1 for key in args[1:] if self._alive(key) and self._data.pop(key, None) is not None)
+                for key in args[1:]:
+                    self._expires.pop(key, None)
+                return removed
+            if command == "SCAN":
+                # 1 回ですべてのキーを返す（カーソルは常に 0）
+                pattern = args[args.index(b"MATCH") + 1] if b"MATCH" in args else b"*"
+                prefix = pattern[:-1] if pattern.endswith(b"*") else None
+                keys = [k for k in list(self._data) if self._alive(k) and (k.startswith(prefix) if prefix is not None else k == pattern)]
+                return [b"0", keys]
+            if command == "DBSIZE":
+                return sum(1 for k in list(self._data) if self._alive(k))
+            if command == "FLUSHDB":
+                self._data.clear()
+                self._expires.clear()
+                return "+OK"
+        return f"-ERR unknown command '{command}'"
+
+    def _handler(self):
+        redis = self
+
+        def encode(reply):
+            if isinstance(reply, str):
+                return (reply + "\r\n").encode()
+            if isinstance(reply, int):
+                return f":{reply}\r\n".encode()
+            if isinstance(reply, bytes):
+                return f"${len(reply)}\r\n".encode() + reply + b"\r\n"
+            if reply is None:
+                return b"$-1\r\n"
+            return f"*{len(reply)}\r\n".encode() + b"".join(encode(r) for r in reply)
+
+        class Handler(socketserver.StreamRequestHandler):
+            def _command(self):
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int(self.rfile.readline()[1:-2])
+                    args.append(self.rfile.read(length + 2)[:-2])
+                return args
+
+            def handle(self):
+                queued = None
+                try:
+                    while True:
+                        args = self._command()
+                        if args is None:
+                            return
+                        name = args[0].decode().upper()
+                        if name == "MULTI":
+                            queued = []
+                            reply = "+OK"
+                        elif name == "EXEC":
+                            reply = [redis.execute(a) for a in (queued or [])]
+                            queued = None
+                        elif queued is not None:
+                            queued.append(args)
+                            reply = "+QUEUED"
+                        else:
+                            reply = redis.execute(args)
+                        self.wfile.write(encode(reply))
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+
+        return Handler
+
+
+def fake_google_credentials(token_uri):
+    # Sheets クライアントの初期化に必要なサービスアカウント鍵（トークンはこのサーバーが発行する）
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ).decode("utf-8")
+    except ImportError:
+        import rsa
+        pem = rsa.newkeys(2048)[1].save_pkcs1().decode("utf-8")
+    info = {
+        "type": "service_account",
+        "project_id": "load-test",
+        "private_key_id": "load-test",
+        "private_key": pem,
+        "client_email": "load-test@load-test.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+    return base64.b64encode(json.dumps(info).encode("utf-8")).decode("ascii")
+
+
+def service_env(services):
+    # アプリをスタンドインに向けるための環境変数
+    return {
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_BASE_URL": f"{services.url}/v1",
+        "GOOGLE_CREDENTIALS": fake_google_credentials(f"{services.url}/token"),
+        "SHEETS_API_ENDPOINT": services.url,
+        "SPREADSHEET_ID": "load-test",
+    }
+
+
+def add_behavior_args(parser):
+    parser.add_argument("--embed-latency-ms", type=float, default=30.0)
+    parser.add_argument("--chat-latency-ms", type=float, default=800.0)
+    parser.add_argument("--sheets-latency-ms", type=float, default=150.0)
+    parser.add_argument("--jitter", type=float, default=0.2, help="遅延のゆらぎ（平均に対する割合）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="全エンドポイント共通のエラー率")
+    parser.add_argument("--embed-error-rate", type=float)
+    parser.add_argument("--chat-error-rate", type=float)
+    parser.add_argument("--sheets-error-rate", type=float)
+
+
+def behaviors_from_args(args):
+    def rate(value):
+        return args.error_rate if value is None else value
+    return {
+        "embeddings": Behavior(args.embed_latency_ms, args.jitter, rate(args.embed_error_rate)),
+        "chat": Behavior(args.chat_latency_ms, args.jitter, rate(args.chat_error_rate)),
+        "sheets": Behavior(args.sheets_latency_ms, args.jitter, rate(args.sheets_error_rate)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI / Google Sheets のローカルスタンドイン")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--redis-port", type=int, default=0, help="指定すると Redis のスタンドインも起動する")
+    add_behavior_args(parser)
+    args = parser.parse_args()
+
+    services = FakeServices(args.host, args.port, behaviors_from_args(args)).start()
+    print(f"🧪 スタンドインを起動しました: {services.url}")
+    for key, value in service_env(services).items():
+        if key != "GOOGLE_CREDENTIALS":
+            print(f"export {key}={value}")
+    redis = FakeRedis(args.host, args.redis_port).start() if args.redis_port else None
+    if redis:
+        print(f"export SESSION_BACKEND=redis\nexport SESSION_REDIS_URL={redis.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        services.stop()
+        if redis:
+            redis.stop()
@@ -1,20 +1,24 @@
 import gspread
 import json
-import time
-import numpy as np
-import openai
-import faiss
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
 import os
+import sys
 
-# .env読み込み（ローカル実行時）
+# リポジトリ直下のモジュールを import できるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# .env読み込み（ローカル実行時。各モジュールは import 時に環境変数を読むので、先に読み込む）
 if os.getenv("GITHUB_ACTIONS") != "true":
     load_dotenv()
 
-# OpenAI APIキー設定
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not openai.api_key:
+from embedding_cache import EmbeddingCache
+from embedding_provider import get_provider
+from knowledge_base import rebuild_store
+
+# 埋め込みの取得先（EMBED_PROVIDER。既定は OpenAI。リトライは provider 側で行う）
+embedding_provider = get_provider()
+if embedding_provider.name == "openai" and not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY is not set.")
 
 # 認証設定
@@ -42,38 +46,19 @@ with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
 
 print(f"✅ {OUTPUT_PATH} を保存しました。")
 
-# ベクトル埋め込み処理
-texts = [f"{title}：{content[0]}" for title, content in knowledge.items()]
-EMBED_MODEL = "text-embedding-3-small"
+# ベクトル埋め込み処理（全コーパス共通のベクトルストア。app.py と同じコーパス定義）
 BATCH_SIZE = 100
 
-def get_embeddings_batch(text_batch, retries=3, delay=3):
-    for attempt in range(retries):
-        try:
-            response = openai.embeddings.create(model=EMBED_MODEL, input=text_batch)
-            return [np.array(d.embedding, dtype="float32") for d in response.data]
-        except openai.error.OpenAIError as e:
-            print(f"⚠️ API error: {e}. Retrying in {delay} sec...")
-            time.sleep(delay)
-    raise RuntimeError("❌ Failed to get embeddings after multiple retries.")
-
-print("🔄 ベクトルを再生成しています...")
-
-all_vectors = []
-for i in range(0, len(texts), BATCH_SIZE):
-    batch = texts[i:i+BATCH_SIZE]
-    vectors = get_embeddings_batch(batch)
-    all_vectors.extend(vectors)
-    print(f"✅ Processed {i + len(batch)}/{len(texts)}")
-
-vector_data = np.array(all_vectors, dtype="float32")
+print("🔄 前回ビルドとの差分を確認しています...")
 
-# FAISSインデックス作成・保存（予約専用）
-dimension = vector_data.shape[1]
-index = faiss.IndexFlatL2(dimension)
-index.add(vector_data)
+# 変更のない行はキャッシュから取得し、新規・変更行だけを埋め込む
+embedding_cache = EmbeddingCache(embedding_provider.model, embedding_provider.dimensions)
 
-np.save("data/reserve_vector_data.npy", vector_data)
-faiss.write_index(index, "data/reserve_index.faiss")
+# FAISSインデックス差分更新・保存（保存した予約用 knowledge を含む全コーパス）
+rebuild_store(
+    lambda texts: embedding_cache.embed(texts, embedding_provider.embed, batch_size=BATCH_SIZE),
+    full=os.getenv("FULL_REBUILD", "").lower() == "true",
+    embedding=embedding_provider.info(),
+)
 
-print("✅ ベクトルデータとFAISSインデックス（予約専用）を保存しました。")
\ No newline at end of file
+print("✅ ベクトルデータとFAISSインデックス（予約専用）を保存しました。")
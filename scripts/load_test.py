@@ -0,0 +1,420 @@
+# scripts/load_test.py
+# 負荷試験: 本物のアプリ（gunicorn + app.py、または uvicorn + asgi_app.py）を、
+# ローカルのスタンドイン（scripts/fake_services.py）に向けて起動し、質問コーパスを指定の並列数で流す
+# ・OpenAI・Google の認証情報は不要。外部 API の遅延とエラー率はオプションで調整する
+# ・質問は data/faq.json（既定）か、書き出したチャットログ（.json / .jsonl / .csv）から読む
+# ・結果はスループット、応答時間の p50 / p95 / p99、回答経路ごとの件数、
+#   /metrics の差分から求めたステージごとの所要時間（平均と p95 の目安）とプロンプトのトークン数
+# ・/metrics はプロセスごとの値なので、ステージの内訳を正しく取るため worker は既定で 1 つ
+#   （--workers で増やすときは --session-backend sqlite / redis で会話履歴を共有する）
+# ・スタンドインの埋め込みは文字 n-gram のハッシュなので、ベクトル検索の結果（どの FAQ が近いか）は本番と異なる。
+#   各ステージの処理量は本番と同じになるので、所要時間の比較には使える
+#
+# 実行例:
+#   python scripts/load_test.py --concurrency 16 --requests 500 --chat-latency-ms 1200 --error-rate 0.01
+#   python scripts/load_test.py --questions chat_logs.csv --stream --server uvicorn
+import os
+import sys
+import csv
+import json
+import time
+import math
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "scripts"))
+from fake_services import FakeRedis, FakeServices, add_behavior_args, behaviors_from_args, service_env
+
+# 完全一致の FAQ 直接回答ばかりにならないよう、質問の言い回しを少し変える
+PARAPHRASE_SUFFIXES = ["", "について教えてください", "を知りたいです", "はどうなっていますか"]
+QUESTION_COLUMNS = ["question", "質問", "user_q"]
+
+
+def load_questions(path):
+    # .json（文字列か question を持つ dict の配列）/ .jsonl / .csv（question 列、なければ 2 列目＝チャットログの質問）
+    if path.endswith(".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.reader(f))
+        if not rows:
+            return []
+        header = [c.strip() for c in rows[0]]
+        column = next((header.index(c) for c in QUESTION_COLUMNS if c in header), None)
+        if column is None:
+            column = 1 if len(header) > 1 else 0
+        else:
+            rows = rows[1:]
+        items = [row[column] for row in rows if len(row) > column]
+    elif path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            items = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            items = json.load(f)
+
+    questions = []
+    for item in items:
+        if isinstance(item, dict):
+            item = next((item[c] for c in QUESTION_COLUMNS if item.get(c)), "")
+        if isinstance(item, str) and item.strip():
+            questions.append(item.strip())
+    return questions
+
+
+def paraphrase(question, rng):
+    suffix = rng.choice(PARAPHRASE_SUFFIXES)
+    if not suffix:
+        return question
+    return question.rstrip("？?。") + suffix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(url, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"アプリが起動中に終了しました（終了コード {process.returncode}）")
+        try:
+            with urllib.request.urlopen(url + "/", timeout=2) as res:
+                if res.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{timeout} 秒以内にアプリが起動しませんでした")
+
+
+def start_app(args, services, port, workdir, redis=None):
+    env = dict(os.environ)
+    env.update(service_env(services))
+    env.update({
+        "PORT": str(port),
+        "WEB_CONCURRENCY": str(args.workers),
+        "SESSION_BACKEND": args.session_backend,
+        "SESSION_SQLITE_PATH": os.path.join(workdir, "sessions.sqlite3"),
+        "GUNICORN_THREADS": str(args.threads or args.concurrency),
+        "METRICS_ENABLED": "true",
+        # スタンドインの埋め込みが本番の埋め込みキャッシュや Sheets の退避ファイルに混ざらないようにする
+        "EMBED_CACHE_DIR": os.path.join(workdir, "embeddings"),
+        "SHEETS_SPOOL_PATH": os.path.join(workdir, "sheets_spool.jsonl"),
+        "RELOAD_WATCH_INTERVAL": "0",
+    })
+    if redis is not None:
+        env["SESSION_REDIS_URL"] = redis.url
+    if args.server == "uvicorn":
+        command = [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(port), "--no-access-log"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}"]
+    log = open(os.path.join(workdir, "app.log"), "w")
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+
+def fetch_metrics(url):
+    # Prometheus のテキスト形式を {(名前, ラベル文字列): 値} に読む
+    with urllib.request.urlopen(url + "/metrics", timeout=10) as res:
+        text = res.read().decode("utf-8")
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_labels, _, value = line.rpartition(" ")
+        name, _, labels = name_labels.partition("{")
+        samples[(name, labels.rstrip("}"))] = float(value)
+    return samples
+
+
+def parse_labels(labels):
+    result = {}
+    for pair in labels.split('",'):
+        if "=" in pair:
+            key, _, value = pair.partition("=")
+            result[key] = value.strip('"')
+    return result
+
+
+def histogram_delta(before, after, name, label):
+    # ラベル値ごとに (件数, 合計, [(上限, 累積件数), ...]) の差分を返す
+    series = {}
+    for (sample, labels), value in after.items():
+        if not sample.startswith(name):
+            continue
+        delta = value - before.get((sample, labels), 0.0)
+        parsed = parse_labels(labels)
+        entry = series.setdefault(parsed.get(label, ""), {"count": 0, "sum": 0.0, "buckets": []})
+        if sample == f"{name}_count":
+            entry["count"] += delta
+        elif sample == f"{name}_sum":
+            entry["sum"] += delta
+        elif sample == f"{name}_bucket":
+            bound = math.inf if parsed["le"] == "+Inf" else float(parsed["le"])
+            entry["buckets"].append((bound, delta))
+    return {key: entry for key, entry in series.items() if entry["count"] > 0}
+
+
+def bucket_quantile(buckets, count, q):
+    # 累積バケットから分位点を線形補間で見積もる（ラベルをまたいだ同じ上限は合算する）
+    merged = {}
+    for bound, cumulative in buckets:
+        merged[bound] = merged.get(bound, 0.0) + cumulative
+    rank = q * count
+    lower, lower_count = 0.0, 0.0
+    for bound in sorted(merged):
+        cumulative = merged[bound]
+        if cumulative >= rank:
+            if bound == math.inf:
+                return lower
+            if cumulative == lower_count:
+                return bound
+            return lower + (bound - lower) * (rank - lower_count) / (cumulative - lower_count)
+        lower, lower_count = bound, cumulative
+    return lower
+
+
+def payload_path(payload):
+    # 回答経路（app.answer_path と同じ分け方。greeting と out_of_scope は区別しない）
+    path = payload.get("answer_path")
+    if path == "faq_direct":
+        return f"faq_{payload.get('faq_match')}"
+    return path or "no_llm"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))
+    return values[index]
+
+
+class Replayer:
+    def __init__(self, url, questions, args, prefix="load"):
+        self.url = url
+        self.prefix = prefix
+        self.questions = questions
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.results = []
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def _take(self):
+        # 次に送る (質問, セッション ID)。session_turns 件ごとに新しいセッションにする
+        with self._lock:
+            n = self._next
+            if n >= self.args.requests:
+                return None
+            self._next += 1
+            question = self.questions[n % len(self.questions)] if not self.args.shuffle else self.rng.choice(self.questions)
+            if self.args.paraphrase:
+                question = paraphrase(question, self.rng)
+        return question, f"{self.prefix}-{n // self.args.session_turns}"
+
+    def _post(self, question, session_id):
+        endpoint = "/chat/stream" if self.args.stream else "/chat"
+        body = json.dumps({"question": question, "session_id": session_id}).encode("utf-8")
+        req = urllib.request.Request(self.url + endpoint, data=body, headers={"Content-Type": "application/json"})
+        started = time.perf_counter()
+        first_byte = None
+        path = None
+        try:
+            with urllib.request.urlopen(req, timeout=self.args.timeout) as res:
+                if self.args.stream:
+                    event = None
+                    for raw in res:
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - started
+                        line = raw.decode("utf-8").rstrip("\n")
+                        if line.startswith("event: "):
+                            event = line[7:]
+                        elif line.startswith("data: ") and event in ("done", "error"):
+                            payload = json.loads(line[6:])
+                            path = "error" if event == "error" else payload_path(payload)
+                else:
+                    payload = json.loads(res.read().decode("utf-8"))
+                    first_byte = time.perf_counter() - started
+                    path = payload_path(payload)
+                status = res.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+            path = "error"
+        except Exception:
+            status = 0
+            path = "error"
+        elapsed = time.perf_counter() - started
+        return {"status": status, "seconds": elapsed, "first_byte": first_byte, "path": path or "other"}
+
+    def _worker(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            result = self._post(*item)
+            with self._lock:
+                self.results.append(result)
+
+    def run(self):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for _ in range(self.args.concurrency):
+                pool.submit(self._worker)
+        return time.perf_counter() - started
+
+
+def summarize(results, wall, before, after, fake_stats):
+    ok = [r for r in results if r["status"] == 200 and r["path"] != "error"]
+    latencies = [r["seconds"] for r in ok]
+    first_bytes = [r["first_byte"] for r in ok if r["first_byte"] is not None]
+    paths = {}
+    for r in results:
+        paths[r["path"]] = paths.get(r["path"], 0) + 1
+
+    stages = {}
+    for stage, entry in sorted(histogram_delta(before, after, "chatbot_stage_duration_seconds", "stage").items()):
+        stages[stage] = {
+            "count": int(entry["count"]),
+            "mean_ms": round(entry["sum"] / entry["count"] * 1000, 2),
+            "p95_ms": round(bucket_quantile(entry["buckets"], entry["count"], 0.95) * 1000, 2),
+        }
+    prompt_tokens = {}
+    for part, entry in sorted(histogram_delta(before, after, "chatbot_prompt_tokens", "part").items()):
+        prompt_tokens[part] = {
+            "mean": round(entry["sum"] / entry["count"], 1),
+            "p95": round(bucket_quantile(entry["buckets"], entry["count"], 0.95), 1),
+        }
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(results) / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99": round(percentile(latencies, 0.99) * 1000, 1),
+            "max": round(max(latencies, default=0.0) * 1000, 1),
+        },
+        "first_byte_ms": {
+            "p50": round(percentile(first_bytes, 0.50) * 1000, 1),
+            "p95": round(percentile(first_bytes, 0.95) * 1000, 1),
+        },
+        "answer_paths": paths,
+        "stages": stages,
+        "prompt_tokens": prompt_tokens,
+        "fake_services": fake_stats,
+    }
+
+
+def print_report(report):
+    print(f"\n📊 {report['requests']} 件（成功 {report['ok']} / 失敗 {report['errors']}）/ {report['wall_seconds']} 秒")
+    print(f"🚀 スループット: {report['throughput_rps']} req/s")
+    latency = report["latency_ms"]
+    print(f"⏱️ 応答時間: p50 {latency['p50']} ms / p95 {latency['p95']} ms / p99 {latency['p99']} ms / 最大 {latency['max']} ms")
+    print(f"⏱️ 最初のバイトまで: p50 {report['first_byte_ms']['p50']} ms / p95 {report['first_byte_ms']['p95']} ms")
+    print("🧭 回答経路: " + ", ".join(f"{path} {count}" for path, count in sorted(report["answer_paths"].items())))
+    if report["stages"]:
+        print("\n🔬 ステージごとの所要時間（/metrics の差分。p95 はバケットからの推定）")
+        print(f"  {'stage':<18}{'count':>8}{'mean ms':>12}{'p95 ms':>12}")
+        for stage, entry in sorted(report["stages"].items(), key=lambda item: -item[1]["mean_ms"] * item[1]["count"]):
+            print(f"  {stage:<18}{entry['count']:>8}{entry['mean_ms']:>12}{entry['p95_ms']:>12}")
+    if report["prompt_tokens"]:
+        print("🧾 プロンプトのトークン数（平均 / p95）: " + ", ".join(
+            f"{part} {entry['mean']} / {entry['p95']}" for part, entry in report["prompt_tokens"].items()
+        ))
+    fake = report["fake_services"]
+    print("\n🧪 スタンドインへの呼び出し: " + ", ".join(
+        f"{name} {count}（エラー {fake['errors'][name]}）" for name, count in fake["calls"].items()
+    ) + f" / Sheets に追記された行 {fake['sheet_rows']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スタンドインに向けたアプリへ質問コーパスを流す負荷試験")
+    parser.add_argument("--questions", default=os.path.join(ROOT, "data", "faq.json"), help="faq.json か、書き出したチャットログ（.json / .jsonl / .csv）")
+    parser.add_argument("--requests", type=int, default=200, help="送るリクエストの総数（コーパスは繰り返し使う）")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--session-turns", type=int, default=1, help="1 セッションで続けて送る質問の数（2 以上で履歴とリライトが効く）")
+    parser.add_argument("--paraphrase", action="store_true", help="質問の言い回しを少し変えて、完全一致の FAQ 直接回答を減らす")
+    parser.add_argument("--shuffle", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream", action="store_true", help="/chat/stream（SSE）に送る")
+    parser.add_argument("--server", choices=["gunicorn", "uvicorn"], default="gunicorn")
+    parser.add_argument("--threads", type=int, help="gunicorn のスレッド数（既定は並列数と同じ）")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn の worker 数（2 以上ではステージの内訳は 1 worker 分の目安）")
+    parser.add_argument("--session-backend", choices=["memory", "sqlite", "redis"], default="memory",
+                        help="会話履歴の保存先（redis は Redis のスタンドインを起動する）")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前に送るリクエスト数")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="結果を JSON で保存するパス")
+    add_behavior_args(parser)
+    args = parser.parse_args()
+    args.session_turns = max(1, args.session_turns)
+
+    questions = load_questions(args.questions)
+    if not questions:
+        print(f"❌ {args.questions} に質問がありません")
+        sys.exit(1)
+
+    services = FakeServices(behaviors=behaviors_from_args(args)).start()
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    print(f"🧪 スタンドイン: {services.url} / アプリ: {url}（{args.server}）/ 作業ディレクトリ: {workdir}")
+
+    redis = FakeRedis().start() if args.session_backend == "redis" else None
+    process, log = start_app(args, services, port, workdir, redis)
+    try:
+        wait_until_ready(url, process, args.startup_timeout)
+        if args.warmup:
+            warmup = argparse.Namespace(**{**vars(args), "requests": args.warmup, "concurrency": 1, "shuffle": True})
+            Replayer(url, questions, warmup, prefix="warmup").run()
+
+        before = fetch_metrics(url)
+        fake_before = services.stats()
+        print(f"▶️ {len(questions)} 件の質問から {args.requests} 件を並列 {args.concurrency} で送信します")
+        replayer = Replayer(url, questions, args)
+        wall = replayer.run()
+        after = fetch_metrics(url)
+        fake_after = services.stats()
+    except RuntimeError as e:
+        print(f"❌ {e}（ログ: {os.path.join(workdir, 'app.log')}）")
+        sys.exit(1)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        services.stop()
+        if redis is not None:
+            redis.stop()
+
+    fake_stats = {
+        "calls": {k: fake_after["calls"][k] - fake_before["calls"][k] for k in fake_after["calls"]},
+        "errors": {k: fake_after["errors"][k] - fake_before["errors"][k] for k in fake_after["errors"]},
+        "sheet_rows": fake_after["sheet_rows"] - fake_before["sheet_rows"],
+    }
+    report = summarize(replayer.results, wall, before, after, fake_stats)
+    report["config"] = {k: v for k, v in vars(args).items() if k != "output"}
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
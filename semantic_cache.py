@@ -0,0 +1,129 @@
+# semantic_cache.py
+# 意味的に近い質問への回答キャッシュ
+# (クエリベクトル, 検索で得たコンテキストのキー, 回答) を小さな FAISS インデックスに保持し、
+# 距離がしきい値以内 かつ 同じコンテキストを検索した質問には保存済みの回答を返す
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import faiss
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "500"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+# 正規化済みベクトルの二乗 L2 距離（0.1 ≒ コサイン類似度 0.95）
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", "0.1"))
+SEARCH_K = 5
+
+
+class SemanticCache:
+    def __init__(self, dimensions=1536, max_entries=None, ttl=None, max_distance=None, enabled=None):
+        self.dimensions = dimensions
+        self.max_entries = max_entries or SEMANTIC_CACHE_MAX_ENTRIES
+        self.ttl = SEMANTIC_CACHE_TTL if ttl is None else ttl
+        self.max_distance = SEMANTIC_CACHE_MAX_DISTANCE if max_distance is None else max_distance
+        self.enabled = SEMANTIC_CACHE_ENABLED if enabled is None else enabled
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimensions))
+        self._entries = OrderedDict()  # id -> entry（末尾ほど最近使用）
+        self._next_id = 0
+
+    def _clear(self):
+        self._index.reset()
+        self._entries.clear()
+
+    def _remove(self, ids):
+        for doc_id in ids:
+            self._entries.pop(doc_id, None)
+        self._index.remove_ids(np.array(ids, dtype="int64"))
+
+    def clear(self):
+        # データの版が切り替わったとき（ArtifactReloader の on_swap）に全件破棄する
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+                print(f"🧹 データ更新のため回答キャッシュを破棄しました（{len(self._entries)} 件）")
+            self._clear()
+
+    def lookup(self, vector, context_key):
+        if not self.enabled:
+            return None
+        vector = np.asarray(vector, dtype="float32").reshape(1, -1)
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+            now = time.time()
+            D, I = self._index.search(vector, min(SEARCH_K, len(self._entries)))
+            expired = []
+            answer = None
+            for dist, doc_id in zip(D[0], I[0]):
+                if doc_id < 0 or dist > self.max_distance:
+                    break
+                entry = self._entries.get(int(doc_id))
+                if entry is None:
+                    continue
+                if now - entry["created_at"] > self.ttl:
+                    expired.append(int(doc_id))
+                    continue
+                if entry["context_key"] == context_key:
+                    self._entries.move_to_end(int(doc_id))
+                    entry["hits"] += 1
+                    answer = entry["answer"]
+                    break
+            if expired:
+                self._remove(expired)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def store(self, vector, context_key, answer):
+        if not self.enabled:
+            return
+        vector = np.asarray(vector, dtype="float32").reshape(1, -1)
+        with self._lock:
+            now = time.time()
+            expired = [doc_id for doc_id, e in self._entries.items() if now - e["created_at"] > self.ttl]
+            if expired:
+                self._remove(expired)
+            overflow = len(self._entries) + 1 - self.max_entries
+            if overflow > 0:
+                oldest = list(self._entries)[:overflow]
+                self._remove(oldest)
+                self.evictions += len(oldest)
+
+            doc_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.array([doc_id], dtype="int64"))
+            self._entries[doc_id] = {
+                "context_key": context_key,
+                "answer": answer,
+                "created_at": now,
+                "hits": 0,
+            }
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,450 @@
+# session_store.py
+# 会話履歴（セッションごとの直近のやり取り）の保存先（設定で切り替え）
+#   memory : プロセス内の LRU（件数の上限つき）。worker をまたいでは共有されない
+#   sqlite : SQLite（WAL）のファイル。同じホストの gunicorn worker 間で共有できる
+#   redis  : Redis プロトコルのサーバー（標準ライブラリだけの最小クライアント）。複数ホストで共有できる
+#
+# ・どの保存先も最後の発言から SESSION_TTL 秒で期限切れ。期限切れの履歴は読み出し時に捨て、
+#   加えてバックグラウンドで定期的に掃除する（同じ session_id が戻ってこなくても溜まらない）
+# ・件数の上限（SESSION_MAX_ENTRIES）を超えたら、最も長く使われていないセッションから削除する
+#   （redis は TTL で消えるので件数の上限はサーバー側の maxmemory-policy に任せる）
+# ・同じセッションへの追記はセッション単位のロックで直列化し、別のセッション同士は待たせない
+#   （sqlite は書き込みトランザクション、redis は MULTI / EXEC で worker 間でも追記が欠けない）
+# ・history() は履歴のコピーを返す。呼び出し側は読むだけで、追記は append() で行う
+import os
+import json
+import time
+import select
+import socket
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+BACKENDS = ("memory", "sqlite", "redis")
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "10"))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+# 期限切れの掃除の間隔（秒）。0 で無効（読み出し時の判定だけになる）
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", ".cache/sessions.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://127.0.0.1:6379/0")
+SESSION_KEY_PREFIX = os.getenv("SESSION_KEY_PREFIX", "chatbot:session:")
+SESSION_REDIS_TIMEOUT = float(os.getenv("SESSION_REDIS_TIMEOUT", "2.0"))
+# セッション単位のロック（session_id のハッシュで振り分ける。ロックの数は一定）
+LOCK_STRIPES = 64
+
+
+class SessionStore:
+    name = "base"
+
+    def __init__(self, ttl=None, max_turns=None, max_entries=None, sweep_interval=None):
+        self.ttl = SESSION_TTL if ttl is None else ttl
+        self.max_turns = max_turns or SESSION_MAX_TURNS
+        self.max_entries = max_entries or SESSION_MAX_ENTRIES
+        self.sweep_interval = SESSION_SWEEP_INTERVAL if sweep_interval is None else sweep_interval
+
+        self.reads = 0
+        self.appends = 0
+        self.expired = 0
+        self.evicted = 0
+        self.errors = 0
+        self.sweeps = 0
+
+        self._stats_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._pid = None
+
+    def lock(self, session_id):
+        return self._locks[zlib.crc32(session_id.encode("utf-8")) % LOCK_STRIPES]
+
+    def _count(self, **amounts):
+        with self._stats_lock:
+            for key, amount in amounts.items():
+                setattr(self, key, getattr(self, key) + amount)
+
+    def _ensure_sweeper(self):
+        # gunicorn の fork 後はプロセスごとに掃除スレッドを起動する
+        if self.sweep_interval <= 0 or self._pid == os.getpid():
+            return
+        with self._stats_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._sweep_loop, name=f"session-sweeper-{self.name}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                self._count(errors=1)
+                print(f"⚠️ セッションの掃除に失敗しました（{self.name}）:", e)
+
+    def history(self, session_id):
+        # 期限内の履歴（古い順の {"role", "content"} のリスト）のコピー
+        self._ensure_sweeper()
+        self._count(reads=1)
+        return self._history(session_id)
+
+    def append(self, session_id, role, content):
+        # 末尾に 1 件追加し、直近 max_turns 件だけ残す
+        self._ensure_sweeper()
+        self._count(appends=1)
+        with self.lock(session_id):
+            self._append(session_id, {"role": role, "content": content})
+
+    def sweep(self):
+        # 期限切れ・上限超過のセッションを削除し、削除した件数を返す
+        removed = self._sweep()
+        self._count(sweeps=1)
+        return removed
+
+    def _history(self, session_id):
+        raise NotImplementedError
+
+    def _append(self, session_id, message):
+        raise NotImplementedError
+
+    def _sweep(self):
+        return 0
+
+    def size(self):
+        # 保持しているセッション数（数えられない保存先は None）
+        return None
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {
+                "backend": self.name,
+                "ttl": self.ttl,
+                "max_turns": self.max_turns,
+                "max_entries": self.max_entries,
+                "reads": self.reads,
+                "appends": self.appends,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "sweeps": self.sweeps,
+                "errors": self.errors,
+            }
+        try:
+            stats["entries"] = self.size()
+        except Exception as e:
+            stats["entries"] = None
+            print(f"⚠️ セッション数を取得できません（{self.name}）:", e)
+        return stats
+
+
+class MemorySessionStore(SessionStore):
+    name = "memory"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session_id -> {"last_active", "history"}（末尾ほど最近使用）
+
+    def _live(self, session_id, now):
+        # 呼び出し側で self._lock を保持していること
+        session = self._sessions.get(session_id)
+        if session is not None and now - session["last_active"] > self.ttl:
+            del self._sessions[session_id]
+            self._count(expired=1)
+            session = None
+        return session
+
+    def _history(self, session_id):
+        now = time.time()
+        with self._lock:
+            session = self._live(session_id, now)
+            if session is None:
+                return []
+            session["last_active"] = now
+            self._sessions.move_to_end(session_id)
+            return list(session["history"])
+
+    def _append(self, session_id, message):
+        now = time.time()
+        with self._lock:
+            session = self._live(session_id, now)
+            if session is None:
+                session = self._sessions[session_id] = {"last_active": now, "history": []}
+            session["last_active"] = now
+            self._sessions.move_to_end(session_id)
+            history = session["history"]
+            history.append(message)
+            if len(history) > self.max_turns:
+                del history[:-self.max_turns]
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self._count(evicted=1)
+
+    def _sweep(self):
+        # 古い順に並んでいるので、期限内のセッションに当たったところで止める
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with self._lock:
+            while self._sessions:
+                session_id, session = next(iter(self._sessions.items()))
+                if session["last_active"] >= cutoff:
+                    break
+                del self._sessions[session_id]
+                removed += 1
+        self._count(expired=removed)
+        return removed
+
+    def size(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+class SqliteSessionStore(SessionStore):
+    name = "sqlite"
+
+    def __init__(self, path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path or SESSION_SQLITE_PATH
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, last_active REAL NOT NULL, history TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active)")
+
+    def _connect(self):
+        # 接続はスレッドごと・プロセスごと（fork 前の接続は使い回さない）
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _history(self, session_id):
+        # 最終利用時刻は append() で更新する（各ターンは必ず質問の追記から始まる）
+        row = self._connect().execute(
+            "SELECT last_active, history FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return []
+        return json.loads(row[1])
+
+    def _append(self, session_id, message):
+        now = time.time()
+        conn = self._connect()
+        # 書き込みロックを先に取り、別 worker の同じセッションへの追記と読み書きが交差しないようにする
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT last_active, history FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            history = []
+            if row is not None:
+                if now - row[0] > self.ttl:
+                    self._count(expired=1)
+                else:
+                    history = json.loads(row[1])
+            history = (history + [message])[-self.max_turns:]
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, last_active, history) VALUES (?, ?, ?)",
+                (session_id, now, json.dumps(history, ensure_ascii=False)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _sweep(self):
+        conn = self._connect()
+        expired = conn.execute("DELETE FROM sessions WHERE last_active < ?", (time.time() - self.ttl,)).rowcount
+        evicted = conn.execute(
+            "DELETE FROM sessions WHERE session_id IN ("
+            "SELECT session_id FROM sessions ORDER BY last_active DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self._count(expired=expired, evicted=evicted)
+        return expired + evicted
+
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def clear(self):
+        self._connect().execute("DELETE FROM sessions")
+
+
+class RespError(Exception):
+    pass
+
+
+class RespClient:
+    # Redis プロトコル（RESP2）の最小クライアント。接続はスレッドごと・プロセスごと
+    def __init__(self, url=None, timeout=None):
+        parsed = urlparse(url or SESSION_REDIS_URL)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout or SESSION_REDIS_TIMEOUT
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid() and self._closed_by_server(conn[0]):
+            # アイドル中にサーバー側で切られた接続は、送る前に張り直す（再送しないコマンドのため）
+            self._close()
+            conn = None
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = (sock, sock.makefile("rb"))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            if self.password:
+                self._roundtrip(conn, [("AUTH", self.password)])
+            if self.db:
+                self._roundtrip(conn, [("SELECT", self.db)])
+        return conn
+
+    @staticmethod
+    def _closed_by_server(sock):
+        # 応答待ちでないのに読めるなら、切断（EOF）か想定外のデータなので使わない
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _encode(args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(parts)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis の接続が切れました")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            return RespError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self._read(reader) for _ in range(length)]
+        raise ConnectionError(f"Redis の応答を解釈できません: {line!r}")
+
+    def _roundtrip(self, conn, commands):
+        sock, reader = conn
+        sock.sendall(b"".join(self._encode(args) for args in commands))
+        replies = [self._read(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def pipeline(self, *commands, retry=True):
+        # 複数のコマンドをまとめて送り、応答をまとめて読む。接続が切れていたら 1 回だけ張り直す
+        # retry=False（MULTI/EXEC の追記など）は、EXEC が適用済みかわからないので再送せずにエラーを返す
+        for attempt in range(2):
+            try:
+                return self._roundtrip(self._connection(), commands)
+            except (ConnectionError, OSError):
+                self._close()
+                if attempt or not retry:
+                    raise
+            except RespError:
+                self._close()
+                raise
+
+    def execute(self, *args):
+        return self.pipeline(args)[0]
+
+
+class RedisSessionStore(SessionStore):
+    # 履歴は 1 セッション 1 つのリスト（要素は JSON）。期限は EXPIRE でサーバー側が管理する
+    name = "redis"
+
+    def __init__(self, url=None, prefix=None, client=None, **kwargs):
+        super().__init__(**kwargs)
+        self.prefix = prefix or SESSION_KEY_PREFIX
+        self.client = client or RespClient(url)
+        self.sweep_interval = 0
+
+    def _key(self, session_id):
+        return self.prefix + session_id
+
+    def _history(self, session_id):
+        return [json.loads(item) for item in self.client.execute("LRANGE", self._key(session_id), 0, -1) or []]
+
+    def _append(self, session_id, message):
+        key = self._key(session_id)
+        self.client.pipeline(
+            ("MULTI",),
+            ("RPUSH", key, json.dumps(message, ensure_ascii=False)),
+            ("LTRIM", key, -self.max_turns, -1),
+            ("EXPIRE", key, self.ttl),
+            ("EXEC",),
+            retry=False,
+        )
+
+    def _keys(self):
+        # このアプリのセッションのキー（件数は数えない。/stats のたびに全キーを走査しないため）
+        cursor = "0"
+        while True:
+            cursor, keys = self.client.execute("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 500)
+            cursor = cursor.decode() if isinstance(cursor, bytes) else str(cursor)
+            yield from keys
+            if cursor == "0":
+                return
+
+    def clear(self):
+        keys = list(self._keys())
+        for start in range(0, len(keys), 500):
+            self.client.execute("DEL", *keys[start:start + 500])
+
+
+def get_session_store(name=None, **kwargs):
+    name = name or SESSION_BACKEND
+    if name == "memory":
+        return MemorySessionStore(**kwargs)
+    if name == "sqlite":
+        return SqliteSessionStore(**kwargs)
+    if name == "redis":
+        return RedisSessionStore(**kwargs)
+    raise ValueError(f"未対応のセッション保存先です: {name}（{', '.join(BACKENDS)}）")
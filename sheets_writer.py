@@ -0,0 +1,241 @@
+# sheets_writer.py
+# Google Sheets への追記をリクエスト処理から切り離すバックグラウンドライター
+# ・行はメモリ上の有界キューに積み、件数または時間でシートごとにまとめて append する
+# ・失敗時は指数バックオフで再試行し、それでも駄目ならローカルのスプールファイルに退避
+# ・スプールは Sheets が復旧した後に再送する（読めない行は .bad に移し、他の行の再送は続ける）
+import os
+import glob
+import json
+import time
+import queue
+import atexit
+import threading
+from collections import OrderedDict
+
+from metrics import span
+
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "50"))
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "2.0"))
+SHEETS_QUEUE_SIZE = int(os.getenv("SHEETS_QUEUE_SIZE", "1000"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "3"))
+SHEETS_RETRY_BACKOFF = float(os.getenv("SHEETS_RETRY_BACKOFF", "1.0"))
+SHEETS_REPLAY_INTERVAL = float(os.getenv("SHEETS_REPLAY_INTERVAL", "60"))
+SHEETS_SPOOL_PATH = os.getenv("SHEETS_SPOOL_PATH", ".cache/sheets_spool.jsonl")
+
+
+class SheetsWriter:
+    def __init__(self, sheet_service, spreadsheet_id, batch_size=None, flush_interval=None,
+                 queue_size=None, max_retries=None, spool_path=None):
+        self.sheet_service = sheet_service
+        self.spreadsheet_id = spreadsheet_id
+        self.batch_size = batch_size or SHEETS_BATCH_SIZE
+        self.flush_interval = SHEETS_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.queue_size = queue_size or SHEETS_QUEUE_SIZE
+        self.max_retries = max_retries or SHEETS_MAX_RETRIES
+        self.spool_path = spool_path or SHEETS_SPOOL_PATH
+
+        self.enqueued = 0
+        self.written = 0
+        self.api_calls = 0
+        self.failures = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.corrupt = 0
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._last_replay = 0.0
+
+    def _ensure_worker(self):
+        # gunicorn の fork 後はプロセスごとにキューとスレッドを作り直す
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            threading.Thread(target=self._run, args=(self._queue,), name="sheets-writer", daemon=True).start()
+            if self._pid is None:
+                atexit.register(self.flush)
+            self._pid = os.getpid()
+
+    def append(self, range_name, row):
+        # 呼び出し側をブロックしない。キューが満杯ならスプールへ
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((range_name, row))
+            with self._lock:
+                self.enqueued += 1
+        except queue.Full:
+            self._spool([(range_name, row)])
+
+    def flush(self):
+        # キューに残っている行をすべて書き出す（終了時用）
+        if self._queue is None or self._pid != os.getpid():
+            return
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            self._write(items)
+
+    # === バックグラウンド処理 ===
+    def _run(self, q):
+        # 1 回の失敗でスレッドが止まると以後の行が書かれなくなるので、例外はここで受け止めて続ける
+        while True:
+            try:
+                items = self._collect(q)
+                if items:
+                    self._write(items)
+                self._replay_spool()
+            except Exception as e:
+                print("❌ Sheets ライターで予期しないエラーが発生しました:", e)
+                time.sleep(self.flush_interval)
+
+    def _collect(self, q):
+        try:
+            items = [q.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _write(self, items):
+        # 書けた行数を返す（書けなかったシートの行はスプールへ）
+        grouped = OrderedDict()
+        for range_name, row in items:
+            grouped.setdefault(range_name, []).append(row)
+        written = 0
+        with self._write_lock:
+            for range_name, rows in grouped.items():
+                if self._append_with_retry(range_name, rows):
+                    written += len(rows)
+                    with self._lock:
+                        self.written += len(rows)
+                else:
+                    self._spool([(range_name, row) for row in rows])
+        return written
+
+    def _append_with_retry(self, range_name, rows):
+        for attempt in range(self.max_retries):
+            try:
+                with self._lock:
+                    self.api_calls += 1
+                with span("sheets_append"):
+                    self.sheet_service.values().append(
+                        spreadsheetId=self.spreadsheet_id,
+                        range=range_name,
+                        valueInputOption="RAW",
+                        body={"values": rows}
+                    ).execute()
+                return True
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                print(f"⚠️ Sheets 書き込み失敗（{attempt + 1}/{self.max_retries}）:", e)
+                if attempt + 1 < self.max_retries:
+                    time.sleep(SHEETS_RETRY_BACKOFF * (2 ** attempt))
+        return False
+
+    # === スプール ===
+    def _spool(self, items):
+        try:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for range_name, row in items:
+                    f.write(json.dumps({"range": range_name, "row": row}, ensure_ascii=False) + "\n")
+            with self._lock:
+                self.spooled += len(items)
+            print(f"💾 Sheets に書けなかった {len(items)} 行をスプールしました: {self.spool_path}")
+        except OSError as e:
+            print("❌ スプールへの退避にも失敗しました:", e)
+
+    def _replay_spool(self):
+        now = time.monotonic()
+        if now - self._last_replay < SHEETS_REPLAY_INTERVAL or not os.path.exists(self.spool_path):
+            return
+        self._last_replay = now
+        # 別プロセスと二重に再送しないよう、先にファイルを自分の名前に移す
+        replay_path = f"{self.spool_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spool_path, replay_path)
+        except OSError:
+            return
+        items = []
+        for path in [replay_path] + self._orphaned_replays(replay_path):
+            items += self._read_spool(path)
+        if items:
+            print(f"🔁 スプール済みの {len(items)} 行を再送します")
+            written = self._write(items)
+            with self._lock:
+                self.replayed += written
+
+    def _orphaned_replays(self, own_path):
+        # 再送の途中で終了したプロセスが残した .replay（pid のプロセスがもう無いもの）
+        orphans = []
+        for path in glob.glob(f"{glob.escape(self.spool_path)}.*.replay"):
+            if path == own_path:
+                continue
+            try:
+                os.kill(int(path.rsplit(".", 2)[-2]), 0)
+            except ProcessLookupError:
+                orphans.append(path)
+            except (ValueError, OSError):
+                pass
+        return orphans
+
+    def _read_spool(self, path):
+        # 1 行ずつ読み、途中で切れた行・壊れた行は .bad に移して残りを再送する
+        items = []
+        bad = []
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        data = json.loads(line)
+                        items.append((data["range"], data["row"]))
+                    except (ValueError, KeyError, TypeError):
+                        bad.append(line if line.endswith("\n") else line + "\n")
+            os.remove(path)
+        except OSError as e:
+            print("⚠️ スプールの読み込みに失敗しました:", e)
+            return items
+        if bad:
+            with self._lock:
+                self.corrupt += len(bad)
+            try:
+                with open(f"{self.spool_path}.bad", "a", encoding="utf-8") as f:
+                    f.writelines(bad)
+            except OSError as e:
+                print("❌ 壊れたスプール行の退避に失敗しました:", e)
+            print(f"⚠️ 読めないスプール行 {len(bad)} 行を {self.spool_path}.bad に移しました")
+        return items
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "api_calls": self.api_calls,
+                "failures": self.failures,
+                "spooled": self.spooled,
+                "replayed": self.replayed,
+                "corrupt": self.corrupt,
+                "spool_pending": os.path.exists(self.spool_path),
+            }
@@ -1,17 +1,20 @@
 import os
 import json
-import numpy as np
-import faiss
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-import openai
 
+# === ローカル実行時のみ .env を読み込む（各モジュールは import 時に環境変数を読むので、先に読み込む）===
 if os.getenv("GITHUB_ACTIONS") != "true":
     from dotenv import load_dotenv
     load_dotenv()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not openai.api_key:
+from embedding_cache import EmbeddingCache
+from embedding_provider import get_provider
+from knowledge_base import rebuild_store
+
+# === 埋め込みの取得先（EMBED_PROVIDER。既定は OpenAI）===
+embedding_provider = get_provider()
+if embedding_provider.name == "openai" and not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY is not set or empty.")
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
@@ -43,47 +46,18 @@ with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
 
 print(f"✅ {OUTPUT_PATH} を保存しました。")
 
-with open("data/reserve_knowledge.json", "r", encoding="utf-8") as f:
-    knowledge_dict = json.load(f)
-knowledge_contents = [
-    f"{category}：{text}"
-    for category, texts in knowledge_dict.items()
-    for text in texts
-]
-
-metadata_note = ""
-metadata_path = "data/reserve_metadata.json"
-if os.path.exists(metadata_path):
-    with open(metadata_path, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
-        metadata_note = f"【ファイル情報】{metadata.get('title', '')}（種類：{metadata.get('type', '')}、優先度：{metadata.get('priority', '')}）"
-
-EMBED_MODEL = "text-embedding-3-small"
-search_corpus = [
-    f"{item['question']} {item['answer']}"
-    for item in faq_list
-    if item.get("question") and item.get("answer")
-] + knowledge_contents + [metadata_note]
-
-search_corpus = [s for s in search_corpus if s.strip()]
+embedding_cache = EmbeddingCache(embedding_provider.model, embedding_provider.dimensions)
 
 def get_embeddings_in_batches(texts, batch_size=100):
-    vectors = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i+batch_size]
-        response = openai.embeddings.create(model=EMBED_MODEL, input=batch)
-        batch_vectors = [np.array(data.embedding, dtype="float32") for data in response.data]
-        vectors.extend(batch_vectors)
-    return np.array(vectors, dtype="float32")
-
-print("🔄 ベクトルをバッチで再生成しています...")
-vector_data = get_embeddings_in_batches(search_corpus)
-
-dimension = vector_data.shape[1]
-index = faiss.IndexFlatL2(dimension)
-index.add(vector_data)
-
-np.save("data/reserve_vector_data.npy", vector_data)
-faiss.write_index(index, "data/reserve_index.faiss")
+    # 変更のない行はキャッシュから取得し、新規・変更行だけを埋め込む
+    return embedding_cache.embed(texts, embedding_provider.embed, batch_size=batch_size)
+
+# ベクトルストアは全コーパス共通。保存した予約用 FAQ を含む全コーパスの行と突き合わせ、変わった行だけを埋め込む
+print("🔄 前回ビルドとの差分を確認しています...")
+rebuild_store(
+    get_embeddings_in_batches,
+    full=os.getenv("FULL_REBUILD", "").lower() == "true",
+    embedding=embedding_provider.info(),
+)
 
 print("✅ ベクトルデータとFAISSインデックス（予約専用）を保存しました。")
\ No newline at end of file
@@ -0,0 +1,291 @@
+# vector_backend.py
+# ベクトル検索のバックエンド（設定で切り替え）
+#   flat_l2        : 全件の L2 距離（厳密・従来どおり）
+#   inner_product  : 内積（正規化済みベクトルのコサイン類似度・厳密）
+#   hnsw           : HNSW グラフ（近似・大規模向けの低レイテンシ）
+#   ivf_pq         : IVF + 直積量子化（近似・省メモリ）
+#   numpy          : NumPy の行列積による全件検索（小さなコーパス向け・faiss の検索を使わない）
+#
+# どのバックエンドでも search() は「二乗 L2 距離（小さいほど近い）」と文書 ID を返す
+# （内積は正規化済みベクトルの関係 |a-b|² = 2 - 2a·b で換算）。FAQ 直接回答や回答キャッシュの
+# しきい値はこの距離を前提にしている。
+# 使ったバックエンドとパラメータはマニフェストに記録し、読み込み時はそれに従う。
+# make_filter(ids) で検索対象を文書 ID に絞れる（search(q, k, flt)。faiss は ID セレクタで検索中に絞り込む）。
+#
+# 保存形式（VECTOR_STORAGE）: float32 / float16 / int8（次元ごとの最小値・幅によるスカラー量子化）
+# .npy とインデックスの両方をこの形式で保存し、検索時は多めに候補を取ってから
+# 保存済みベクトルを float32 に戻して距離を計算し直す（再スコア）。
+import os
+import math
+
+import numpy as np
+import faiss
+
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "flat_l2")
+BACKENDS = ("flat_l2", "inner_product", "hnsw", "ivf_pq", "numpy")
+
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))  # 0 なら件数から自動で決める
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+IVF_PQ_M = int(os.getenv("IVF_PQ_M", "64"))
+IVF_PQ_NBITS = 8
+
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "float32")
+STORAGE_TYPES = ("float32", "float16", "int8")
+# 圧縮保存時、再スコアのために k の何倍の候補を取るか
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))
+RECALL_SAMPLE = 200
+RECALL_K = 10
+
+
+def backend_config(name=None, storage=None):
+    # ビルド時の設定（マニフェストにそのまま記録する）
+    name = name or VECTOR_BACKEND
+    storage = storage or VECTOR_STORAGE
+    if name not in BACKENDS:
+        raise ValueError(f"未対応のベクトル検索バックエンドです: {name}（{', '.join(BACKENDS)}）")
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"未対応のベクトル保存形式です: {storage}（{', '.join(STORAGE_TYPES)}）")
+    params = {}
+    if name == "hnsw":
+        params = {"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION}
+    elif name == "ivf_pq":
+        params = {"nlist": IVF_NLIST, "pq_m": IVF_PQ_M, "nbits": IVF_PQ_NBITS}
+    return {"name": name, "params": params, "storage": storage}
+
+
+# === 保存形式 ===
+def encode_vectors(vectors, storage):
+    """float32 のベクトルを保存形式に変換する。返り値は (配列, 復元用パラメータ)。"""
+    vectors = np.asarray(vectors, dtype="float32")
+    if storage == "float16":
+        return vectors.astype("float16"), {}
+    if storage == "int8":
+        if len(vectors) == 0:
+            return vectors.astype("int8"), {"vmin": [], "scale": []}
+        vmin = vectors.min(axis=0)
+        scale = (vectors.max(axis=0) - vmin) / 255.0
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint((vectors - vmin) / scale) - 128, -128, 127).astype("int8")
+        return codes, {"vmin": vmin.tolist(), "scale": scale.tolist()}
+    return vectors, {}
+
+
+def decode_vectors(array, storage_params=None):
+    # 保存形式から float32 に戻す（memmap の一部だけを渡してもよい）
+    if array.dtype == np.int8:
+        vmin = np.asarray(storage_params["vmin"], dtype="float32")
+        scale = np.asarray(storage_params["scale"], dtype="float32")
+        return (array.astype("float32") + 128) * scale + vmin
+    return np.asarray(array, dtype="float32")
+
+
+def _sq_type(storage):
+    return faiss.ScalarQuantizer.QT_fp16 if storage == "float16" else faiss.ScalarQuantizer.QT_8bit
+
+
+def _ivf_pq_params(params, n, d):
+    nlist = params.get("nlist") or max(1, int(math.sqrt(n)))
+    pq_m = params["pq_m"]
+    while d % pq_m:
+        pq_m -= 1
+    return min(nlist, n), pq_m
+
+
+def build_search_index(config, vectors, ids):
+    """保存用の検索インデックスを作る。返り値は (index, 実際に使った設定)。
+
+    numpy / flat_l2 は通常の IndexFlatL2 を保存する（numpy は読み込み時に保存済みベクトルで検索する）。
+    件数が少なすぎて IVF-PQ を学習できない場合は flat_l2 にフォールバックする。
+    """
+    name, params = config["name"], config["params"]
+    storage = config.get("storage", "float32")
+    compact = storage != "float32"
+    n, d = vectors.shape
+    ids = np.asarray(ids, dtype="int64")
+
+    if name == "ivf_pq":
+        nlist, pq_m = _ivf_pq_params(params, n, d)
+        # 各セントロイド・各コードブックに十分な学習データがなければ近似の精度が出ない
+        if n < max(39 * nlist, 2 ** params["nbits"]):
+            print(f"⚠️ 件数（{n}）が少ないため IVF-PQ を使わず flat_l2 で保存します")
+            return build_search_index(backend_config("flat_l2", storage), vectors, ids)
+        quantizer = faiss.IndexFlatL2(d)
+        base = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, params["nbits"])
+        base.train(vectors)
+        params = dict(params, nlist=nlist, pq_m=pq_m)
+    elif name == "hnsw":
+        base = faiss.IndexHNSWSQ(d, _sq_type(storage), params["m"]) if compact else faiss.IndexHNSWFlat(d, params["m"])
+        base.hnsw.efConstruction = params["ef_construction"]
+    elif name == "inner_product":
+        base = faiss.IndexScalarQuantizer(d, _sq_type(storage), faiss.METRIC_INNER_PRODUCT) if compact else faiss.IndexFlatIP(d)
+    else:
+        base = faiss.IndexScalarQuantizer(d, _sq_type(storage), faiss.METRIC_L2) if compact else faiss.IndexFlatL2(d)
+
+    if compact and n and not base.is_trained:
+        base.train(vectors)
+    index = faiss.IndexIDMap2(base)
+    if n:
+        index.add_with_ids(vectors, ids)
+    return index, {"name": name, "params": params, "storage": storage}
+
+
+class IdFilter:
+    # 検索対象を指定した文書 ID に絞る（名前空間の絞り込み）。バックエンドの make_filter() で作る
+    def __init__(self, ids):
+        self.ids = np.unique(np.asarray(ids, dtype="int64"))
+        self.id_set = set(self.ids.tolist())
+        self.params = None  # faiss の SearchParameters（ID セレクタ付き）
+        self.rows = None    # NumpyBackend 用の行番号
+        self.selector = None
+
+
+def _pad(D, I, k):
+    out_D = np.full((1, k), np.inf, dtype="float32")
+    out_I = np.full((1, k), -1, dtype="int64")
+    out_D[0, :len(D)] = D[:k]
+    out_I[0, :len(I)] = I[:k]
+    return out_D, out_I
+
+
+class FaissBackend:
+    def __init__(self, index, config):
+        self.index = index
+        self.name = config["name"]
+        base = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+        if self.name == "hnsw":
+            base.hnsw.efSearch = HNSW_EF_SEARCH
+        elif self.name == "ivf_pq":
+            base.nprobe = IVF_NPROBE
+        self._inner_product = self.name == "inner_product"
+
+    def make_filter(self, ids):
+        flt = IdFilter(ids)
+        flt.selector = faiss.IDSelectorBatch(flt.ids)  # params は参照を持たないので、こちらで保持する
+        if self.name == "hnsw":
+            params = faiss.SearchParametersHNSW(sel=flt.selector, efSearch=HNSW_EF_SEARCH)
+        elif self.name == "ivf_pq":
+            params = faiss.SearchParametersIVF(sel=flt.selector, nprobe=IVF_NPROBE)
+        else:
+            params = faiss.SearchParameters(sel=flt.selector)
+        try:
+            self.index.search(np.zeros((1, self.index.d), dtype="float32"), 1, params=params)
+            flt.params = params
+        except (TypeError, RuntimeError, AttributeError) as e:
+            # ID セレクタに対応していない faiss・インデックスでは、候補を多めに取ってから絞り込む
+            print(f"⚠️ ID セレクタを使えないため、検索後に絞り込みます（{self.name}）: {e}")
+        return flt
+
+    def search(self, q, k, flt=None):
+        if flt is None:
+            D, I = self.index.search(q, k)
+        elif flt.params is not None:
+            D, I = self.index.search(q, k, params=flt.params)
+        else:
+            D, I = self._search_then_filter(q, k, flt)
+        if self._inner_product:
+            D = np.where(I >= 0, 2.0 - 2.0 * D, np.inf).astype("float32")
+        return D, I
+
+    def _search_then_filter(self, q, k, flt):
+        fetch = k * 4
+        while True:
+            D, I = self.index.search(q, min(fetch, self.index.ntotal))
+            keep = [j for j, i in enumerate(I[0]) if int(i) in flt.id_set]
+            if len(keep) >= k or fetch >= self.index.ntotal:
+                return _pad(D[0][keep], I[0][keep], k)
+            fetch *= 4
+
+
+class NumpyBackend:
+    def __init__(self, vectors, row_ids, storage_params=None):
+        # vectors は memmap のままでもよい（検索のたびにページキャッシュから読む）
+        self.name = "numpy"
+        self.vectors = vectors
+        self.storage_params = storage_params
+        self.row_ids = np.asarray(row_ids, dtype="int64")
+        decoded = decode_vectors(vectors, storage_params)
+        self.sq_norms = np.einsum("ij,ij->i", decoded, decoded).astype("float32")
+
+    def make_filter(self, ids):
+        flt = IdFilter(ids)
+        flt.rows = np.flatnonzero(np.isin(self.row_ids, flt.ids))
+        return flt
+
+    def search(self, q, k, flt=None):
+        q = np.asarray(q, dtype="float32").reshape(1, -1)
+        if flt is None:
+            vectors, sq_norms, row_ids = self.vectors, self.sq_norms, self.row_ids
+        else:
+            # 名前空間の行だけを計算する
+            vectors, sq_norms, row_ids = self.vectors[flt.rows], self.sq_norms[flt.rows], self.row_ids[flt.rows]
+        dist = sq_norms - 2.0 * (decode_vectors(vectors, self.storage_params) @ q[0]) + float(q[0] @ q[0])
+        n = min(k, len(dist))
+        top = np.argpartition(dist, n - 1)[:n] if n else np.array([], dtype="int64")
+        top = top[np.argsort(dist[top])]
+        if flt is not None:
+            return _pad(dist[top].astype("float32"), row_ids[top], k)
+        return dist[top].reshape(1, -1).astype("float32"), row_ids[top].reshape(1, -1)
+
+
+class RescoringBackend:
+    # 圧縮インデックスで多めに候補を取り、保存済みベクトルを float32 に戻して距離を計算し直す
+    def __init__(self, inner, vectors, row_ids, storage_params=None, factor=None):
+        self.inner = inner
+        self.name = inner.name
+        self.vectors = vectors
+        self.storage_params = storage_params
+        self.factor = factor or RESCORE_FACTOR
+        self.row_of = {int(doc_id): row for row, doc_id in enumerate(row_ids)}
+
+    def make_filter(self, ids):
+        return self.inner.make_filter(ids)
+
+    def search(self, q, k, flt=None):
+        q = np.asarray(q, dtype="float32").reshape(1, -1)
+        _, I = self.inner.search(q, k * self.factor, flt)
+        ids = [int(i) for i in I[0] if i >= 0]
+        if not ids:
+            return np.full((1, k), np.inf, dtype="float32"), np.full((1, k), -1, dtype="int64")
+        rows = [self.row_of[i] for i in ids]
+        candidates = decode_vectors(self.vectors[rows], self.storage_params)
+        dist = ((candidates - q) ** 2).sum(axis=1)
+        order = np.argsort(dist)[:k]
+        D = np.full((1, k), np.inf, dtype="float32")
+        out = np.full((1, k), -1, dtype="int64")
+        D[0, :len(order)] = dist[order]
+        out[0, :len(order)] = np.asarray(ids, dtype="int64")[order]
+        return D, out
+
+
+def load_backend(index, vectors, config, storage_params=None):
+    # マニフェストに記録されたバックエンドで検索器を作る（記録がなければ flat_l2）
+    config = config or backend_config("flat_l2", "float32")
+    row_ids = faiss.vector_to_array(index.id_map) if hasattr(index, "id_map") else np.arange(index.ntotal)
+    if config["name"] == "numpy":
+        if vectors is None:
+            raise ValueError("numpy バックエンドには保存済みベクトル（.npy）が必要です")
+        return NumpyBackend(vectors, row_ids, storage_params)
+    backend = FaissBackend(index, config)
+    if config.get("storage", "float32") != "float32" and vectors is not None:
+        return RescoringBackend(backend, vectors, row_ids, storage_params)
+    return backend
+
+
+def storage_recall(vectors, row_ids, search, k=RECALL_K, sample=RECALL_SAMPLE):
+    # float32 の厳密検索を基準にした recall@k（コーパスの一部を質問として使う）
+    row_ids = np.asarray(row_ids, dtype="int64")
+    n = len(vectors)
+    if n == 0:
+        return 1.0
+    k = min(k, n)
+    queries = vectors[np.linspace(0, n - 1, min(sample, n)).astype("int64")]
+    sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    hits = 0
+    for q in queries:
+        exact = row_ids[np.argsort(sq_norms - 2.0 * (vectors @ q))[:k]]
+        _, I = search(q.reshape(1, -1), k)
+        hits += len(set(exact.tolist()) & set(int(i) for i in I[0]))
+    return round(hits / (k * len(queries)), 4)
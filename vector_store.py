@@ -0,0 +1,132 @@
+# vector_store.py
+# 全コーパス共通のベクトルストア（検索用インデックスと保存済みベクトルを 1 組だけ持つ）
+# ・同じテキストの行は、通常用・予約用の両方にあっても 1 回だけ埋め込み・保存する
+# ・差分更新のキーは build_corpus の同一性キー（FAQ の質問、ナレッジのカテゴリと位置など）。内容を直した行は同じ文書 ID のまま
+# ・各コーパスは「名前空間」として自分の行の文書 ID を登録し、検索は ID セレクタでその行だけを対象にする
+# ・複数の名前空間をまとめて 1 回で検索できる（ルーターが両方を選んだとき）
+# ・インデックスとベクトルは読み取り専用で memmap し、gunicorn の worker 間でページを共有する
+import os
+import threading
+
+import numpy as np
+import faiss
+
+from vector_backend import decode_vectors, load_backend
+from incremental_index import content_hash, load_manifest, manifest_path_for, update_index
+
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() == "true"
+# faiss 1.9 以降は IO_FLAG_MMAP_IFC で IndexFlat / IndexIDMap のベクトルも memmap できる（requirements.txt の版）。
+# それ以前の faiss では IVF の転置リストしか memmap されず、フラットなインデックスは worker ごとに読み込まれる
+MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+STORE_INDEX_PATH = "data/unified_index.faiss"
+STORE_VECTOR_PATH = "data/unified_vector_data.npy"
+
+
+def read_index(path):
+    if INDEX_MMAP:
+        return faiss.read_index(path, MMAP_FLAG)
+    return faiss.read_index(path)
+
+
+def load_vectors(path, ntotal):
+    # 保存済みベクトル（インデックス内部の並び）。件数が合わなければ使わない
+    if not os.path.exists(path):
+        return None
+    vectors = np.load(path, mmap_mode="r" if INDEX_MMAP else None)
+    if vectors.ndim != 2 or vectors.shape[0] != ntotal:
+        print(f"⚠️ {path} の件数（{vectors.shape[0]}）がインデックス（{ntotal}）と一致しないため使用しません")
+        return None
+    return vectors
+
+
+def unique_rows(corpora):
+    # 複数コーパスの行を、同じテキストは 1 回だけ出現順に並べる（ストアに登録する行）。
+    # 返り値は (キー, テキスト) のリストの組。キーはそのテキストが最初に出てきた行のもの
+    # （キーが同じでテキストの違う行、たとえば両方の FAQ の同じ質問は、差分更新で出現順に区別される）
+    rows = {}
+    for entries in corpora:
+        for e in entries:
+            rows.setdefault(e["text"], e["key"])
+    return list(rows.values()), list(rows)
+
+
+def update_store(texts, embed, index_path=None, vector_path=None, full=False, backend=None, embedding=None, keys=None):
+    # 行の同一性キーで差分更新する（キーが同じで内容が変わった行は同じ文書 ID のままベクトルを差し替える）
+    return update_index(
+        texts, embed, index_path or STORE_INDEX_PATH, vector_path or STORE_VECTOR_PATH,
+        keys=keys, full=full, backend=backend, embedding=embedding,
+    )
+
+
+class VectorStore:
+    def __init__(self, index_path=None, vector_path=None, texts=None, embed=None, embedding=None, keys=None):
+        # texts・keys・embed は、インデックスがまだ無いときの初回構築にだけ使う
+        self.index_path = index_path or STORE_INDEX_PATH
+        self.vector_path = vector_path or STORE_VECTOR_PATH
+
+        if not os.path.exists(self.index_path):
+            if embed is None or texts is None:
+                raise FileNotFoundError(f"{self.index_path} が見つかりません")
+            print("🧱 ベクトルストアが無いため構築します")
+            update_store(texts, embed, self.index_path, self.vector_path, full=True, embedding=embedding, keys=keys)
+
+        self.index = read_index(self.index_path)
+        self.manifest = load_manifest(manifest_path_for(self.index_path))
+        if not hasattr(self.index, "id_map") or self.manifest is None:
+            raise ValueError(f"{self.index_path} は文書 ID 付きのインデックスではありません。再構築してください。")
+        self.dimension = self.index.d
+        self.vectors = load_vectors(self.vector_path, self.index.ntotal)
+        # 検索バックエンドはビルド時にマニフェストへ記録したものを使う（設定との食い違いを防ぐ）
+        self.storage = self.manifest.get("storage", {"dtype": "float32", "params": {}})
+        self.backend = load_backend(self.index, self.vectors, self.manifest.get("backend"), self.storage.get("params"))
+
+        self._row_of = {int(doc_id): row for row, doc_id in enumerate(faiss.vector_to_array(self.index.id_map))}
+        # ストアは同じテキストを 1 回だけ持つので、内容ハッシュから文書 ID が決まる
+        self._id_of = {doc["hash"]: doc["id"] for doc in self.manifest["docs"]}
+        self.namespaces = {}
+        self._filters = {}
+        self._lock = threading.Lock()
+        print(f"🗂️ ベクトルストア: {self.index.ntotal} 件 / 検索: {self.backend.name}（{self.storage['dtype']}）")
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    def ids_for(self, texts):
+        # テキスト → 文書 ID（ストアに無い・内容の古い行は -1）。同じテキストは同じ ID
+        return [self._id_of.get(content_hash(t), -1) for t in texts]
+
+    def register(self, name, ids):
+        # 名前空間（コーパス）に属する文書 ID を登録する
+        with self._lock:
+            self.namespaces[name] = np.unique(np.asarray([i for i in ids if i >= 0], dtype="int64"))
+            self._filters = {}
+
+    def _filter(self, namespaces):
+        # 名前空間の組み合わせごとに ID セレクタを作り、使い回す
+        key = tuple(sorted(set(namespaces)))
+        with self._lock:
+            flt = self._filters.get(key)
+            if flt is None:
+                ids = np.concatenate([self.namespaces[name] for name in key])
+                flt = self._filters[key] = self.backend.make_filter(ids)
+        return flt
+
+    def search(self, q_vector, k, namespaces=None):
+        # (距離, 文書 ID) を返す。namespaces を指定すると、その名前空間の行だけを検索する
+        q = np.asarray(q_vector, dtype="float32").reshape(1, -1)
+        if namespaces is None:
+            return self.backend.search(q, k)
+        if isinstance(namespaces, str):
+            namespaces = (namespaces,)
+        return self.backend.search(q, k, self._filter(namespaces))
+
+    def vectors_for(self, ids):
+        # 文書 ID の行のベクトル（ストアに無い ID は除く）
+        rows = [self._row_of[int(i)] for i in ids if int(i) in self._row_of]
+        if not rows:
+            return np.zeros((0, self.dimension), dtype="float32")
+        if self.vectors is not None:
+            return decode_vectors(self.vectors[rows], self.storage.get("params"))
+        return np.vstack([self.index.reconstruct(int(i)) for i in ids if int(i) in self._row_of])